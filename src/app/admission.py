@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Admission control of `/rates` queries: per-shape timeouts and a bounded lane for expensive ones."""
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from datetime import date
+
+from .api.pool import settings_from_env
+
+
+# seconds a query of each shape may run before it is cancelled
+STATEMENT_TIMEOUTS = {
+    "port_port": float(os.getenv("STATEMENT_TIMEOUT_PORT_PORT", "2")),
+    "port_region": float(os.getenv("STATEMENT_TIMEOUT_PORT_REGION", "5")),
+    "region_port": float(os.getenv("STATEMENT_TIMEOUT_PORT_REGION", "5")),
+    "region_region": float(os.getenv("STATEMENT_TIMEOUT_REGION_REGION", "10")),
+}
+
+# port->port queries over more days than this are expensive too
+WIDE_RANGE_DAYS = int(os.getenv("ADMISSION_WIDE_RANGE_DAYS", "90"))
+
+
+class Overloaded(Exception):
+    """Raised instead of running a query the server has no capacity for right now."""
+
+    def __init__(self, status_code, detail, retry_after):
+        """
+        :param status_code: int, 429 when too many are queued, 503 when the wait was too long
+        :param detail: str
+        :param retry_after: int, seconds, sent as `Retry-After`
+        """
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+def is_expensive(shape, date_from, date_to):
+    """
+    :param shape: str as returned by `metrics.shape_of`
+    :param date_from: str in format "YYYY-MM-DD"
+    :param date_to: str in format "YYYY-MM-DD"
+    :return: bool
+        True for queries involving a region or a range wider than `WIDE_RANGE_DAYS`.
+    """
+    if shape != "port_port":
+        return True
+    return (date.fromisoformat(date_to) - date.fromisoformat(date_from)).days + 1 > WIDE_RANGE_DAYS
+
+
+def statement_timeout(shape):
+    """:return: float seconds a query of `shape` may run"""
+    return STATEMENT_TIMEOUTS.get(shape, STATEMENT_TIMEOUTS["region_region"])
+
+
+class AdmissionLimiter:
+    """
+    Bounds how many expensive queries hold a connection at once, so that the rest
+    of the pool stays free for cheap lookups, which are never queued here.
+    Expensive queries beyond `limit` wait at most `queue_timeout` seconds, and at
+    most `max_queue` of them wait: past that they are shed straight away.
+    """
+
+    def __init__(self, limit, max_queue=32, queue_timeout=0.5, retry_after=1):
+        """
+        :param limit: int, expensive queries running at once
+        :param max_queue: int, expensive queries waiting at once
+        :param queue_timeout: float, seconds one may wait for a slot
+        :param retry_after: int, seconds suggested to shed clients
+        """
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self._semaphore = None
+
+        self.active = 0
+        self.queued = 0
+        self.admitted_total = 0
+        self.rejected_total = 0
+        self.timeouts_total = 0
+
+    def _get_semaphore(self):
+        """Helper private function to create the semaphore once inside a running loop."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        return self._semaphore
+
+    @asynccontextmanager
+    async def admit(self, expensive):
+        """
+        Async context manager holding a slot for the duration of an expensive query.
+        :param expensive: bool, cheap queries go through without waiting
+        :raise: Overloaded
+        """
+        if not expensive:
+            yield
+            return
+
+        semaphore = self._get_semaphore()
+        # a free slot is taken right away, without the task `wait_for` would spawn
+        if not semaphore.locked():
+            await semaphore.acquire()
+        else:
+            if self.queued >= self.max_queue:
+                self.rejected_total += 1
+                raise Overloaded(429, "[BUSY]Too many expensive queries waiting, retry later.", self.retry_after)
+
+            self.queued += 1
+            try:
+                await asyncio.wait_for(semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.timeouts_total += 1
+                raise Overloaded(503, "[BUSY]No capacity for expensive queries, retry later.", self.retry_after)
+            finally:
+                self.queued -= 1
+
+        self.active += 1
+        self.admitted_total += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            semaphore.release()
+
+    def stats(self):
+        """
+        :return: dict
+            Slots in use and counters since startup.
+        """
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queued": self.queued,
+            "admitted_total": self.admitted_total,
+            "rejected_total": self.rejected_total,
+            "timeouts_total": self.timeouts_total,
+        }
+
+
+admission = AdmissionLimiter(
+    # by default half of the pool, the other half is kept for cheap lookups
+    limit=int(os.getenv("ADMISSION_EXPENSIVE_LIMIT", "0")) or max(1, settings_from_env()["max_size"] // 2),
+    max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "32")),
+    queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "0.5")),
+    retry_after=int(os.getenv("ADMISSION_RETRY_AFTER", "1")),
+)
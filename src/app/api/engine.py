@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+In-process columnar copy of the daily price aggregates, answering `/rates` without the db.
+Selected with `RATES_BACKEND=memory`; the functions below mirror `execute_when_*` of `sql.py`.
+"""
+import asyncio
+import os
+from datetime import date
+
+import numpy as np
+
+from ..validate.result import bucket_starts, day_axis
+from .regions import region_index
+from .stats import stats_state
+
+
+RATES_BACKEND = os.getenv("RATES_BACKEND", "postgres")
+
+# day offsets take the low bits of the sort key, lanes the high ones
+DAY_BITS = 21
+DAY_MASK = (1 << DAY_BITS) - 1
+
+LOAD_FROM_PRICES = """
+    SELECT orig_code, dest_code, day, COUNT(*) AS price_count, SUM(price) AS price_sum
+        FROM prices
+        GROUP BY orig_code, dest_code, day
+"""
+
+LOAD_FROM_STATS = """
+    SELECT orig_code, dest_code, day, price_count, price_sum
+        FROM lane_daily_stats
+"""
+
+READ_CODES = """
+    SELECT code FROM ports
+"""
+
+
+def arrays_of(orig_codes, dest_codes, days, counts, sums, codes=()):
+    """
+    Sorts and aggregates rows into the arrays of a `PriceEngine`, rows that share a lane and day summed.
+    :param orig_codes: Sequence[str]
+    :param dest_codes: Sequence[str]
+    :param days: Sequence[int] proleptic Gregorian ordinals, Eg: `date.toordinal()`
+    :param counts: Sequence[int] prices of each row (1 for raw prices)
+    :param sums: Sequence[int] sum of those prices
+    :param codes: Iterable[str] port codes to encode even if they have no prices
+    :return: tuple[numpy.ndarray, int, dict]
+        The sorted port codes, the day epoch and an array for each name of `PriceEngine.COLUMNS`.
+    """
+    orig_codes = np.asarray(orig_codes, dtype=object)
+    dest_codes = np.asarray(dest_codes, dtype=object)
+    days = np.asarray(days, dtype=np.int64)
+
+    all_codes = np.unique(np.concatenate([orig_codes, dest_codes, np.array(list(codes), dtype=object)]))
+    epoch = int(days.min()) if len(days) else 0
+    if len(days) and int(days.max()) - epoch > DAY_MASK:
+        raise ValueError("prices span more days than the engine keys can hold")
+
+    lanes = np.searchsorted(all_codes, orig_codes) * len(all_codes) + np.searchsorted(all_codes, dest_codes)
+    keys = (lanes.astype(np.int64) << DAY_BITS) | (days - epoch)
+    keys, rows = np.unique(keys, return_inverse=True)
+    lanes, lane_starts = np.unique(keys >> DAY_BITS, return_index=True)
+
+    # exact as long as a sum stays below 2**53
+    counts = np.bincount(rows, weights=np.asarray(counts, dtype=np.float64), minlength=len(keys))
+    sums = np.bincount(rows, weights=np.asarray(sums, dtype=np.float64), minlength=len(keys))
+    return all_codes, epoch, {
+        "keys": keys,
+        "counts": counts.astype(np.int64),
+        "sums": sums.astype(np.int64),
+        "lanes": lanes,
+        "lane_offsets": np.append(lane_starts, len(keys)).astype(np.int64),
+    }
+
+
+def _arrays_of_batches(batches, codes):
+    """Helper private function to run `arrays_of` on the records fetched by `PriceEngine.refresh`."""
+    rows = [row for batch in batches for row in batch]
+    return arrays_of(
+        [row["orig_code"] for row in rows],
+        [row["dest_code"] for row in rows],
+        [row["day"].toordinal() for row in rows],
+        [row["price_count"] for row in rows],
+        [row["price_sum"] for row in rows],
+        codes=codes,
+    )
+
+
+class PriceEngine:
+    """
+    Count and sum of prices per (lane, day), in arrays sorted by (orig_code, dest_code, day).
+
+    Port codes are dictionary-encoded as ints (`codes` holds them sorted) and days are
+    stored as offsets from `epoch`, so one int64 key per row encodes the lane and
+    the day: a lane's days are a contiguous slice found with `searchsorted`, and
+    several lanes (regions) are summed per day with `bincount`.
+    `lanes` lists the lanes having prices, sorted, and the rows of `lanes[i]` are
+    `lane_offsets[i]:lane_offsets[i + 1]`; lanes without prices are skipped up front.
+    """
+
+    # arrays saved to and mapped back from a snapshot (see `snapshot.py`)
+    COLUMNS = ("keys", "counts", "sums", "lanes", "lane_offsets")
+
+    def __init__(self):
+        self.codes = np.array([], dtype=object)
+        self.epoch = 0
+        self.keys = np.array([], dtype=np.int64)
+        self.counts = np.array([], dtype=np.int64)
+        self.sums = np.array([], dtype=np.int64)
+        self.lanes = np.array([], dtype=np.int64)
+        self.lane_offsets = np.zeros(1, dtype=np.int64)
+        # prices version the arrays reflect, None until loaded
+        self.version = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def build(self, orig_codes, dest_codes, days, counts, sums, codes=(), version=None):
+        """
+        Replaces the arrays, aggregating rows that share a lane and day.
+        :param orig_codes: Sequence[str]
+        :param dest_codes: Sequence[str]
+        :param days: Sequence[int] proleptic Gregorian ordinals, Eg: `date.toordinal()`
+        :param counts: Sequence[int] prices of each row (1 for raw prices)
+        :param sums: Sequence[int] sum of those prices
+        :param codes: Iterable[str] port codes to encode even if they have no prices
+        :param version: int or None, prices version of the rows
+        """
+        all_codes, epoch, columns = arrays_of(orig_codes, dest_codes, days, counts, sums, codes)
+        self.assign(all_codes, epoch, version, **columns)
+
+    def assign(self, codes, epoch, version, **columns):
+        """
+        Swaps in arrays built elsewhere, Eg: views of a mapped snapshot.
+        :param codes: numpy.ndarray of sorted str port codes
+        :param epoch: int, ordinal of the day of offset 0
+        :param version: int or None, prices version of the arrays
+        :param columns: numpy.ndarray for each name of `COLUMNS`
+        """
+        # queries run on the event loop between two awaits, none sees a mix of old and new arrays
+        for name in self.COLUMNS:
+            setattr(self, name, columns[name])
+        self.codes = codes
+        self.epoch = epoch
+        self.version = version
+
+    async def refresh(self, conn, chunk_rows=100_000):
+        """
+        Loads the aggregates from the db, from `lane_daily_stats` when they are fresh.
+        The records are fetched in batches of `chunk_rows`, and turned into arrays in a
+        thread: on a full table that takes seconds the event loop spends answering requests.
+        :param conn: asyncpg.Connection object
+        :param chunk_rows: int, rows per round-trip of the cursor
+        """
+        from_stats = await stats_state.is_fresh(conn)
+        version = stats_state.prices_version
+        batches = []
+        async with conn.transaction():
+            cursor = await conn.cursor(LOAD_FROM_STATS if from_stats else LOAD_FROM_PRICES)
+            while True:
+                batch = await cursor.fetch(chunk_rows)
+                if not batch:
+                    break
+                batches.append(batch)
+            codes = [row["code"] for row in await conn.fetch(READ_CODES)]
+        all_codes, epoch, columns = await asyncio.get_running_loop().run_in_executor(
+            None, _arrays_of_batches, batches, codes
+        )
+        # swapped in on the event loop, see `assign`
+        self.assign(all_codes, epoch, version, **columns)
+
+    def ids_of(self, codes):
+        """
+        :param codes: Iterable[str] port codes
+        :return: numpy.ndarray of their ints, unknown codes left out
+        """
+        codes = np.asarray(list(codes), dtype=object)
+        if not len(codes) or not len(self.codes):
+            return np.array([], dtype=np.int64)
+        ids = np.searchsorted(self.codes, codes)
+        found = ids < len(self.codes)
+        found[found] = self.codes[ids[found]] == codes[found]
+        return np.unique(ids[found])
+
+    def aggregate(self, orig_ids, dest_ids, date_from, date_to):
+        """
+        Price count and sum per day of [`date_from`, `date_to`] over every lane from
+        one of `orig_ids` to one of `dest_ids`.
+        :param orig_ids: numpy.ndarray as returned by `ids_of`
+        :param dest_ids: numpy.ndarray as returned by `ids_of`
+        :param date_from: datetime.date
+        :param date_to: datetime.date
+        :return: tuple[numpy.ndarray, numpy.ndarray] counts and sums, one per day
+        """
+        n_days = (date_to - date_from).days + 1
+        first = date_from.toordinal() - self.epoch
+        last = date_to.toordinal() - self.epoch
+        if not len(orig_ids) or not len(dest_ids) or not len(self.lanes) or last < 0 or first > DAY_MASK:
+            return np.zeros(n_days, dtype=np.int64), np.zeros(n_days, dtype=np.int64)
+
+        lanes = (orig_ids[:, None] * len(self.codes) + dest_ids[None, :]).ravel().astype(np.int64)
+        rows, _ = self._rows_of(lanes, first, last)
+        slots = (self.keys[rows] & DAY_MASK) - first
+        counts = np.bincount(slots, weights=self.counts[rows], minlength=n_days)
+        sums = np.bincount(slots, weights=self.sums[rows], minlength=n_days)
+        return counts.astype(np.int64), sums.astype(np.int64)
+
+    def _rows_of(self, lanes, first, last):
+        """
+        Helper private function to find the rows of `lanes` from day offset `first` to `last`.
+        :return: tuple[numpy.ndarray, numpy.ndarray]
+            The rows, and for each the position of its lane in `lanes`.
+        """
+        # lanes without prices are dropped through the (much shorter) lane index
+        found = np.minimum(np.searchsorted(self.lanes, lanes), len(self.lanes) - 1)
+        present = np.flatnonzero(self.lanes[found] == lanes)
+        keys = lanes[present] << DAY_BITS
+        starts = np.searchsorted(self.keys, keys | max(first, 0), side="left")
+        lengths = np.searchsorted(self.keys, keys | min(last, DAY_MASK), side="right") - starts
+
+        # indexes of every row of every slice, without a Python loop over the lanes
+        offsets = np.cumsum(lengths) - lengths
+        rows = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+        return rows, np.repeat(present, lengths)
+
+    def matrix(self, orig_codes, dest_codes, date_from, date_to, collapse=False):
+        """
+        Price count and sum of every lane from one of `orig_codes` to one of `dest_codes`,
+        per day of [`date_from`, `date_to`] or over all of them.
+        :param orig_codes: Sequence[str] port codes, the first axis in this order
+        :param dest_codes: Sequence[str] port codes, the second axis in this order
+        :param date_from: str in format "YYYY-MM-DD"
+        :param date_to: str in format "YYYY-MM-DD"
+        :param collapse: bool, whether to sum the days instead of keeping a third axis
+        :return: tuple[numpy.ndarray, numpy.ndarray]
+            counts and sums shaped (origins, destinations[, days]), as `result.to_matrix` makes them.
+        """
+        first = date.fromisoformat(date_from).toordinal() - self.epoch
+        last = date.fromisoformat(date_to).toordinal() - self.epoch
+        n_days = last - first + 1
+        shape = (len(orig_codes), len(dest_codes)) + (() if collapse else (n_days,))
+        orig_ids, orig_known = self._positions(orig_codes)
+        dest_ids, dest_known = self._positions(dest_codes)
+        if not len(self.lanes) or last < 0 or first > DAY_MASK:
+            return np.zeros(shape, dtype=np.int64), np.zeros(shape, dtype=np.int64)
+
+        # cells whose both ports are known, in row-major order of the matrix
+        cells = np.flatnonzero(orig_known[:, None] & dest_known[None, :])
+        lanes = (orig_ids[:, None] * len(self.codes) + dest_ids[None, :]).ravel()[cells]
+        rows, positions = self._rows_of(lanes, first, last)
+        slots = cells[positions]
+        if not collapse:
+            slots = slots * n_days + (self.keys[rows] & DAY_MASK) - first
+        size = int(np.prod(shape))
+        counts = np.bincount(slots, weights=self.counts[rows], minlength=size)
+        sums = np.bincount(slots, weights=self.sums[rows], minlength=size)
+        return counts.astype(np.int64).reshape(shape), sums.astype(np.int64).reshape(shape)
+
+    def _positions(self, codes):
+        """
+        Helper private function to get the ints of `codes`, in their order.
+        :return: tuple[numpy.ndarray, numpy.ndarray] the ints and whether each code is known
+        """
+        codes = np.asarray(list(codes), dtype=object)
+        if not len(self.codes):
+            return np.zeros(len(codes), dtype=np.int64), np.zeros(len(codes), dtype=bool)
+        ids = np.minimum(np.searchsorted(self.codes, codes), len(self.codes) - 1)
+        return ids.astype(np.int64), self.codes[ids] == codes
+
+    def buckets(self, orig_ids, dest_ids, date_from, date_to, granularity="day"):
+        """
+        `aggregate` summed per bucket of `granularity`.
+        :param date_from: str in format "YYYY-MM-DD"
+        :param date_to: str in format "YYYY-MM-DD"
+        :param granularity: str as returned by `granularity.validate`
+        :return: tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]
+            `datetime64[D]` first days of the buckets, their counts and sums.
+        """
+        counts, sums = self.aggregate(orig_ids, dest_ids, date.fromisoformat(date_from), date.fromisoformat(date_to))
+        days = day_axis(date_from, date_to)
+        if granularity != "day":
+            starts = bucket_starts(date_from, date_to, granularity)
+            days, counts, sums = days[starts], np.add.reduceat(counts, starts), np.add.reduceat(sums, starts)
+        return days, counts, sums
+
+    def arrays(self, orig_ids, dest_ids, date_from, date_to, granularity="day"):
+        """
+        The same as `result.to_arrays` would make of the rows of the SQL path.
+        :param date_from: str in format "YYYY-MM-DD"
+        :param date_to: str in format "YYYY-MM-DD"
+        :param granularity: str as returned by `granularity.validate`
+        :return: tuple[numpy.ndarray, numpy.ndarray] `datetime64[D]` days and rounded averages
+        """
+        days, counts, sums = self.buckets(orig_ids, dest_ids, date_from, date_to, granularity)
+        # same statistical condition as `result.to_arrays`: more than 2 prices (per bucket)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            prices = np.where(counts > 2, np.rint(sums / counts), np.nan)
+        return days, prices
+
+    def rows(self, orig_ids, dest_ids, date_from, date_to, granularity="day"):
+        """
+        The rows the SQL path returns: one per day (or bucket), with keys "days", "average_price" and "day".
+        :return: List[dict]
+        """
+        days, counts, sums = self.buckets(orig_ids, dest_ids, date_from, date_to, granularity)
+        return [
+            {
+                "days": int(count),
+                "average_price": int(total) / int(count) if count else None,
+                "day": day,
+            }
+            for day, count, total in zip(days.tolist(), counts, sums)
+        ]
+
+
+engine = PriceEngine()
+
+
+async def _ids_of_region(conn, slug):
+    """Helper function to get the ints of the ports below region `slug`."""
+    return engine.ids_of(await region_index.resolve(conn, slug))
+
+
+async def execute_when_both_ports(conn, origin, destination, date_from, date_to, granularity="day"):
+    """`sql.execute_when_both_ports` answered from `engine`."""
+    return engine.rows(engine.ids_of([origin]), engine.ids_of([destination]), date_from, date_to, granularity)
+
+
+async def execute_when_one_region(conn, origin, destination, date_from, date_to, first_is_region,
+                                  granularity="day"):
+    """`sql.execute_when_one_region` answered from `engine`."""
+    if first_is_region:
+        orig_ids, dest_ids = await _ids_of_region(conn, origin), engine.ids_of([destination])
+    else:
+        orig_ids, dest_ids = engine.ids_of([origin]), await _ids_of_region(conn, destination)
+    return engine.rows(orig_ids, dest_ids, date_from, date_to, granularity)
+
+
+async def execute_when_both_region(conn, origin, destination, date_from, date_to, granularity="day"):
+    """`sql.execute_when_both_region` answered from `engine`."""
+    return engine.rows(
+        await _ids_of_region(conn, origin), await _ids_of_region(conn, destination), date_from, date_to, granularity
+    )
+
+
+async def rates_arrays(conn, type_loc, origin, destination, date_from, date_to, granularity="day"):
+    """
+    Days and rounded average prices of a query straight from `engine`,
+    skipping the rows `execute_when_*` build for parity with the SQL path.
+    :return: tuple[numpy.ndarray, numpy.ndarray] as returned by `result.to_arrays`
+    """
+    if type_loc[0] == "region":
+        orig_ids = await _ids_of_region(conn, origin)
+    else:
+        orig_ids = engine.ids_of([origin])
+    if type_loc[1] == "region":
+        dest_ids = await _ids_of_region(conn, destination)
+    else:
+        dest_ids = engine.ids_of([destination])
+    return engine.arrays(orig_ids, dest_ids, date_from, date_to, granularity)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""Bulk loading of new prices from CSV/NDJSON, via `POST /rates/prices` or `python -m app.api.ingest`."""
+import asyncio
+import csv
+import json
+import os
+import sys
+import time
+from datetime import date
+
+import asyncpg
+
+from .stats import READ_META, refresh_stats
+
+
+COLUMNS = ("orig_code", "dest_code", "day", "price")
+
+MEDIA_TYPES = ("text/csv", "application/x-ndjson")
+
+# rows sent per COPY, bounds the memory held by a load whatever its size
+INGEST_BATCH_ROWS = int(os.getenv("INGEST_BATCH_ROWS", "50000"))
+
+CREATE_STAGING = """
+    CREATE TEMPORARY TABLE prices_staging (LIKE prices) ON COMMIT DROP
+"""
+
+# rows whose lane has a port unknown to `ports` are not loaded
+REJECT_UNKNOWN_PORTS = """
+    WITH rejected AS (
+        DELETE FROM prices_staging AS staging
+            WHERE NOT EXISTS (SELECT 1 FROM ports WHERE ports.code = staging.orig_code) OR
+                  NOT EXISTS (SELECT 1 FROM ports WHERE ports.code = staging.dest_code)
+            RETURNING orig_code, dest_code
+    )
+    SELECT COUNT(*) AS rows,
+           (SELECT array_agg(DISTINCT code)
+                FROM (SELECT orig_code AS code FROM rejected
+                      UNION
+                      SELECT dest_code FROM rejected) AS codes
+                WHERE NOT EXISTS (SELECT 1 FROM ports WHERE ports.code = codes.code)) AS codes
+        FROM rejected
+"""
+
+TOUCHED_KEYS = """
+    SELECT DISTINCT orig_code, dest_code, day
+        FROM prices_staging
+"""
+
+INSERT_STAGED = """
+    INSERT INTO prices (orig_code, dest_code, day, price)
+        SELECT orig_code, dest_code, day, price
+            FROM prices_staging
+"""
+
+
+class IngestError(ValueError):
+    """A line of the input could not be read as a price."""
+
+
+def _record(values, line_number):
+    """
+    Helper private function to convert one input row into the tuple copied to `prices`.
+    :param values: Sequence[str|int] orig_code, dest_code, day, price
+    :param line_number: int, reported when the row is invalid
+    :return: tuple[str, str, datetime.date, int]
+    :raise: IngestError
+    """
+    try:
+        orig_code, dest_code, day, price = values
+        return str(orig_code), str(dest_code), date.fromisoformat(day), int(price)
+    except (TypeError, ValueError):
+        raise IngestError(f"Line {line_number}: expected {', '.join(COLUMNS)}, got {values!r}")
+
+
+async def iter_lines(chunks):
+    """
+    Splits a stream of bytes (Eg: a request body) into text lines.
+    :param chunks: AsyncIterable[bytes]
+    :return: AsyncIterator[str]
+    """
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.decode()
+    if pending:
+        yield pending.decode()
+
+
+async def read_records(lines, media_type):
+    """
+    Parses prices out of CSV (with a header naming the columns) or NDJSON lines.
+    :param lines: AsyncIterable[str]
+    :param media_type: str, one of `MEDIA_TYPES`
+    :return: AsyncIterator[tuple[str, str, datetime.date, int]]
+    :raise: IngestError on the first invalid line.
+    """
+    header = None
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        line = line.strip()
+        if not line:
+            continue
+
+        if media_type == "text/csv":
+            values = next(csv.reader([line]))
+            if header is None:
+                header = values
+                if sorted(header) != sorted(COLUMNS):
+                    raise IngestError(f"Line {line_number}: expected a header with {', '.join(COLUMNS)}")
+                continue
+            values = dict(zip(header, values))
+        else:
+            try:
+                values = json.loads(line)
+            except ValueError:
+                raise IngestError(f"Line {line_number}: not JSON")
+            if not isinstance(values, dict):
+                raise IngestError(f"Line {line_number}: expected an object")
+
+        yield _record([values.get(column) for column in COLUMNS], line_number)
+
+
+async def _written_version(conn):
+    """
+    Helper private function to read the prices version the insert stamped, before its
+    transaction commits and lets another write bump it.
+    :return: int, or None if the version stamps are not migrated.
+    """
+    try:
+        # a savepoint, so a missing table does not abort the load
+        async with conn.transaction():
+            meta = await conn.fetchrow(READ_META)
+    except asyncpg.UndefinedTableError:
+        return None
+    return meta["prices_version"]
+
+
+async def ingest(conn, records, batch_rows=INGEST_BATCH_ROWS):
+    """
+    Loads prices through a staging table: rows are copied in batches, the ones with
+    unknown ports are dropped and the rest inserted into `prices` in one transaction,
+    after which the daily statistics of the touched lanes and days are refreshed.
+    `prices` has no key, so new rows add to the ones of the same lane and day.
+    :param conn: asyncpg.Connection object
+    :param records: AsyncIterable[tuple[str, str, datetime.date, int]] as from `read_records`
+    :param batch_rows: int, rows per COPY
+    :return: dict
+        rows read, inserted and rejected (with the unknown port codes), seconds and rows/sec.
+    """
+    started = time.perf_counter()
+    read = 0
+
+    async with conn.transaction():
+        await conn.execute(CREATE_STAGING)
+
+        batch = []
+        async for record in records:
+            batch.append(record)
+            if len(batch) >= batch_rows:
+                await conn.copy_records_to_table("prices_staging", records=batch, columns=COLUMNS)
+                read += len(batch)
+                batch = []
+        if batch:
+            await conn.copy_records_to_table("prices_staging", records=batch, columns=COLUMNS)
+            read += len(batch)
+
+        rejected = await conn.fetchrow(REJECT_UNKNOWN_PORTS)
+        keys = [tuple(key) for key in await conn.fetch(TOUCHED_KEYS)]
+        version = None
+        # an insert of no rows would still bump `prices_version`, leaving the stats stale
+        if keys:
+            await conn.execute(INSERT_STAGED)
+            version = await _written_version(conn)
+
+    # without version stamps (migration 0004 not applied) there are no statistics to refresh
+    if version is not None:
+        await refresh_stats(conn, keys, version)
+
+    seconds = time.perf_counter() - started
+    return {
+        "rows": read,
+        "inserted": read - rejected["rows"],
+        "rejected": rejected["rows"],
+        "unknown_ports": sorted(rejected["codes"] or []),
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(read / seconds) if seconds else 0,
+    }
+
+
+async def _file_lines(path):
+    with open(path, encoding="utf-8") as lines:
+        for line in lines:
+            yield line
+
+
+async def _main(path):
+    media_type = "application/x-ndjson" if path.endswith((".ndjson", ".jsonl")) else "text/csv"
+    conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+    try:
+        report = await ingest(conn, read_records(_file_lines(path), media_type))
+    finally:
+        await conn.close()
+    print(json.dumps(report))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise SystemExit("usage: python -m app.api.ingest <prices.csv|prices.ndjson>")
+    asyncio.run(_main(sys.argv[1]))
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """Basic Pydantic Models to get reference of Tables."""
-from typing import Union
+from typing import List, Union
 from datetime import date
 from pydantic import BaseModel
 
@@ -22,3 +22,16 @@ class PriceSchema(BaseModel):
     dest_code: str
     day: date
     price: int
+
+
+class LaneSchema(BaseModel):
+    origin: str
+    destination: str
+    date_from: Union[str, None] = None
+    date_to: Union[str, None] = None
+
+
+class BatchSchema(BaseModel):
+    date_from: Union[str, None] = None
+    date_to: Union[str, None] = None
+    lanes: List[LaneSchema]
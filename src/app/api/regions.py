@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""In-process index of the Regions/Ports tree, so region slugs resolve without the db."""
+import asyncio
+import json
+import os
+import time
+
+from ..shared_cache import shared_cache
+
+
+REGIONS_QUERY = """
+    SELECT slug, parent_slug
+        FROM Regions
+"""
+
+PORTS_QUERY = """
+    SELECT code, parent_slug
+        FROM Ports
+"""
+
+
+class RegionIndex:
+    """
+    Maps every region slug to the codes of all ports below it, at any depth.
+
+    The tree is small (tens of regions, hundreds of ports) so it is loaded whole
+    and the transitive closure is computed once per load. It is reloaded lazily
+    when older than `ttl` seconds, or explicitly through `refresh`.
+    """
+
+    # key of the raw rows in the shared tier
+    SHARED_KEY = "regions:rows"
+
+    def __init__(self, ttl=300.0, shared=None):
+        """
+        :param ttl: float
+            Seconds after which the next lookup reloads the tree (0 disables expiry).
+        :param shared: SharedCache or None
+            Where the rows are shared with the other worker processes, so that
+            only one of them queries the db per `ttl`.
+        """
+        self.ttl = ttl
+        self.shared = shared
+        self.loaded_at = None
+        self.loads = 0
+        self._ports = {}
+        # created lazily so it binds to the loop serving requests
+        self._lock = None
+
+    def load(self, regions, ports):
+        """
+        Builds the closure from raw rows.
+        :param regions: Iterable of rows with keys "slug" and "parent_slug"
+        :param ports: Iterable of rows with keys "code" and "parent_slug"
+        """
+        children = {}
+        direct_ports = {}
+        for region in regions:
+            children.setdefault(region["slug"], [])
+            if region["parent_slug"] is not None:
+                children.setdefault(region["parent_slug"], []).append(region["slug"])
+        for port in ports:
+            direct_ports.setdefault(port["parent_slug"], []).append(port["code"])
+
+        closure = {}
+
+        def _collect(slug, seen):
+            """Helper private function to gather ports of `slug` and its descendants."""
+            if slug in closure:
+                return closure[slug]
+            codes = set(direct_ports.get(slug, []))
+            for child in children.get(slug, []):
+                # guard against a (malformed) cycle in parent_slug
+                if child not in seen:
+                    codes |= _collect(child, seen | {child})
+            closure[slug] = codes
+            return codes
+
+        for slug in children:
+            _collect(slug, {slug})
+
+        self._ports = {slug: sorted(codes) for slug, codes in closure.items()}
+        self.loaded_at = time.monotonic()
+        self.loads += 1
+
+    @property
+    def is_loaded(self):
+        """Whether the tree was loaded at least once (it may still be stale)."""
+        return self.loads > 0
+
+    def is_stale(self):
+        """Whether the index was never loaded or has outlived its `ttl`."""
+        if self.loaded_at is None:
+            return True
+        return bool(self.ttl) and time.monotonic() - self.loaded_at > self.ttl
+
+    async def refresh(self, conn):
+        """
+        Reloads the tree from the database, or from the shared tier if
+        another worker did so less than `ttl` seconds ago.
+        :param conn: asyncpg.Connection object
+        """
+        async with self._get_lock():
+            await self._reload(conn)
+
+    async def _reload(self, conn):
+        if self.shared is not None:
+            rows = self.shared.get(self.SHARED_KEY)
+            if rows is not None:
+                rows = json.loads(rows)
+                self.load(rows["regions"], rows["ports"])
+                return
+
+        regions = [dict(row) for row in await conn.fetch(REGIONS_QUERY)]
+        ports = [dict(row) for row in await conn.fetch(PORTS_QUERY)]
+        self.load(regions, ports)
+        if self.shared is not None:
+            self.shared.put(
+                self.SHARED_KEY,
+                json.dumps({"regions": regions, "ports": ports}).encode(),
+                ttl=self.ttl or None,
+            )
+
+    def _get_lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def invalidate(self):
+        """Forces the next lookup to reload the tree, Eg: after ports were added."""
+        self.loaded_at = None
+        if self.shared is not None:
+            self.shared.delete(self.SHARED_KEY)
+
+    def ports_of(self, slug):
+        """
+        Port codes below `slug` from the current load, without touching the db.
+        :param slug: str
+        :return: List[str]
+            Empty for an unknown slug, which then simply matches no prices.
+        """
+        return self._ports.get(slug, [])
+
+    async def resolve(self, conn, slug):
+        """
+        Port codes below `slug`, reloading the tree first if it is stale.
+        :param conn: asyncpg.Connection object
+        :param slug: str
+        :return: List[str]
+        """
+        if self.is_stale():
+            async with self._get_lock():
+                # another request may have reloaded it while this one waited
+                if self.is_stale():
+                    await self._reload(conn)
+        return self.ports_of(slug)
+
+
+region_index = RegionIndex(ttl=float(os.getenv("REGION_INDEX_TTL", "300")), shared=shared_cache)
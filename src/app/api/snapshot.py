@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""Versioned binary snapshot of the in-memory engine, memory-mapped by every worker of a host."""
+import asyncio
+import fcntl
+import json
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+
+import numpy as np
+
+from .engine import DAY_BITS, PriceEngine
+from .regions import PORTS_QUERY, REGIONS_QUERY
+from .stats import stats_state
+
+
+# read by `app.main`, set by `python -m app.serve` when `RATES_BACKEND=memory`
+RATES_SNAPSHOT_PATH = os.getenv("RATES_SNAPSHOT_PATH")
+
+MAGIC = b"RATESNAP"
+# bumped whenever the layout below changes, older files are then rebuilt
+FORMAT = 1
+# column offsets are multiples of it, so the views are aligned
+ALIGN = 64
+_PREFIX = struct.Struct("<8sI")
+
+
+class SnapshotError(ValueError):
+    """Raised for a file that is not a snapshot this code can map."""
+
+
+def _fixed_width(values):
+    """Helper private function to turn str (or None) values into a fixed-width bytes column."""
+    encoded = [value.encode() if value is not None else b"" for value in values]
+    return np.array(encoded, dtype=f"S{max([len(value) for value in encoded] + [1])}")
+
+
+def _strings(column):
+    """Helper private function to read a fixed-width bytes column back, "" being None."""
+    return [value.decode() or None for value in column.tolist()]
+
+
+def _aligned(offset):
+    """Helper private function to round `offset` up to a multiple of `ALIGN`."""
+    return -(-offset // ALIGN) * ALIGN
+
+
+def write(path, engine, regions, ports):
+    """
+    Saves `engine` and the region tree to `path`, atomically: a new file is written next
+    to it then renamed over it, so processes that mapped the former one keep reading it
+    and the next ones to open `path` see the new one, never a partly written file.
+
+    Layout: `MAGIC`, the header length (uint32), a JSON header giving the prices version,
+    the day epoch and each column's dtype, length and offset, then the fixed-width columns
+    (offsets count from the first multiple of `ALIGN` after the header).
+    :param path: str
+    :param engine: PriceEngine
+    :param regions: Iterable of rows with keys "slug" and "parent_slug"
+    :param ports: Iterable of rows with keys "code" and "parent_slug"
+    """
+    regions, ports = list(regions), list(ports)
+    columns = {
+        "codes": _fixed_width(engine.codes),
+        **{name: np.ascontiguousarray(getattr(engine, name)) for name in PriceEngine.COLUMNS},
+        "region_slugs": _fixed_width([row["slug"] for row in regions]),
+        "region_parents": _fixed_width([row["parent_slug"] for row in regions]),
+        "port_codes": _fixed_width([row["code"] for row in ports]),
+        "port_parents": _fixed_width([row["parent_slug"] for row in ports]),
+    }
+
+    layout, offset = {}, 0
+    for name, column in columns.items():
+        layout[name] = {"dtype": column.dtype.str, "length": len(column), "offset": offset}
+        offset = _aligned(offset + column.nbytes)
+    header = json.dumps({
+        "format": FORMAT,
+        "prices_version": engine.version,
+        "epoch": engine.epoch,
+        "day_bits": DAY_BITS,
+        "columns": layout,
+    }).encode()
+    start = _aligned(_PREFIX.size + len(header))
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, "wb") as file:
+            file.write(_PREFIX.pack(MAGIC, len(header)))
+            file.write(header)
+            for name, column in columns.items():
+                file.write(b"\0" * (start + layout[name]["offset"] - file.tell()))
+                file.write(column.data)
+            # up to the end of the last column, empty ones included
+            file.write(b"\0" * (start + offset - file.tell()))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary, path)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+class Snapshot:
+    """
+    A snapshot file mapped read-only: its columns are NumPy views of the mapping, no
+    byte is copied and the pages are shared by every process mapping the same file.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: str
+        :raise: FileNotFoundError, SnapshotError
+        """
+        with open(path, "rb") as file:
+            # the mapping outlives the file descriptor, and a later rename over `path`
+            self._mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mapping) < _PREFIX.size:
+            raise SnapshotError(f"{path} is too short to be a snapshot")
+        magic, header_length = _PREFIX.unpack_from(self._mapping)
+        if magic != MAGIC:
+            raise SnapshotError(f"{path} is not a snapshot")
+        header = json.loads(self._mapping[_PREFIX.size:_PREFIX.size + header_length])
+        if header["format"] != FORMAT or header["day_bits"] != DAY_BITS:
+            raise SnapshotError(f"{path} has format {header['format']}, expected {FORMAT}")
+
+        start = _aligned(_PREFIX.size + header_length)
+        self.path = path
+        self.prices_version = header["prices_version"]
+        self.epoch = header["epoch"]
+        self.columns = {
+            name: np.frombuffer(self._mapping, dtype=column["dtype"], count=column["length"],
+                                offset=start + column["offset"])
+            for name, column in header["columns"].items()
+        }
+
+    def attach(self, engine):
+        """Makes `engine` answer from the mapped columns."""
+        codes = np.array(_strings(self.columns["codes"]), dtype=object)
+        engine.assign(codes, self.epoch, self.prices_version,
+                      **{name: self.columns[name] for name in PriceEngine.COLUMNS})
+
+    def tree(self):
+        """
+        :return: tuple[List[dict], List[dict]]
+            The regions and ports rows, as `RegionIndex.load` takes them.
+        """
+        regions = [
+            {"slug": slug, "parent_slug": parent}
+            for slug, parent in zip(_strings(self.columns["region_slugs"]), _strings(self.columns["region_parents"]))
+        ]
+        ports = [
+            {"code": code, "parent_slug": parent}
+            for code, parent in zip(_strings(self.columns["port_codes"]), _strings(self.columns["port_parents"]))
+        ]
+        return regions, ports
+
+
+def open_snapshot(path):
+    """
+    :param path: str
+    :return: Snapshot, or None if there is no (readable) snapshot at `path`.
+    """
+    try:
+        return Snapshot(path)
+    # SnapshotError, an empty file or a truncated header alike
+    except (FileNotFoundError, ValueError, KeyError):
+        return None
+
+
+@contextmanager
+def _build_lock(path):
+    """Helper private function to let one process of the host at a time (re)build the snapshot."""
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+async def load(conn, engine, path=RATES_SNAPSHOT_PATH):
+    """
+    Brings `engine` to the current prices version: the snapshot at `path` is mapped if it
+    holds that version, else one process builds it from the db and writes it while the
+    others of the host wait for it, then map it too.
+    :param conn: asyncpg.Connection object
+    :param engine: PriceEngine
+    :param path: str, or None to only load `engine` from the db.
+    :return: Snapshot attached to `engine`, or None if it was loaded from the db only.
+    """
+    await stats_state.is_fresh(conn)
+    version = stats_state.prices_version
+    # without version stamps a file could not be told current from outdated
+    if path is None or version is None:
+        await engine.refresh(conn)
+        return None
+
+    snapshot = open_snapshot(path)
+    if snapshot is None or snapshot.prices_version != version:
+        loop = asyncio.get_running_loop()
+        lock = _build_lock(path)
+        # waiting for another process' build must not block the event loop
+        await loop.run_in_executor(None, lock.__enter__)
+        try:
+            snapshot = open_snapshot(path)
+            if snapshot is None or snapshot.prices_version != version:
+                # built in a thread, the loop keeps answering from the former arrays meanwhile
+                await engine.refresh(conn)
+                regions = [dict(row) for row in await conn.fetch(REGIONS_QUERY)]
+                ports = [dict(row) for row in await conn.fetch(PORTS_QUERY)]
+                await loop.run_in_executor(None, write, path, engine, regions, ports)
+                snapshot = Snapshot(path)
+        finally:
+            lock.__exit__(None, None, None)
+
+    # the heap copy a build made is dropped for the shared pages
+    snapshot.attach(engine)
+    return snapshot
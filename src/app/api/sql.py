@@ -3,39 +3,410 @@
 """
 Please note that queries are not broken down into smaller strings
 to promote readability over a smaller file. This may result in few extra lines.
+
+Every statement below is a constant text with positional parameters, so
+asyncpg prepares it once per connection and serves every later call from its
+statement cache (see `statement_cache_size` of `asyncpg.connect`), and
+Postgres can reuse the plan instead of re-parsing a new text per request.
+
+Every statement returns one row per day of [date_from, date_to] in order
+(days without prices have `days` = 0), generated by `generate_series`.
+`BUCKETED` holds each of them wrapped to return one row per week, month or N days instead.
+"""
+from datetime import date
+
+from .. import metrics
+from ..validate.granularity import bucket_of
+from .regions import region_index
+from .stats import stats_state
+
+
+RATES_BOTH_PORTS = """
+    SELECT COALESCE(daily.days, 0) AS days,
+           daily.average_price,
+           series.day::date AS day
+        FROM generate_series($3::date, $4::date, interval '1 day') AS series(day)
+        LEFT JOIN
+            (SELECT COUNT(*) AS days,
+                    AVG(price) AS average_price,
+                    day
+                FROM Prices
+                WHERE orig_code = $1::text AND
+                      dest_code = $2::text AND
+                      (day BETWEEN $3::date AND $4::date)
+                GROUP BY day) AS daily
+            ON daily.day = series.day::date
+        ORDER BY series.day
+"""
+
+RATES_ORIGIN_REGION = """
+    SELECT COALESCE(daily.days, 0) AS days,
+           daily.average_price,
+           series.day::date AS day
+        FROM generate_series($3::date, $4::date, interval '1 day') AS series(day)
+        LEFT JOIN
+            (SELECT COUNT(*) AS days,
+                    AVG(price) AS average_price,
+                    day
+                FROM Prices
+                WHERE
+                    orig_code = ANY($1::text[]) AND
+                    dest_code = $2::text AND
+                    (day BETWEEN $3::date AND $4::date)
+                GROUP BY day) AS daily
+            ON daily.day = series.day::date
+        ORDER BY series.day
+"""
+
+RATES_DESTINATION_REGION = """
+    SELECT COALESCE(daily.days, 0) AS days,
+           daily.average_price,
+           series.day::date AS day
+        FROM generate_series($3::date, $4::date, interval '1 day') AS series(day)
+        LEFT JOIN
+            (SELECT COUNT(*) AS days,
+                    AVG(price) AS average_price,
+                    day
+                FROM Prices
+                WHERE
+                    orig_code = $1::text AND
+                    dest_code = ANY($2::text[]) AND
+                    (day BETWEEN $3::date AND $4::date)
+                GROUP BY day) AS daily
+            ON daily.day = series.day::date
+        ORDER BY series.day
 """
 
+RATES_BOTH_REGION = """
+    SELECT COALESCE(daily.days, 0) AS days,
+           daily.average_price,
+           series.day::date AS day
+        FROM generate_series($3::date, $4::date, interval '1 day') AS series(day)
+        LEFT JOIN
+            (SELECT COUNT(*) AS days,
+                    AVG(price) AS average_price,
+                    day
+                FROM Prices
+                WHERE
+                    orig_code = ANY($1::text[]) AND
+                    dest_code = ANY($2::text[]) AND
+                    (day BETWEEN $3::date AND $4::date)
+                GROUP BY day) AS daily
+            ON daily.day = series.day::date
+        ORDER BY series.day
+"""
 
-async def _execute_get_slug_from_parent(
+# Used while the region index is not loaded: the hierarchy is walked by the
+# db itself, so the request still costs a single round-trip.
+RATES_BOTH_REGION_RECURSIVE = """
+    WITH RECURSIVE
+        origin_regions(slug) AS (
+            SELECT $1::text
+            UNION
+            SELECT Regions.slug
+                FROM Regions
+                JOIN origin_regions ON Regions.parent_slug = origin_regions.slug
+        ),
+        destination_regions(slug) AS (
+            SELECT $2::text
+            UNION
+            SELECT Regions.slug
+                FROM Regions
+                JOIN destination_regions ON Regions.parent_slug = destination_regions.slug
+        ),
+        daily AS (
+            SELECT COUNT(*) AS days,
+                   AVG(Prices.price) AS average_price,
+                   Prices.day
+                FROM Prices
+                JOIN Ports AS orig ON orig.code = Prices.orig_code
+                JOIN Ports AS dest ON dest.code = Prices.dest_code
+                WHERE
+                    orig.parent_slug IN (SELECT slug FROM origin_regions) AND
+                    dest.parent_slug IN (SELECT slug FROM destination_regions) AND
+                    (Prices.day BETWEEN $3::date AND $4::date)
+                GROUP BY Prices.day
+        )
+    SELECT COALESCE(daily.days, 0) AS days,
+           daily.average_price,
+           series.day::date AS day
+        FROM generate_series($3::date, $4::date, interval '1 day') AS series(day)
+        LEFT JOIN daily ON daily.day = series.day::date
+        ORDER BY series.day
+"""
+
+# Same shapes as above, read from the pre-aggregated `lane_daily_stats` and
+# `region_daily_stats` (migration 0004) while they reflect the current prices.
+STATS_BOTH_PORTS = """
+    SELECT COALESCE(stats.price_count, 0) AS days,
+           stats.price_sum::numeric / stats.price_count AS average_price,
+           series.day::date AS day
+        FROM generate_series($3::date, $4::date, interval '1 day') AS series(day)
+        LEFT JOIN lane_daily_stats AS stats
+            ON stats.orig_code = $1::text AND
+               stats.dest_code = $2::text AND
+               stats.day = series.day::date
+        ORDER BY series.day
+"""
+
+STATS_ORIGIN_REGION = """
+    SELECT COALESCE(daily.days, 0) AS days,
+           daily.average_price,
+           series.day::date AS day
+        FROM generate_series($3::date, $4::date, interval '1 day') AS series(day)
+        LEFT JOIN
+            (SELECT SUM(price_count) AS days,
+                    SUM(price_sum)::numeric / SUM(price_count) AS average_price,
+                    day
+                FROM lane_daily_stats
+                WHERE
+                    orig_code = ANY($1::text[]) AND
+                    dest_code = $2::text AND
+                    (day BETWEEN $3::date AND $4::date)
+                GROUP BY day) AS daily
+            ON daily.day = series.day::date
+        ORDER BY series.day
+"""
+
+STATS_DESTINATION_REGION = """
+    SELECT COALESCE(daily.days, 0) AS days,
+           daily.average_price,
+           series.day::date AS day
+        FROM generate_series($3::date, $4::date, interval '1 day') AS series(day)
+        LEFT JOIN
+            (SELECT SUM(price_count) AS days,
+                    SUM(price_sum)::numeric / SUM(price_count) AS average_price,
+                    day
+                FROM lane_daily_stats
+                WHERE
+                    orig_code = $1::text AND
+                    dest_code = ANY($2::text[]) AND
+                    (day BETWEEN $3::date AND $4::date)
+                GROUP BY day) AS daily
+            ON daily.day = series.day::date
+        ORDER BY series.day
+"""
+
+STATS_BOTH_REGION = """
+    SELECT COALESCE(stats.price_count, 0) AS days,
+           stats.price_sum::numeric / stats.price_count AS average_price,
+           series.day::date AS day
+        FROM generate_series($3::date, $4::date, interval '1 day') AS series(day)
+        LEFT JOIN region_daily_stats AS stats
+            ON stats.orig_slug = $1::text AND
+               stats.dest_slug = $2::text AND
+               stats.day = series.day::date
+        ORDER BY series.day
+"""
+
+# Groups the daily rows of one of the statements above by bucket: $5 is the unit
+# ('week', 'month' or 'days') and $6 the days per bucket of 'days'. A bucket is
+# labeled by its first day in the range, its average weighted by the prices of each day.
+BUCKET_DAILY_ROWS = """
+    SELECT SUM(daily.days)::bigint AS days,
+           SUM(daily.days * daily.average_price) / NULLIF(SUM(daily.days), 0) AS average_price,
+           GREATEST(
+               CASE $5::text
+                   WHEN 'week' THEN date_trunc('week', daily.day::timestamp)::date
+                   WHEN 'month' THEN date_trunc('month', daily.day::timestamp)::date
+                   ELSE $3::date + (daily.day - $3::date) / $6::int * $6::int
+               END,
+               $3::date
+           ) AS day
+        FROM (%s) AS daily
+        GROUP BY 3
+        ORDER BY 3
+"""
+
+BUCKETED = {
+    query: BUCKET_DAILY_ROWS % query
+    for query in (
+        RATES_BOTH_PORTS,
+        RATES_ORIGIN_REGION,
+        RATES_DESTINATION_REGION,
+        RATES_BOTH_REGION,
+        RATES_BOTH_REGION_RECURSIVE,
+        STATS_BOTH_PORTS,
+        STATS_ORIGIN_REGION,
+        STATS_DESTINATION_REGION,
+        STATS_BOTH_REGION,
+    )
+}
+
+# Every lane of a region-by-region matrix in one round-trip: the rows of the
+# lanes (and days) having prices, the dense matrix is laid out by `result.to_matrix`.
+MATRIX_RATES = """
+    SELECT orig_code, dest_code, day, COUNT(*) AS price_count, SUM(price) AS price_sum
+        FROM Prices
+        WHERE
+            orig_code = ANY($1::text[]) AND
+            dest_code = ANY($2::text[]) AND
+            (day BETWEEN $3::date AND $4::date)
+        GROUP BY orig_code, dest_code, day
+"""
+
+MATRIX_RATES_COLLAPSED = """
+    SELECT orig_code, dest_code, COUNT(*) AS price_count, SUM(price) AS price_sum
+        FROM Prices
+        WHERE
+            orig_code = ANY($1::text[]) AND
+            dest_code = ANY($2::text[]) AND
+            (day BETWEEN $3::date AND $4::date)
+        GROUP BY orig_code, dest_code
+"""
+
+MATRIX_STATS = """
+    SELECT orig_code, dest_code, day, price_count, price_sum
+        FROM lane_daily_stats
+        WHERE
+            orig_code = ANY($1::text[]) AND
+            dest_code = ANY($2::text[]) AND
+            (day BETWEEN $3::date AND $4::date)
+"""
+
+MATRIX_STATS_COLLAPSED = """
+    SELECT orig_code, dest_code, SUM(price_count) AS price_count, SUM(price_sum) AS price_sum
+        FROM lane_daily_stats
+        WHERE
+            orig_code = ANY($1::text[]) AND
+            dest_code = ANY($2::text[]) AND
+            (day BETWEEN $3::date AND $4::date)
+        GROUP BY orig_code, dest_code
+"""
+
+
+async def _execute_get_ports_of_region(
         conn,
-        parent_slug
+        slug
 ):
     """
-    Helper function that is called to get regions that has this `parent_slug`.
+    Helper function that is called to get codes of all ports below region `slug`.
+    Answered by the in-process `region_index`, which covers sub-regions at any depth
+    and ports directly associated to a main region; the db is only queried
+    when the index has to be (re)loaded.
     :param conn: asyncpg.Connection Object
-    :param parent_slug: str
+    :param slug: str
     :return: List[str]
-        result of the query in form of a list.
-    """
-    data = await conn.fetch(
-        f"""
-        SELECT slug
-            FROM Regions
-            WHERE parent_slug='{parent_slug}'
-        """
+        codes of the ports, empty for an unknown slug.
+    """
+    with metrics.phase("region_lookup"):
+        return await region_index.resolve(conn, slug)
+
+
+async def _reads_stats(conn, from_stats):
+    """
+    Helper function to tell whether the stats are read: as the caller decided, else from `conn`.
+    Only the primary's stamps may set `stats_state`, the versions replicas are compared with.
+    """
+    if from_stats is not None:
+        return from_stats
+    return await stats_state.is_fresh(conn)
+
+
+def _bucketed(plan, granularity):
+    """Helper function to swap a daily plan for its bucketed statement, unless `granularity` is "day"."""
+    if granularity == "day":
+        return plan
+    return (BUCKETED[plan[0]], *plan[1:], *bucket_of(granularity))
+
+
+async def _plan_when_both_ports(conn, origin, destination, date_from, date_to, from_stats=None):
+    """Helper function returning the statement and arguments run by `execute_when_both_ports`."""
+    query = STATS_BOTH_PORTS if await _reads_stats(conn, from_stats) else RATES_BOTH_PORTS
+
+    return (
+        query,
+        origin,
+        destination,
+        date.fromisoformat(date_from),
+        date.fromisoformat(date_to),
     )
 
-    # if above query fetches more than zero results then given region was main
-    if len(data) > 0:
-        data = [i['slug'] for i in data]
-    # else given region was a sub-region
-    else:
-        data = []
 
-    # also add the main region(if present) in list of sub-regions to search
-    # since some port are directly associated to the main region than sub-regions
-    data.append(parent_slug)
-    return '\', \''.join([d for d in data])
+async def _plan_when_one_region(conn, origin, destination, date_from, date_to, first_is_region, from_stats=None):
+    """Helper function returning the statement and arguments run by `execute_when_one_region`."""
+    region = origin if first_is_region else destination
+
+    data = await _execute_get_ports_of_region(conn, region)
+    from_stats = await _reads_stats(conn, from_stats)
+
+    # if `origin` contains region then match orig_code against its ports
+    if first_is_region:
+        return (
+            STATS_ORIGIN_REGION if from_stats else RATES_ORIGIN_REGION,
+            data,
+            destination,
+            date.fromisoformat(date_from),
+            date.fromisoformat(date_to),
+        )
+    # else, dest_code should be matched against them
+    return (
+        STATS_DESTINATION_REGION if from_stats else RATES_DESTINATION_REGION,
+        origin,
+        data,
+        date.fromisoformat(date_from),
+        date.fromisoformat(date_to),
+    )
+
+
+async def _plan_when_both_region(conn, origin, destination, date_from, date_to, from_stats=None):
+    """Helper function returning the statement and arguments run by `execute_when_both_region`."""
+    if await _reads_stats(conn, from_stats):
+        return (
+            STATS_BOTH_REGION,
+            origin,
+            destination,
+            date.fromisoformat(date_from),
+            date.fromisoformat(date_to),
+        )
+
+    if not region_index.is_loaded:
+        return (
+            RATES_BOTH_REGION_RECURSIVE,
+            origin,
+            destination,
+            date.fromisoformat(date_from),
+            date.fromisoformat(date_to),
+        )
+
+    data_origin = await _execute_get_ports_of_region(conn, origin)
+    data_dest = await _execute_get_ports_of_region(conn, destination)
+
+    return (
+        RATES_BOTH_REGION,
+        data_origin,
+        data_dest,
+        date.fromisoformat(date_from),
+        date.fromisoformat(date_to),
+    )
+
+
+async def plan_rates(conn, type_loc, origin, destination, date_from, date_to, granularity="day", from_stats=None):
+    """
+    The statement and arguments answering a query, without running it,
+    Eg: to run it through a server-side cursor instead of `fetch`.
+    :param conn: asyncpg.Connection object
+    :param type_loc: tuple[str] as returned by `location.validate`
+    :param origin: str
+    :param destination: str
+    :param date_from: str in format "YYYY-MM-DD"
+    :param date_to: str in format "YYYY-MM-DD"
+    :param granularity: str as returned by `granularity.validate`
+    :param from_stats: bool or None
+        Whether to read the pre-aggregated stats, as decided from the primary's version stamps;
+        None reads the stamps through `conn`, which must then be the primary (see `stats_state`).
+    :return: tuple
+        The statement followed by its arguments.
+    """
+    if type_loc[0] == type_loc[1] == "port":
+        plan = await _plan_when_both_ports(conn, origin, destination, date_from, date_to, from_stats)
+    elif type_loc[0] == type_loc[1] == "region":
+        plan = await _plan_when_both_region(conn, origin, destination, date_from, date_to, from_stats)
+    else:
+        first_is_region = True if type_loc[0] == "region" else False
+        plan = await _plan_when_one_region(conn, origin, destination, date_from, date_to, first_is_region,
+                                           from_stats)
+    return _bucketed(plan, granularity)
 
 
 async def execute_when_both_ports(
@@ -44,6 +415,8 @@ async def execute_when_both_ports(
         destination,
         date_from,
         date_to,
+        granularity="day",
+        from_stats=None,
 ):
     """
     The function that is called when `origin` and `destination` are determined to be ports by validators.
@@ -53,20 +426,15 @@ async def execute_when_both_ports(
     :param destination: str
     :param date_from: str in format "YYYY-MM-DD"
     :param date_to: str in format "YYYY-MM-DD"
+    :param granularity: str as returned by `granularity.validate`
+        Anything but "day" returns one row per bucket instead (see `BUCKET_DAILY_ROWS`).
+    :param from_stats: bool or None
+        Whether to read the pre-aggregated stats, as decided from the primary's version stamps;
+        None reads the stamps through `conn`, which must then be the primary (see `stats_state`).
     :return: List[asyncpg.Record]
     """
-
     return await conn.fetch(
-        f"""
-        SELECT COUNT(*) AS days, 
-               AVG(price) AS average_price,
-               day
-            FROM Prices
-            WHERE orig_code='{origin}' AND
-                  dest_code='{destination}' AND
-                  (day BETWEEN '{date_from}' AND '{date_to}')
-            GROUP BY day;
-        """
+        *_bucketed(await _plan_when_both_ports(conn, origin, destination, date_from, date_to, from_stats), granularity)
     )
 
 
@@ -77,11 +445,12 @@ async def execute_when_one_region(
         date_from,
         date_to,
         first_is_region,
+        granularity="day",
+        from_stats=None,
 ):
     """
     The function that is called when either `origin` or `destination` is region (but not both).
-    A slightly more complicated querying is required since it not only requires two queries,
-    but also sub-querying in the second query.
+    The region is first expanded to its port codes, which are then matched as an array.
     :param conn: asyncpg.Connection object
     :param origin: str
     :param destination: str
@@ -90,51 +459,20 @@ async def execute_when_one_region(
     :param first_is_region: bool
         If True, then signifies that `origin` is determined to be region as per validators.
         Else, `destination` is region.
+    :param granularity: str as returned by `granularity.validate`
+        Anything but "day" returns one row per bucket instead (see `BUCKET_DAILY_ROWS`).
+    :param from_stats: bool or None
+        Whether to read the pre-aggregated stats, as decided from the primary's version stamps;
+        None reads the stamps through `conn`, which must then be the primary (see `stats_state`).
     :return: List[asyncpg.Record]
     """
-    region = origin if first_is_region else destination
-
-    data = await _execute_get_slug_from_parent(conn, region)
-
-    # if `origin` contains region then subquery for orig_code
-    if first_is_region:
-        data = await conn.fetch(
-            f"""
-            SELECT COUNT(*) AS days,
-                   AVG(price) AS average_price,
-                   day
-                FROM Prices
-                WHERE
-                    orig_code IN 
-                        (SELECT code
-                            FROM Ports
-                            WHERE parent_slug IN ('{data}')) AND
-                    dest_code='{destination}' AND
-                    (day BETWEEN '{date_from}' AND '{date_to}')
-                GROUP BY day
-                ORDER BY day
-            """
-        )
-    # else, dest_code should contain the subquery
-    else:
-        data = await conn.fetch(
-            f"""
-                    SELECT COUNT(*) AS days,
-                           AVG(price) AS average_price,
-                           day
-                        FROM Prices
-                        WHERE
-                            orig_code='{origin}'AND
-                            dest_code IN 
-                                (SELECT code
-                                    FROM Ports
-                                    WHERE parent_slug IN ('{data}')) AND
-                            (day BETWEEN '{date_from}' AND '{date_to}')
-                        GROUP BY day
-                        ORDER BY day
-            """
+    return await conn.fetch(
+        *_bucketed(
+            await _plan_when_one_region(conn, origin, destination, date_from, date_to, first_is_region,
+                                        from_stats),
+            granularity,
         )
-    return data
+    )
 
 
 async def execute_when_both_region(
@@ -143,39 +481,82 @@ async def execute_when_both_region(
         destination,
         date_from,
         date_to,
+        granularity="day",
+        from_stats=None,
 ):
     """
     Function that is called when both `origin` and `destination` are determined to be regions
     by the validators.
-    Although it requires more querying, it is similar to above function in how it is written and smaller
-    by virtue of it being non-conditional (both origin and destination are region so requires no condition).
+    It is similar to above function in how it is written and smaller by virtue of it
+    being non-conditional (both origin and destination are region so requires no condition).
+    With fresh stats, the region-level rollup is read directly by slug. Otherwise, if the
+    region index is not loaded, the hierarchy is resolved inside the statement
+    instead of reloading the index first, keeping it to a single round-trip.
     :param conn: asyncpg.Connection object
     :param origin: str
     :param destination: str
     :param date_from: str in format "YYYY-MM-DD"
     :param date_to: str in format "YYYY-MM-DD"
+    :param granularity: str as returned by `granularity.validate`
+        Anything but "day" returns one row per bucket instead (see `BUCKET_DAILY_ROWS`).
+    :param from_stats: bool or None
+        Whether to read the pre-aggregated stats, as decided from the primary's version stamps;
+        None reads the stamps through `conn`, which must then be the primary (see `stats_state`).
     :return: List[asyncpg.Record]
     """
-    data_origin = await _execute_get_slug_from_parent(conn, origin)
-    data_dest = await _execute_get_slug_from_parent(conn, destination)
+    return await conn.fetch(
+        *_bucketed(await _plan_when_both_region(conn, origin, destination, date_from, date_to, from_stats), granularity)
+    )
+
 
+async def ports_of(conn, location, is_region):
+    """
+    The port codes a location stands for, Eg: for one axis of a matrix.
+    :param conn: asyncpg.Connection object
+    :param location: str, a region slug or a port code
+    :param is_region: bool, as determined by the validators
+    :return: List[str]
+        every port below a region, sorted, or the port itself.
+    """
+    if is_region:
+        return await _execute_get_ports_of_region(conn, location)
+    return [location]
+
+
+async def execute_matrix(
+        conn,
+        orig_codes,
+        dest_codes,
+        date_from,
+        date_to,
+        collapse=False,
+        from_stats=None,
+):
+    """
+    Function that is called for `/rates/matrix`: the price count and sum of every lane
+    from one of `orig_codes` to one of `dest_codes`, per day, in a single statement.
+    :param conn: asyncpg.Connection object
+    :param orig_codes: List[str] as returned by `ports_of`
+    :param dest_codes: List[str] as returned by `ports_of`
+    :param date_from: str in format "YYYY-MM-DD"
+    :param date_to: str in format "YYYY-MM-DD"
+    :param collapse: bool
+        If True, one row per lane over the whole range instead of one per lane and day.
+    :param from_stats: bool or None
+        Whether to read the pre-aggregated stats, as decided from the primary's version stamps;
+        None reads the stamps through `conn`, which must then be the primary (see `stats_state`).
+    :return: List[asyncpg.Record]
+        Rows with keys "orig_code", "dest_code", ("day",) "price_count" and "price_sum",
+        only for the lanes (and days) having prices.
+    """
+    if await _reads_stats(conn, from_stats):
+        query = MATRIX_STATS_COLLAPSED if collapse else MATRIX_STATS
+    else:
+        query = MATRIX_RATES_COLLAPSED if collapse else MATRIX_RATES
     return await conn.fetch(
-        f"""
-        SELECT COUNT(*) AS days,
-               AVG(price) AS average_price,
-               day
-            FROM Prices
-            WHERE
-                orig_code IN
-                    (SELECT code
-                        FROM Ports
-                        WHERE parent_slug IN ('{data_origin}')) AND
-                dest_code IN
-                    (SELECT code
-                        FROM Ports
-                        WHERE parent_slug IN ('{data_dest}')) AND
-                (day BETWEEN '{date_from}' AND '{date_to}')
-            GROUP BY day
-            ORDER BY day
-        """
+        query,
+        orig_codes,
+        dest_codes,
+        date.fromisoformat(date_from),
+        date.fromisoformat(date_to),
     )
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""Refresh and freshness of the pre-aggregated daily statistics (see migration 0004)."""
+import asyncio
+import os
+import sys
+import time
+
+import asyncpg
+
+
+LOCK_META = """
+    SELECT prices_version, stats_version
+        FROM rates_meta
+        FOR UPDATE
+"""
+
+READ_META = """
+    SELECT prices_version, stats_version
+        FROM rates_meta
+"""
+
+MARK_FRESH = """
+    UPDATE rates_meta SET stats_version = $1::bigint
+"""
+
+REBUILD_LANE_STATS = """
+    TRUNCATE lane_daily_stats;
+    INSERT INTO lane_daily_stats (orig_code, dest_code, day, price_count, price_sum)
+        SELECT orig_code, dest_code, day, COUNT(*), SUM(price)
+            FROM prices
+            GROUP BY orig_code, dest_code, day;
+"""
+
+REBUILD_REGION_STATS = """
+    TRUNCATE region_daily_stats;
+    INSERT INTO region_daily_stats (orig_slug, dest_slug, day, price_count, price_sum)
+        SELECT orig.slug, dest.slug, stats.day, SUM(stats.price_count), SUM(stats.price_sum)
+            FROM lane_daily_stats AS stats
+            JOIN region_ports AS orig ON orig.code = stats.orig_code
+            JOIN region_ports AS dest ON dest.code = stats.dest_code
+            GROUP BY orig.slug, dest.slug, stats.day;
+"""
+
+# incremental path: only the (lane, day) keys touched by new price rows
+DELETE_LANE_KEYS = """
+    DELETE FROM lane_daily_stats AS stats
+        USING unnest($1::text[], $2::text[], $3::date[]) AS keys(orig_code, dest_code, day)
+        WHERE stats.orig_code = keys.orig_code AND
+              stats.dest_code = keys.dest_code AND
+              stats.day = keys.day
+"""
+
+INSERT_LANE_KEYS = """
+    INSERT INTO lane_daily_stats (orig_code, dest_code, day, price_count, price_sum)
+        SELECT prices.orig_code, prices.dest_code, prices.day, COUNT(*), SUM(prices.price)
+            FROM prices
+            JOIN (SELECT DISTINCT *
+                      FROM unnest($1::text[], $2::text[], $3::date[])
+                      AS keys(orig_code, dest_code, day)) AS keys
+                ON prices.orig_code = keys.orig_code AND
+                   prices.dest_code = keys.dest_code AND
+                   prices.day = keys.day
+            GROUP BY prices.orig_code, prices.dest_code, prices.day
+"""
+
+DELETE_REGION_DAYS = """
+    DELETE FROM region_daily_stats
+        WHERE day = ANY($1::date[])
+"""
+
+INSERT_REGION_DAYS = """
+    INSERT INTO region_daily_stats (orig_slug, dest_slug, day, price_count, price_sum)
+        SELECT orig.slug, dest.slug, stats.day, SUM(stats.price_count), SUM(stats.price_sum)
+            FROM lane_daily_stats AS stats
+            JOIN region_ports AS orig ON orig.code = stats.orig_code
+            JOIN region_ports AS dest ON dest.code = stats.dest_code
+            WHERE stats.day = ANY($1::date[])
+            GROUP BY orig.slug, dest.slug, stats.day
+"""
+
+
+async def refresh_stats(conn, keys=None, version=None):
+    """
+    Brings `lane_daily_stats`/`region_daily_stats` up to date with `prices`.
+    `rates_meta` is locked for the duration, so prices written meanwhile
+    wait and leave the stats stale again rather than being missed.
+    :param conn: asyncpg.Connection object
+    :param keys: None or Iterable[tuple[str, str, datetime.date]]
+        (orig_code, dest_code, day) touched by new price rows; only those lanes and
+        the region rollup of those days are recomputed. None rebuilds everything.
+    :param version: None or int
+        The prices version the statement writing `keys` stamped. The keys are only trusted
+        if it was the one write since the stats were fresh, else everything is rebuilt.
+    :return: int
+        The prices version the stats now reflect.
+    """
+    async with conn.transaction():
+        meta = await conn.fetchrow(LOCK_META)
+        if keys is not None and meta["stats_version"] == meta["prices_version"]:
+            # refreshed meanwhile, Eg: by a load that wrote after this one
+            return meta["prices_version"]
+        if keys is not None and (version is None or
+                                 not meta["prices_version"] == version == meta["stats_version"] + 1):
+            # another write landed since the stats were fresh, its lanes are unknown
+            keys = None
+        if keys is None:
+            await conn.execute(REBUILD_LANE_STATS)
+            await conn.execute(REBUILD_REGION_STATS)
+        else:
+            keys = set(keys)
+            origins, destinations, days = (list(column) for column in zip(*keys)) if keys else ([], [], [])
+            await conn.execute(DELETE_LANE_KEYS, origins, destinations, days)
+            await conn.execute(INSERT_LANE_KEYS, origins, destinations, days)
+            touched_days = sorted(set(days))
+            await conn.execute(DELETE_REGION_DAYS, touched_days)
+            await conn.execute(INSERT_REGION_DAYS, touched_days)
+        await conn.execute(MARK_FRESH, meta["prices_version"])
+    stats_state.invalidate()
+    return meta["prices_version"]
+
+
+class StatsState:
+    """
+    Remembers for `ttl` seconds whether the stats reflect the current prices,
+    so that requests do not pay a round-trip to `rates_meta` each.
+    """
+
+    def __init__(self, ttl=5.0):
+        """
+        :param ttl: float
+            Seconds a freshness answer is trusted before `rates_meta` is read again.
+        """
+        self.ttl = ttl
+        self.prices_version = None
+        self.fresh = False
+        self.checked_at = None
+
+    def invalidate(self):
+        """Forces the next check to read `rates_meta`."""
+        self.checked_at = None
+
+    async def check(self, conn):
+        """
+        Reads both version stamps.
+        :param conn: asyncpg.Connection object of the primary: the versions read here
+            are the ones replicas are compared with (see `ReplicaRouter.is_in_sync`).
+        """
+        try:
+            meta = await conn.fetchrow(READ_META)
+        except asyncpg.UndefinedTableError:
+            # migration 0004 not applied, serve from raw prices
+            meta = None
+        self.prices_version = meta["prices_version"] if meta else None
+        self.fresh = bool(meta) and meta["stats_version"] == meta["prices_version"]
+        self.checked_at = time.monotonic()
+
+    def is_current(self):
+        """Whether the last check is recent enough to be trusted without the db."""
+        return self.checked_at is not None and time.monotonic() - self.checked_at <= self.ttl
+
+    async def is_fresh(self, conn):
+        """
+        :param conn: asyncpg.Connection object of the primary, as for `check`
+        :return: bool
+            True if the rate queries may read the pre-aggregated stats.
+        """
+        if not self.is_current():
+            await self.check(conn)
+        return self.fresh
+
+
+stats_state = StatsState(ttl=float(os.getenv("STATS_FRESHNESS_TTL", "5")))
+
+
+async def _main():
+    conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+    try:
+        version = await refresh_stats(conn)
+        print(f"stats rebuilt at prices version {version}")
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] not in ([], ["refresh"]):
+        raise SystemExit("usage: python -m app.api.stats [refresh]")
+    asyncio.run(_main())
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""In-process caches of `/rates`: final results and per-day aggregates below them."""
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from datetime import date, timedelta
+
+
+# result of an in-flight computation whose caller was cancelled, its waiters compute again
+_LEADER_CANCELLED = object()
+
+
+class ResponseCache:
+    """
+    Bounded mapping from a normalized query to its final result.
+
+    Entries expire `ttl` seconds after being computed and the least recently
+    used one is evicted once `maxsize` is reached. Concurrent misses on the same
+    key are coalesced: the first caller computes, the others await its result.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60.0):
+        """
+        :param maxsize: int
+            Maximum number of entries kept (0 disables caching, coalescing still applies).
+        :param ttl: float
+            Seconds an entry stays valid.
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        :param key: Hashable
+        :return: the cached value, or None on a miss/expired entry.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """Stores `value`, evicting the least recently used entries beyond `maxsize`."""
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_compute(self, key, compute):
+        """
+        Returns the cached value for `key`, or computes it once for all concurrent callers.
+        :param key: Hashable
+        :param compute: Callable[[], Awaitable]
+            Called on a miss; its exception is raised to every coalesced caller
+            and nothing is cached. If the computing caller is cancelled, one of
+            the waiting ones computes instead.
+        """
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        inflight = self._inflight.get(key)
+        while inflight is not None:
+            self.coalesced += 1
+            value = await asyncio.shield(inflight)
+            if value is not _LEADER_CANCELLED:
+                return value
+            # the first waiter to resume computes, the others wait for it
+            self.coalesced -= 1
+            inflight = self._inflight.get(key)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await compute()
+        except asyncio.CancelledError:
+            # the caller left (Eg: its client disconnected), not a failure of `compute`
+            future.set_result(_LEADER_CANCELLED)
+            raise
+        except Exception as error:
+            future.set_exception(error)
+            raise
+        else:
+            self.put(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            del self._inflight[key]
+            # mark the exception as retrieved even if nobody was waiting on it
+            if future.done() and not future.cancelled():
+                future.exception()
+
+    def invalidate(self):
+        """Drops every entry, Eg: after new prices were loaded."""
+        self._entries.clear()
+
+    def stats(self):
+        """
+        :return: dict
+            Size and hit/miss counters since startup.
+        """
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_ratio": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+        }
+
+
+class DayCache:
+    """
+    Per-lane, per-day aggregate rows (`days`, `average_price`, `day`) as returned
+    by the queries, so that overlapping date windows only fetch the days they miss.
+
+    Lanes are evicted least recently used first once `max_lanes` lanes or `max_days`
+    days over all lanes are held (a lane's days grow with the ranges asked for it),
+    and every day expires `ttl` seconds after it was fetched.
+    """
+
+    # beyond this many separate gaps, one query spanning all of them is cheaper
+    MAX_RUNS = 3
+
+    def __init__(self, max_lanes=4096, ttl=300.0, max_days=500000):
+        """
+        :param max_lanes: int
+            Maximum number of (origin, destination) lanes kept.
+        :param ttl: float
+            Seconds a cached day stays valid.
+        :param max_days: int
+            Maximum number of days kept over all lanes.
+        """
+        self.max_lanes = max_lanes
+        self.max_days = max_days
+        self.ttl = ttl
+        self._lanes = OrderedDict()
+        self._day_count = 0
+
+        self.day_hits = 0
+        self.day_misses = 0
+
+    def _fresh_days(self, lane):
+        """Helper private function to get the unexpired days of `lane`, or an empty dict."""
+        days = self._lanes.get(lane)
+        if days is None:
+            return {}
+        self._lanes.move_to_end(lane)
+        now = time.monotonic()
+        for day in [day for day, (expires_at, _) in days.items() if now >= expires_at]:
+            del days[day]
+            self._day_count -= 1
+        return days
+
+    def missing_runs(self, lane, start, end):
+        """
+        Ranges of [`start`, `end`] not held for `lane`.
+        :param lane: tuple[str, str] (origin, destination)
+        :param start: datetime.date
+        :param end: datetime.date
+        :return: List[tuple[datetime.date, datetime.date]]
+            Inclusive ranges in order, at most `MAX_RUNS` of them.
+        """
+        days = self._fresh_days(lane)
+        runs = []
+        current = start
+        while current <= end:
+            if current in days:
+                self.day_hits += 1
+            else:
+                self.day_misses += 1
+                if runs and runs[-1][1] == current - timedelta(1):
+                    runs[-1] = (runs[-1][0], current)
+                else:
+                    runs.append((current, current))
+            current += timedelta(1)
+
+        if len(runs) > self.MAX_RUNS:
+            runs = [(runs[0][0], runs[-1][1])]
+        return runs
+
+    def store(self, lane, rows):
+        """
+        Remembers fetched rows, which must cover every day of the fetched range
+        (days without prices included), as the queries in `app/api/sql.py` do.
+        :param lane: tuple[str, str] (origin, destination)
+        :param rows: Iterable of rows with keys "days", "average_price" and "day"
+        """
+        if self.max_lanes <= 0 or self.max_days <= 0:
+            return
+        days = self._lanes.setdefault(lane, {})
+        self._lanes.move_to_end(lane)
+        expires_at = time.monotonic() + self.ttl
+        held = len(days)
+        for row in rows:
+            days[row["day"]] = (expires_at, {
+                "days": row["days"],
+                "average_price": row["average_price"],
+                "day": row["day"],
+            })
+        self._day_count += len(days) - held
+        if len(days) > self.max_days:
+            # would push every other lane out, it is not kept instead
+            del self._lanes[lane]
+            self._day_count -= len(days)
+        while self._lanes and (len(self._lanes) > self.max_lanes or self._day_count > self.max_days):
+            _, evicted = self._lanes.popitem(last=False)
+            self._day_count -= len(evicted)
+
+    def rows(self, lane, start, end):
+        """
+        Cached rows of [`start`, `end`] in order; days not held are left out.
+        :return: List[dict]
+        """
+        days = self._lanes.get(lane, {})
+        rows = []
+        current = start
+        while current <= end:
+            entry = days.get(current)
+            if entry is not None:
+                rows.append(entry[1])
+            current += timedelta(1)
+        return rows
+
+    async def get_or_fetch(self, lane, date_from, date_to, fetch):
+        """
+        Rows of every day in [`date_from`, `date_to`], fetching only the missing ranges.
+        :param lane: tuple[str, str] (origin, destination)
+        :param date_from: str in format "YYYY-MM-DD"
+        :param date_to: str in format "YYYY-MM-DD"
+        :param fetch: Callable[[str, str], Awaitable[List]]
+            Queries one inclusive range, dates in format "YYYY-MM-DD".
+        :return: List[dict|asyncpg.Record] ordered by day
+        """
+        start = date.fromisoformat(date_from)
+        end = date.fromisoformat(date_to)
+
+        fetched = []
+        for run_from, run_to in self.missing_runs(lane, start, end):
+            fetched.extend(await fetch(run_from.isoformat(), run_to.isoformat()))
+        self.store(lane, fetched)
+
+        by_day = {row["day"]: row for row in self.rows(lane, start, end)}
+        by_day.update((row["day"], row) for row in fetched)
+        return [by_day[day] for day in sorted(by_day) if start <= day <= end]
+
+    def invalidate(self):
+        """Drops every lane, Eg: after new prices were loaded."""
+        self._lanes.clear()
+        self._day_count = 0
+
+    def stats(self):
+        """
+        :return: dict
+            Size and per-day hit/miss counters since startup.
+        """
+        lookups = self.day_hits + self.day_misses
+        return {
+            "lanes": len(self._lanes),
+            "days": self._day_count,
+            "max_days": self.max_days,
+            "day_hits": self.day_hits,
+            "day_misses": self.day_misses,
+            "day_hit_ratio": self.day_hits / lookups if lookups else 0.0,
+        }
+
+
+rates_cache = ResponseCache(
+    maxsize=int(os.getenv("RATES_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("RATES_CACHE_TTL", "60")),
+)
+
+day_cache = DayCache(
+    max_lanes=int(os.getenv("DAY_CACHE_LANES", "4096")),
+    ttl=float(os.getenv("DAY_CACHE_TTL", "300")),
+    max_days=int(os.getenv("DAY_CACHE_DAYS", "500000")),
+)
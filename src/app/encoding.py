@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""HTTP content negotiation (media type, content-coding) and validators (ETag) of encoded `/rates` bodies."""
+import gzip
+import hashlib
+import os
+
+try:
+    import brotli
+except ImportError:  # optional, only gzip is offered without it
+    brotli = None
+
+
+# bodies smaller than this are not worth the compression cost
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+# seconds shared caches (CDN) may serve a `/rates` answer without revalidating
+RATES_MAX_AGE = int(os.getenv("RATES_MAX_AGE", "300"))
+
+
+def negotiate_encoding(accept_encoding):
+    """
+    Picks the content-coding to use from an `Accept-Encoding` header.
+    :param accept_encoding: str or None
+    :return: str or None
+        "br" (when brotli is installed) or "gzip", None to send the body as is.
+    """
+    offered = set()
+    for token in (accept_encoding or "").split(","):
+        name, _, params = token.strip().partition(";")
+        params = params.replace(" ", "")
+        try:
+            quality = float(params[2:]) if params.startswith("q=") else 1.0
+        except ValueError:
+            quality = 1.0
+        if quality > 0:
+            offered.add(name.strip().lower())
+
+    if brotli is not None and ("br" in offered or "*" in offered):
+        return "br"
+    if "gzip" in offered or "*" in offered:
+        return "gzip"
+    return None
+
+
+def _quality(params):
+    """Helper private function to read the `q` parameter of a header token, 1 without one."""
+    for param in params.split(";"):
+        name, _, value = param.strip().partition("=")
+        if name.strip().lower() == "q":
+            try:
+                return float(value)
+            except ValueError:
+                return 1.0
+    return 1.0
+
+
+def negotiate_media_type(accept, offered):
+    """
+    Picks the representation to send from an `Accept` header, by quality then by the
+    order of the header; a type is matched by its most specific media range
+    (`text/csv` before `text/*` before `*/*`) and one at `q=0` is never sent.
+    :param accept: str or None
+    :param offered: tuple[str] media types the endpoint can send, the first one by default
+    :return: str, one of `offered`
+    """
+    ranges = []
+    for position, token in enumerate((accept or "").split(",")):
+        media_range, _, params = token.strip().partition(";")
+        media_range = media_range.strip().lower()
+        if media_range:
+            ranges.append((media_range, _quality(params), position))
+    if not ranges:
+        return offered[0]
+
+    best, best_key = offered[0], None
+    for media_type in offered:
+        kind = media_type.split("/")[0] + "/*"
+        matches = [
+            (specificity, quality, position)
+            for media_range, quality, position in ranges
+            for specificity, candidate in ((2, media_type), (1, kind), (0, "*/*"))
+            if media_range == candidate
+        ]
+        if not matches:
+            continue
+        _, quality, position = max(matches)
+        # earlier offered types win ties, `max` keeps the first one
+        if quality > 0 and (best_key is None or (quality, -position) > best_key):
+            best, best_key = media_type, (quality, -position)
+    return best
+
+
+def compress(body, encoding):
+    """
+    :param body: bytes
+    :param encoding: str, as returned by `negotiate_encoding`
+    :return: bytes
+    """
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+    return gzip.compress(body, compresslevel=6)
+
+
+def query_etag(version, *parts):
+    """
+    Strong validator of a query answer, known before running the query:
+    the same parts at the same data version always produce the same body.
+    :param version: int, data version of `prices` (see `rates_meta`)
+    :param parts: str, everything the body depends on (dates, locations, media type...)
+    :return: str quoted ETag
+    """
+    key = "|".join([str(version), *parts]).encode()
+    return f'"v{version}-{hashlib.blake2b(key, digest_size=12).hexdigest()}"'
+
+
+def content_etag(body):
+    """
+    Strong validator derived from the body itself, when no data version is known.
+    :param body: bytes
+    :return: str quoted ETag
+    """
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Weak comparison (as `If-None-Match` requires) of the header against `etag`,
+    ignoring the content-coding suffix added by `encoded_etag`.
+    :param if_none_match: str or None
+    :param etag: str quoted ETag
+    :return: bool
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        for suffix in ("-gzip", "-br"):
+            if candidate.endswith(f'{suffix}"'):
+                candidate = candidate[:-len(suffix) - 1] + '"'
+        if candidate == etag:
+            return True
+    return False
+
+
+def encoded_etag(etag, encoding):
+    """Distinct strong validator per content-coding, Eg: "abc" -> "abc-gzip"."""
+    return etag if encoding is None else f'{etag[:-1]}-{encoding}"'
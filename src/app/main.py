@@ -1,21 +1,57 @@
 # -*- coding: utf-8 -*-
 """Main file to encapsulate the functionality web app with the db."""
+import asyncio
+import json
+import logging
 import os
-import asyncpg
-from fastapi import FastAPI, HTTPException
+import time
+from contextlib import AsyncExitStack, contextmanager
+from typing import Union
 
+import numpy as np
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+from starlette.background import BackgroundTask
+from starlette.responses import PlainTextResponse, StreamingResponse
+
+from .api import snapshot
+from .api.engine import RATES_BACKEND, engine, rates_arrays
+from .api.ingest import (
+    MEDIA_TYPES as INGEST_MEDIA_TYPES,
+    IngestError,
+    ingest,
+    iter_lines,
+    read_records,
+)
 from .api.models import (
+    BatchSchema,
     PortSchema,
     RegionSchema,
     PriceSchema,
 )
+from .api.pool import (
+    ConnectionPool,
+    PoolTimeout,
+    settings_from_env,
+)
+from .api.regions import region_index
+from .api.replicas import router_from_env
+from .api.stats import stats_state
 from .api.sql import (
+    plan_rates,
+    ports_of,
+    execute_matrix,
     execute_when_one_region,
     execute_when_both_ports,
     execute_when_both_region,
 )
+from . import encoding, metrics
+from .admission import Overloaded, admission, is_expensive, statement_timeout
+from .cache import day_cache, rates_cache
+from .migrate import apply_migrations
+from .shared_cache import shared_cache
 from .validate import (
     date,
+    granularity as bucket,
     location,
     result,
 )
@@ -24,15 +60,47 @@ from .validate import (
 app = FastAPI()
 connect_dict = {}
 
+BATCH_MAX_LANES = int(os.getenv("BATCH_MAX_LANES", "1000"))
+# rows fetched per round-trip by the server-side cursor of streamed responses
+STREAM_PREFETCH = int(os.getenv("STREAM_PREFETCH", "1000"))
+# seconds a streamed response may hold its connection (and admission slot), slow readers included
+STREAM_TIMEOUT = float(os.getenv("STREAM_TIMEOUT", "60"))
+# largest `/rates/matrix` answer, in prices (origins x destinations x days)
+MATRIX_MAX_CELLS = int(os.getenv("MATRIX_MAX_CELLS", "2000000"))
+# seconds before a failed reload of the in-memory engine is tried again
+ENGINE_RELOAD_RETRY = float(os.getenv("ENGINE_RELOAD_RETRY", "30"))
+
+log = logging.getLogger("app.main")
+
 
 @app.on_event("startup")
 async def startup():
-    connect_dict['conn'] = await asyncpg.connect(os.getenv("DATABASE_URL"))
+    connect_dict['pool'] = await ConnectionPool(
+        os.getenv("DATABASE_URL"),
+        **settings_from_env(),
+    ).open()
+    # rate reads go to the replicas of `DATABASE_REPLICA_URLS` in sync, everything else to the primary
+    connect_dict['reads'] = await router_from_env(connect_dict['pool'], **settings_from_env()).open()
+    async with connect_dict['pool'].acquire() as conn:
+        if os.getenv("APPLY_MIGRATIONS", "0") == "1":
+            await apply_migrations(conn)
+        if RATES_BACKEND == "memory":
+            mapped = await snapshot.load(conn, engine)
+            # the tree comes with the prices, sparing each worker its query
+            if mapped is not None:
+                region_index.load(*mapped.tree())
+        if not region_index.is_loaded:
+            await region_index.refresh(conn)
 
 
 @app.on_event("shutdown")
 async def shutdown():
-    await connect_dict['conn'].close()
+    if 'reads' in connect_dict:
+        await connect_dict['reads'].close()
+    if 'pool' in connect_dict:
+        await connect_dict['pool'].close()
+    if shared_cache is not None:
+        shared_cache.close()
 
 
 @app.get("/rates")
@@ -41,6 +109,10 @@ async def rates(
         date_to: str,
         origin: str,
         destination: str,
+        granularity: str = "day",
+        accept: Union[str, None] = Header(default=None),
+        accept_encoding: Union[str, None] = Header(default=None),
+        if_none_match: Union[str, None] = Header(default=None),
 ):
     """
     The initial and main entrypoint. It requires no path parameters and four query
@@ -53,14 +125,166 @@ async def rates(
         The starting location, can either be a region(main/sub/middle) slug or a port code.
     :param destination: str
         The ending location, can either be a region(main/sub/middle) slug or a port code.
+    :param granularity: str, optional
+        "day" (the default), "week", "month" or "<N>d": prices are averaged over each
+        calendar week/month or run of N days instead, each bucket given by its first day.
     :return: List[dict]
         The keys of each element will be:
             day: (str) representing the day for which average price is calculated.
             average_price: (int|None) representing average price of that day from `origin` to `destination`.
+        With `Accept: application/x-ndjson` or `Accept: text/csv`, the same days are
+        streamed instead as they are read from the db, one line per day.
+        With `Accept: application/vnd.rates.columnar+json` or `Accept: application/msgpack`,
+        a single map {"date_from", "date_to", "average_price": [...]} is returned instead,
+        the i-th price being the one of `date_from` + i days.
+        Bodies are gzip (or brotli) compressed when `Accept-Encoding` allows it, and
+        an `If-None-Match` carrying the current ETag is answered 304 without querying.
+    """
+    query = {"date_from": date_from, "date_to": date_to, "origin": origin, "destination": destination}
+    with metrics.request_timer(**query) as timer:
+        type_loc = _validate_query(date_from, date_to, origin, destination)
+        granularity = _validate_granularity(granularity)
+        timer.shape = metrics.shape_of(type_loc)
+        return await _answer_rates(type_loc, origin, destination, date_from, date_to,
+                                   accept, accept_encoding, if_none_match, granularity)
+
+
+async def _answer_rates(type_loc, origin, destination, date_from, date_to,
+                        accept, accept_encoding, if_none_match, granularity="day"):
+    """
+    Helper private function to answer a validated `/rates` query in the representation asked for.
+    :return: Response
+    """
+    media_type = encoding.negotiate_media_type(
+        accept, ("application/json", *result.STREAM_MEDIA_TYPES, *result.COLUMNAR_MEDIA_TYPES)
+    )
+    if media_type in result.STREAM_MEDIA_TYPES:
+        return await _stream_rates(type_loc, origin, destination, date_from, date_to, media_type, granularity)
+
+    # the answer only changes with the prices, so its ETag is known upfront
+    version = await _data_version()
+    etag = None
+    if version is not None:
+        etag = encoding.query_etag(version, date_from, date_to, origin, destination, granularity, media_type)
+        if encoding.etag_matches(if_none_match, etag):
+            return _not_modified(encoding.encoded_etag(etag, encoding.negotiate_encoding(accept_encoding)))
+
+    days, prices = await _cached_rates(type_loc, origin, destination, date_from, date_to, version, granularity)
+
+    with metrics.phase("serialize"):
+        if media_type in result.COLUMNAR_MEDIA_TYPES:
+            body = result.encode_columnar(days, prices, media_type)
+        else:
+            body = result.encode_json(days, prices)
+    return _encoded_response(body, media_type, etag, accept_encoding, if_none_match, cacheable=True)
+
+
+def _encoded_response(body, media_type="application/json", etag=None,
+                      accept_encoding=None, if_none_match=None, cacheable=False):
+    """
+    Helper private function to send an already encoded body, compressed when it is
+    worth it (`Content-Length` is set from the body by the response itself).
+    :param body: bytes
+    :param media_type: str
+    :param etag: str or None
+        Quoted ETag of the query, None to derive it from the body.
+    :param accept_encoding: str or None, the `Accept-Encoding` request header
+    :param if_none_match: str or None, the `If-None-Match` request header
+    :param cacheable: bool
+        Whether shared caches may keep the response for `RATES_MAX_AGE` seconds.
+    :return: Response
+    """
+    if etag is None:
+        etag = encoding.content_etag(body)
+
+    coding = encoding.negotiate_encoding(accept_encoding)
+    if len(body) < encoding.COMPRESS_MIN_SIZE:
+        coding = None
+    etag = encoding.encoded_etag(etag, coding)
+    if encoding.etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+
+    headers = {"ETag": etag, "Vary": "Accept, Accept-Encoding"}
+    if cacheable:
+        headers["Cache-Control"] = f"public, max-age={encoding.RATES_MAX_AGE}"
+    if coding is not None:
+        with metrics.phase("compress"):
+            body = encoding.compress(body, coding)
+        headers["Content-Encoding"] = coding
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+def _not_modified(etag):
+    """Helper private function to answer a conditional request whose copy is still current."""
+    return Response(status_code=304, headers={
+        "ETag": etag,
+        "Vary": "Accept, Accept-Encoding",
+        "Cache-Control": f"public, max-age={encoding.RATES_MAX_AGE}",
+    })
+
+
+async def _data_version():
+    """
+    Helper private function to get the current version of `prices` (see `rates_meta`),
+    read from the db at most once per `STATS_FRESHNESS_TTL` seconds.
+    Cached days of an older version are dropped once a new one is seen.
+    :return: int, or None if the version stamps are not migrated.
+    """
+    if not stats_state.is_current():
+        try:
+            async with connect_dict["pool"].acquire() as conn:
+                await stats_state.check(conn)
+        except PoolTimeout:
+            raise HTTPException(status_code=503,
+                                detail="[BUSY]No database connection available, retry later.")
+
+    version = stats_state.prices_version
+    if version != connect_dict.get("version"):
+        connect_dict["version"] = version
+        day_cache.invalidate()
+    if RATES_BACKEND == "memory" and engine.version != version:
+        _reload_engine()
+    return version
+
+
+def _reload_engine():
+    """
+    Helper private function to reload the in-memory engine in the background, once at a time;
+    queries go to the db meanwhile (see `_fetch_rates`). The worker seeing a new version
+    first writes the snapshot, the others of the host wait for it and map it.
     """
-    conn = connect_dict["conn"]
+    reload = connect_dict.get("engine_reload")
+    if reload is not None and not reload.done():
+        return
+    # after a failure, queries keep going to the db rather than retrying on every request
+    if time.monotonic() < connect_dict.get("engine_reload_after", 0.0):
+        return
 
-    type_date = date.validate(date_from, date_to)
+    async def _reload():
+        async with connect_dict["pool"].acquire() as conn:
+            await snapshot.load(conn, engine)
+
+    connect_dict["engine_reload"] = asyncio.ensure_future(_reload())
+    connect_dict["engine_reload"].add_done_callback(_reload_done)
+
+
+def _reload_done(reload):
+    """Helper private function to log a failed reload of the in-memory engine and delay the next one."""
+    if reload.cancelled() or reload.exception() is None:
+        return
+    connect_dict["engine_reload_after"] = time.monotonic() + ENGINE_RELOAD_RETRY
+    log.error("in-memory engine reload failed, next try in %ss", ENGINE_RELOAD_RETRY,
+              exc_info=reload.exception())
+
+
+def _validate_query(date_from, date_to, origin, destination):
+    """
+    Helper private function to run the date and location validators.
+    :return: tuple[str] as returned by `location.validate`
+    :raise: HTTPException if either validation fails.
+    """
+    with metrics.phase("date_validate"):
+        type_date = date.validate(date_from, date_to)
 
     # type_date is a string, other than "success"
     # is a failure.
@@ -71,7 +295,8 @@ async def rates(
         raise HTTPException(status_code=418,
                             detail="[BAD DATA]Date From > Date To.")
 
-    type_loc = location.validate(origin, destination)
+    with metrics.phase("location_validate"):
+        type_loc = location.validate(origin, destination)
 
     # type_loc will be a 2-length tuple, if it contains
     # "neither", it implies that location validation failed.
@@ -79,34 +304,431 @@ async def rates(
         raise HTTPException(status_code=503,
                             detail="[BAD DATA]Validation on location(s) are currently failing.")
 
-    if type_loc[0] == type_loc[1] == "port":
-        data = await execute_when_both_ports(
-            conn,
-            origin,
-            destination,
-            date_from,
-            date_to
+    return type_loc
+
+
+def _validate_granularity(granularity):
+    """
+    Helper private function to run the granularity validator.
+    :return: str as returned by `granularity.validate`
+    :raise: HTTPException if it fails.
+    """
+    granularity = bucket.validate(granularity)
+    if granularity == "f_granularity_wrong":
+        raise HTTPException(status_code=418,
+                            detail=f"[BAD DATA]Granularity must be day, week, month or <N>d "
+                                   f"(N up to {bucket.MAX_BUCKET_DAYS}).")
+    return granularity
+
+
+async def _cached_rates(type_loc, origin, destination, date_from, date_to, version=None, granularity="day"):
+    """
+    Helper private function to answer an already validated query through the caches.
+    :param version: int or None, as returned by `_data_version`
+    :param granularity: str as returned by `granularity.validate`
+    :return: tuple[numpy.ndarray, numpy.ndarray] as returned by `result.to_arrays`
+    """
+    # dates and locations passed validation, so the tuple is already normalized;
+    # the version keeps answers computed from older prices from being served
+    key = (version, date_from, date_to, origin, destination, granularity)
+    return await rates_cache.get_or_compute(
+        key,
+        lambda: _shared_rates(key, type_loc, origin, destination, date_from, date_to, granularity),
+    )
+
+
+async def _shared_rates(key, type_loc, origin, destination, date_from, date_to, granularity="day"):
+    """
+    Helper private function to look a query up in the tier shared by the workers
+    before fetching it, and to share what was fetched.
+    Only the prices are kept there, the day (bucket) axis follows from the dates.
+    :return: tuple[numpy.ndarray, numpy.ndarray] as returned by `result.to_arrays`
+    """
+    if shared_cache is None:
+        return await _fetch_rates(type_loc, origin, destination, date_from, date_to, granularity)
+
+    shared_key = "rates:" + "|".join(map(str, key))
+    prices = shared_cache.get(shared_key)
+    if prices is not None:
+        return result.bucket_axis(date_from, date_to, granularity), np.frombuffer(prices, dtype=np.float64)
+
+    days, prices = await _fetch_rates(type_loc, origin, destination, date_from, date_to, granularity)
+    shared_cache.put(shared_key, prices.tobytes())
+    return days, prices
+
+
+async def _stream_rates(type_loc, origin, destination, date_from, date_to, media_type, granularity="day"):
+    """
+    Helper private function to stream the rows of a query through a server-side cursor.
+    The connection is acquired before the response starts, so a saturated pool
+    still answers 503, and released once the response is over (or the client left).
+    A response still going after `STREAM_TIMEOUT` seconds, Eg: for a client reading
+    slowly, is cut short so that it does not keep the connection from other queries.
+    :return: StreamingResponse
+    """
+    # the stamps are read from the primary, `plan_rates` then only gets the answer
+    await _data_version()
+    resources = AsyncExitStack()
+    expensive = is_expensive(metrics.shape_of(type_loc), date_from, date_to)
+    with _answering_busy():
+        try:
+            await resources.enter_async_context(admission.admit(expensive))
+            conn = await resources.enter_async_context(_reads().acquire())
+        except BaseException:
+            # whatever kept the connection from being acquired, the admission slot is given back
+            await resources.aclose()
+            raise
+
+    async def _expire(streaming):
+        await asyncio.sleep(STREAM_TIMEOUT)
+        log.warning("stream of %s->%s cut after %ss", origin, destination, STREAM_TIMEOUT)
+        streaming.cancel()
+        # waiting for the client at a chunk: the body is closed from here,
+        # else it is reading from the db and the cancellation reaches it there
+        if not body.ag_running:
+            await body.aclose()
+
+    async def _body():
+        watchdog = asyncio.ensure_future(_expire(asyncio.current_task()))
+        try:
+            # cursors only live inside a transaction
+            async with conn.transaction():
+                query, *args = await plan_rates(conn, type_loc, origin, destination, date_from, date_to, granularity,
+                                                stats_state.fresh)
+                rows = conn.cursor(query, *args, prefetch=STREAM_PREFETCH)
+                async for chunk in result.stream(rows, date_from, date_to, media_type, granularity=granularity):
+                    yield chunk
+        finally:
+            if watchdog is not asyncio.current_task():
+                watchdog.cancel()
+            # the background task only runs once the body ended normally;
+            # shielded so that a client leaving mid-stream still gives the connection back
+            await asyncio.shield(resources.aclose())
+
+    body = _body()
+
+    async def _release():
+        # the body may not have started (Eg: the client left first), closing the stack again is a no-op
+        await body.aclose()
+        await resources.aclose()
+
+    return StreamingResponse(body, media_type=media_type, background=BackgroundTask(_release))
+
+
+@app.post("/rates/batch")
+async def rates_batch(
+        batch: BatchSchema,
+        accept_encoding: Union[str, None] = Header(default=None),
+):
+    """
+    Answers many lanes in one request, Eg: every origin/destination pair of a quote sheet.
+    Each lane goes through the same validators and caches as `/rates`, and lanes
+    are looked up concurrently over the connection pool.
+    :param batch: BatchSchema
+        `date_from`/`date_to` of a lane default to the ones of the batch.
+    :return: List[dict]
+        In the order of `batch.lanes`, with keys:
+            origin, destination, date_from, date_to: (str) the lane as it was answered.
+            rates: (List[dict]) as returned by `/rates`.
+    """
+    with metrics.request_timer("batch", lanes=len(batch.lanes)):
+        if len(batch.lanes) > BATCH_MAX_LANES:
+            raise HTTPException(status_code=413,
+                                detail=f"[BAD DATA]At most {BATCH_MAX_LANES} lanes per batch.")
+
+        queries = []
+        for index, lane in enumerate(batch.lanes):
+            date_from = lane.date_from or batch.date_from
+            date_to = lane.date_to or batch.date_to
+            if date_from is None or date_to is None:
+                raise HTTPException(status_code=418,
+                                    detail=f"Lane {index}: [BAD DATA]No date range given.")
+            try:
+                type_loc = _validate_query(date_from, date_to, lane.origin, lane.destination)
+            except HTTPException as error:
+                raise HTTPException(status_code=error.status_code,
+                                    detail=f"Lane {index}: {error.detail}")
+            queries.append((type_loc, lane.origin, lane.destination, date_from, date_to))
+
+        version = await _data_version()
+        # no more lanes in flight than the pool has connections
+        limit = asyncio.Semaphore(connect_dict["pool"].max_size)
+
+        async def _answer(type_loc, origin, destination, date_from, date_to):
+            async with limit:
+                days, prices = await _cached_rates(type_loc, origin, destination, date_from, date_to, version)
+            # the rates are spliced in already encoded
+            return b'{"origin":%s,"destination":%s,"date_from":%s,"date_to":%s,"rates":%s}' % (
+                *(json.dumps(value).encode() for value in (origin, destination, date_from, date_to)),
+                result.encode_json(days, prices),
+            )
+
+        lanes = await asyncio.gather(*[_answer(*query) for query in queries])
+        return _encoded_response(b"[" + b",".join(lanes) + b"]", accept_encoding=accept_encoding)
+
+
+@app.get("/rates/matrix")
+async def rates_matrix(
+        date_from: str,
+        date_to: str,
+        origin: str,
+        destination: str,
+        collapse: bool = False,
+        accept: Union[str, None] = Header(default=None),
+        accept_encoding: Union[str, None] = Header(default=None),
+        if_none_match: Union[str, None] = Header(default=None),
+):
+    """
+    Average prices of every lane from a port below `origin` to a port below `destination`,
+    Eg: china_main x north_europe_main, instead of one `/rates` request per lane.
+    Both regions are expanded once and every lane is read by a single query.
+    :param date_from: str in format "YYYY-MM-DD"
+    :param date_to: str in format "YYYY-MM-DD"
+    :param origin: str, a region slug (or a port code, for a single row)
+    :param destination: str, a region slug (or a port code, for a single column)
+    :param collapse: bool
+        If True, one average per lane over the whole range instead of one per day.
+    :return: dict as encoded by `result.encode_matrix`
+        Prices nested [origin][destination][day] in JSON, or with `Accept: application/msgpack`
+        a dense float32 array of shape (origins, destinations[, days]), NaN for None.
+        Larger than `MATRIX_MAX_CELLS` prices is refused with 413.
+    """
+    query = {"date_from": date_from, "date_to": date_to, "origin": origin, "destination": destination}
+    with metrics.request_timer("matrix", **query):
+        type_loc = _validate_query(date_from, date_to, origin, destination)
+        media_type = encoding.negotiate_media_type(accept, ("application/json", "application/msgpack"))
+
+        version = await _data_version()
+        etag = None
+        if version is not None:
+            etag = encoding.query_etag(version, "matrix", date_from, date_to, origin, destination, str(collapse), media_type)
+            if encoding.etag_matches(if_none_match, etag):
+                return _not_modified(encoding.encoded_etag(etag, encoding.negotiate_encoding(accept_encoding)))
+
+        origins, destinations, prices = await rates_cache.get_or_compute(
+            ("matrix", version, date_from, date_to, origin, destination, collapse),
+            lambda: _fetch_matrix(type_loc, origin, destination, date_from, date_to, collapse),
         )
-    elif type_loc[0] == type_loc[1] == "region":
-        data = await execute_when_both_region(
+        with metrics.phase("serialize"):
+            body = result.encode_matrix(origins, destinations, date_from, date_to, prices, media_type)
+        return _encoded_response(body, media_type, etag, accept_encoding, if_none_match, cacheable=True)
+
+
+async def _fetch_matrix(type_loc, origin, destination, date_from, date_to, collapse):
+    """
+    Helper private function to expand both locations and read every lane between them,
+    from the in-memory engine when it is current, else in one query.
+    :return: tuple[List[str], List[str], numpy.ndarray]
+        The origin and destination ports and the prices as returned by `result.matrix_prices`.
+    """
+    n_days = len(result.day_axis(date_from, date_to))
+
+    async def _axes(conn):
+        with metrics.phase("region_lookup"):
+            origins = await ports_of(conn, origin, type_loc[0] == "region")
+            destinations = await ports_of(conn, destination, type_loc[1] == "region")
+        cells = len(origins) * len(destinations) * (1 if collapse else n_days)
+        if cells > MATRIX_MAX_CELLS:
+            raise HTTPException(status_code=413,
+                                detail=f"[BAD DATA]{cells} prices asked, at most {MATRIX_MAX_CELLS}: "
+                                       f"collapse the days or narrow the range.")
+        return origins, destinations
+
+    if _engine_is_current() and not region_index.is_stale():
+        origins, destinations = await _axes(None)
+        with metrics.phase("execute"):
+            counts, sums = engine.matrix(origins, destinations, date_from, date_to, collapse)
+        return origins, destinations, result.matrix_prices(counts, sums)
+
+    async def _execute(conn):
+        origins, destinations = await _axes(conn)
+        with metrics.phase("execute"):
+            rows = await execute_matrix(conn, origins, destinations, date_from, date_to, collapse,
+                                        stats_state.fresh)
+        return origins, destinations, rows
+
+    with _answering_busy():
+        # a matrix spans many lanes, it always takes the expensive lane of admission
+        async with admission.admit(True):
+            origins, destinations, rows = await _reads().run(
+                lambda conn: asyncio.wait_for(_execute(conn), statement_timeout("region_region"))
+            )
+
+    with metrics.phase("result"):
+        counts, sums = result.to_matrix(rows, origins, destinations, date_from, date_to, collapse)
+        return origins, destinations, result.matrix_prices(counts, sums)
+
+
+@app.post("/rates/prices")
+async def ingest_prices(
+        request: Request,
+        content_type: Union[str, None] = Header(default=None),
+):
+    """
+    Loads new prices, streamed from the request body as they are parsed.
+    :param request: body as CSV (`Content-Type: text/csv`, with a header line) or
+        NDJSON (`Content-Type: application/x-ndjson`) of orig_code, dest_code, day, price.
+    :return: dict as returned by `ingest.ingest`, with the throughput in rows/sec.
+    """
+    media_type = next((media for media in INGEST_MEDIA_TYPES if media in (content_type or "")), None)
+    if media_type is None:
+        raise HTTPException(status_code=415,
+                            detail=f"[BAD DATA]Send prices as one of {', '.join(INGEST_MEDIA_TYPES)}.")
+
+    try:
+        async with connect_dict["pool"].acquire() as conn:
+            report = await ingest(conn, read_records(iter_lines(request.stream()), media_type))
+    except PoolTimeout:
+        raise HTTPException(status_code=503,
+                            detail="[BUSY]No database connection available, retry later.")
+    except IngestError as error:
+        # nothing was loaded, the transaction rolled back
+        raise HTTPException(status_code=418, detail=f"[BAD DATA]{error}")
+
+    rates_cache.invalidate()
+    day_cache.invalidate()
+    if shared_cache is not None:
+        # answers other workers put there are as stale as this one's
+        shared_cache.invalidate()
+    if RATES_BACKEND == "memory":
+        # builds the snapshot of the new prices without waiting for the next version check
+        _reload_engine()
+    return report
+
+
+async def _execute_rates(conn, type_loc, origin, destination, date_from, date_to, granularity="day"):
+    """
+    Helper private function to run the query matching the location types,
+    timed as the "execute" phase of the request.
+    :param conn: asyncpg.Connection object
+    :param type_loc: tuple[str] as returned by `location.validate`
+    :return: List[asyncpg.Record]
+    """
+    with metrics.phase("execute"):
+        return await _dispatch_rates(conn, type_loc, origin, destination, date_from, date_to, granularity)
+
+
+async def _dispatch_rates(conn, type_loc, origin, destination, date_from, date_to, granularity="day"):
+    """
+    Helper private function to call the `execute_when_*` matching the location types.
+    `conn` may be a replica's: whether to read the stats comes from the primary's stamps
+    (see `_data_version`), the replica's must not replace them.
+    """
+    if type_loc[0] == type_loc[1] == "port":
+        return await execute_when_both_ports(
             conn,
             origin,
             destination,
             date_from,
             date_to,
+            granularity,
+            stats_state.fresh,
         )
-    else:
-        first_is_region = True if type_loc[0] == "region" else False
-        data = await execute_when_one_region(
+    elif type_loc[0] == type_loc[1] == "region":
+        return await execute_when_both_region(
             conn,
             origin,
             destination,
             date_from,
             date_to,
-            first_is_region,
+            granularity,
+            stats_state.fresh,
         )
+    first_is_region = True if type_loc[0] == "region" else False
+    return await execute_when_one_region(
+        conn,
+        origin,
+        destination,
+        date_from,
+        date_to,
+        first_is_region,
+        granularity,
+        stats_state.fresh,
+    )
+
+
+async def _fetch_rates(type_loc, origin, destination, date_from, date_to, granularity="day"):
+    """
+    Helper private function to run the query on a pooled connection and lay out its result.
+    :return: tuple[numpy.ndarray, numpy.ndarray] as returned by `result.to_arrays`
+    """
+    shape = metrics.shape_of(type_loc)
+
+    if _engine_is_current():
+        return await _memory_rates(type_loc, origin, destination, date_from, date_to, granularity)
+
+    async def _fetch_range(range_from, range_to):
+        # only what reaches the db is admitted, cheap lookups skip the queue
+        async with admission.admit(is_expensive(shape, range_from, range_to)):
+            return await _reads().run(lambda conn: asyncio.wait_for(
+                _execute_rates(conn, type_loc, origin, destination, range_from, range_to, granularity),
+                statement_timeout(shape),
+            ))
+
+    with _answering_busy():
+        if granularity == "day":
+            # per-day aggregates already known for this lane are reused,
+            # only the missing days reach the db
+            data = await day_cache.get_or_fetch(
+                (origin, destination), date_from, date_to, _fetch_range
+            )
+        else:
+            # buckets are aggregated by the db, a few rows instead of every day
+            data = await _fetch_range(date_from, date_to)
+
+    with metrics.phase("result"):
+        return result.to_arrays(data, date_from, date_to, granularity)
+
+
+def _reads():
+    """
+    Helper private function to get where rate reads go: the replica router, else the primary pool.
+    Writes, ingestion and the version stamps are read from `connect_dict["pool"]`, the primary.
+    """
+    return connect_dict.get("reads") or connect_dict["pool"]
+
+
+def _engine_is_current():
+    """Helper private function telling whether the in-memory engine holds the current prices (it answers no others)."""
+    return RATES_BACKEND == "memory" and engine.version is not None and engine.version == stats_state.prices_version
+
+
+@contextmanager
+def _answering_busy():
+    """Helper private function to answer a query shed, timed out or left without a connection (503/429)."""
+    try:
+        yield
+    except Overloaded as error:
+        raise _shed(error)
+    except asyncio.TimeoutError:
+        # the pending statement was cancelled on the server when its task was
+        raise _shed(Overloaded(503, "[BUSY]Query took too long, retry later.", admission.retry_after))
+    except PoolTimeout:
+        raise HTTPException(status_code=503,
+                            detail="[BUSY]No database connection available, retry later.")
+
+
+async def _memory_rates(type_loc, origin, destination, date_from, date_to, granularity="day"):
+    """
+    Helper private function to answer from the in-memory engine; the db is only
+    reached if the region index has to be reloaded first.
+    :return: tuple[numpy.ndarray, numpy.ndarray] as returned by `result.to_arrays`
+    """
+    with metrics.phase("execute"):
+        if "region" in type_loc and region_index.is_stale():
+            async with _reads().acquire() as conn:
+                return await rates_arrays(conn, type_loc, origin, destination, date_from, date_to, granularity)
+        return await rates_arrays(None, type_loc, origin, destination, date_from, date_to, granularity)
 
-    return result.validate(data, date_from, date_to)
+
+def _shed(error):
+    """
+    Helper private function to turn a shed query into its HTTP answer.
+    :param error: Overloaded
+    :return: HTTPException with a `Retry-After` header
+    """
+    return HTTPException(status_code=error.status_code, detail=error.detail,
+                         headers={"Retry-After": str(error.retry_after)})
 
 
 # The following methods are only here in case one needs to
@@ -114,7 +736,7 @@ async def rates(
 # proper connection between db and app (for testing).
 async def _get_port():
     """Helper private function to fetch one row from Ports table"""
-    data = await connect_dict["conn"].fetchrow(
+    data = await connect_dict["pool"].fetchrow(
         """SELECT * FROM Ports LIMIT 1"""
     )
     return dict(data)
@@ -122,7 +744,7 @@ async def _get_port():
 
 async def _get_price():
     """Helper private function to fetch one row from Ports table"""
-    data = await connect_dict["conn"].fetchrow(
+    data = await connect_dict["pool"].fetchrow(
         """SELECT * FROM Prices LIMIT 1"""
     )
     return dict(data)
@@ -130,7 +752,7 @@ async def _get_price():
 
 async def _get_region():
     """Helper private function to fetch one row from Regions table"""
-    data = await connect_dict["conn"].fetchrow(
+    data = await connect_dict["pool"].fetchrow(
         """SELECT * FROM Regions LIMIT 1"""
     )
     return dict(data)
@@ -149,3 +771,74 @@ async def single_region():
 @app.get("/rates/get_single_price/", response_model=PriceSchema)
 async def single_price():
     return _get_price()
+
+
+@app.get("/health")
+async def health():
+    """Liveness of the database behind the pool, 503 if it does not answer."""
+    if not await connect_dict["pool"].health_check():
+        raise HTTPException(status_code=503,
+                            detail="[DB DOWN]Database is not answering.")
+    return {"status": "ok"}
+
+
+@app.get("/rates/pool_stats/")
+async def pool_stats():
+    """Saturation metrics of the connection pool, used to size it under load, and the routing of reads."""
+    stats = connect_dict["pool"].metrics()
+    if "reads" in connect_dict:
+        stats["reads"] = connect_dict["reads"].metrics()
+    return stats
+
+
+@app.get("/rates/cache_stats/")
+async def cache_stats():
+    """Size and hit/miss counters of the `/rates` response, per-day and shared caches."""
+    return {
+        "responses": rates_cache.stats(),
+        "days": day_cache.stats(),
+        "shared": shared_cache.stats() if shared_cache is not None else None,
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Request and phase latency histograms, pool and cache gauges, in the Prometheus text format."""
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
+def _pool_metric(key):
+    """Helper private function to read one pool metric at scrape time, None before startup."""
+    return lambda: connect_dict["pool"].metrics()[key] if "pool" in connect_dict else None
+
+
+metrics.registry.gauge("db_pool_in_use", "Pooled connections checked out.", _pool_metric("in_use"))
+metrics.registry.gauge("db_pool_waiting", "Callers waiting for a pooled connection.", _pool_metric("waiting"))
+metrics.registry.gauge("db_pool_timeouts_total", "Acquisitions that timed out.", _pool_metric("timeouts_total"))
+metrics.registry.gauge("db_replicas_in_sync", "Read replicas taking rate reads.",
+                       lambda: sum(replica["in_sync"] for replica in connect_dict["reads"].metrics()["replicas"])
+                       if "reads" in connect_dict else None)
+metrics.registry.gauge("db_replica_failovers_total", "Reads sent back to the primary after a replica failed.",
+                       lambda: connect_dict["reads"].failovers_total if "reads" in connect_dict else None)
+metrics.registry.gauge("admission_active", "Expensive queries running.", lambda: admission.active)
+metrics.registry.gauge("admission_queued", "Expensive queries waiting for a slot.", lambda: admission.queued)
+metrics.registry.gauge("admission_shed_total", "Expensive queries answered 429/503 instead of run.",
+                       lambda: admission.rejected_total + admission.timeouts_total)
+metrics.registry.gauge("rates_cache_hit_ratio", "Hit ratio of the /rates response cache.",
+                       lambda: rates_cache.stats()["hit_ratio"])
+metrics.registry.gauge("rates_cache_entries", "Entries of the /rates response cache.", lambda: len(rates_cache))
+metrics.registry.gauge("day_cache_hit_ratio", "Hit ratio of the per-day aggregate cache.",
+                       lambda: day_cache.stats()["day_hit_ratio"])
+
+
+@app.delete("/rates/cache/")
+async def invalidate_cache():
+    """
+    Drops every cached `/rates` response and day, Eg: after prices were loaded.
+    The shared tier is emptied for every worker, the in-process caches only for this one.
+    """
+    rates_cache.invalidate()
+    day_cache.invalidate()
+    if shared_cache is not None:
+        shared_cache.invalidate()
+    return await cache_stats()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""Per-phase timings of `/rates` requests, exported in the Prometheus text format at `/metrics`."""
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# requests slower than this many seconds are logged with their phase breakdown (0 disables)
+SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_SECONDS", "1.0"))
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+slow_query_log = logging.getLogger("app.slow_query")
+
+
+def _format_labels(names, values, extra=()):
+    """Helper private function to write a `{name="value",...}` label set."""
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+class Histogram:
+    """Cumulative histogram with a fixed set of label names, as Prometheus expects it."""
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        :param name: str
+        :param documentation: str, the `# HELP` line
+        :param labels: tuple[str] label names, their values are given to `observe`
+        :param buckets: tuple[float] sorted upper bounds, `+Inf` is implied
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        # label values -> [counts per bucket, sum]
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        """
+        :param value: float, Eg: seconds
+        :param label_values: str, one per label name
+        """
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [[0] * len(self.buckets), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        """:return: List[str] lines of the text exposition format"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labels, label_values, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Histograms updated as requests go, plus gauges read from their source when scraped."""
+
+    def __init__(self):
+        self._histograms = []
+        self._gauges = []
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        """Creates and registers a `Histogram`."""
+        histogram = Histogram(name, documentation, labels, buckets)
+        self._histograms.append(histogram)
+        return histogram
+
+    def gauge(self, name, documentation, read):
+        """
+        Registers a gauge whose value is read at scrape time.
+        :param read: Callable[[], float|None] None leaves the gauge out, Eg: before startup
+        """
+        self._gauges.append((name, documentation, read))
+
+    def render(self):
+        """:return: str the whole exposition, in registration order"""
+        lines = []
+        for histogram in self._histograms:
+            lines.extend(histogram.render())
+        for name, documentation, read in self._gauges:
+            value = read()
+            if value is None:
+                continue
+            lines.extend([f"# HELP {name} {documentation}", f"# TYPE {name} gauge", f"{name} {_format_value(value)}"])
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    "rates_request_seconds", "Time spent answering a /rates request.", labels=("shape",),
+)
+PHASE_SECONDS = registry.histogram(
+    "rates_phase_seconds", "Time spent in each phase of a /rates request.", labels=("phase", "shape"),
+)
+POOL_WAIT_SECONDS = registry.histogram(
+    "db_pool_wait_seconds", "Time spent waiting for a pooled connection.",
+)
+
+_current = ContextVar("rates_request_timer", default=None)
+
+
+class RequestTimer:
+    """Collects the phase durations of one request until its query shape is known."""
+
+    def __init__(self, shape="unknown"):
+        self.shape = shape
+        self.details = {}
+        self.phases = {}
+        self.started = time.perf_counter()
+
+    def add(self, phase, seconds):
+        """Adds to `phase`, which may run several times, Eg: one region lookup per slug."""
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def finish(self):
+        """Records the request in the histograms and logs it if slower than `SLOW_QUERY_SECONDS`."""
+        total = time.perf_counter() - self.started
+        REQUEST_SECONDS.observe(total, self.shape)
+        for phase, seconds in self.phases.items():
+            PHASE_SECONDS.observe(seconds, phase, self.shape)
+
+        if 0 < SLOW_QUERY_SECONDS <= total:
+            slow_query_log.warning(
+                "slow /rates request: %.3fs shape=%s %s phases=%s",
+                total,
+                self.shape,
+                " ".join(f"{key}={value}" for key, value in self.details.items()),
+                {phase: round(seconds, 4) for phase, seconds in self.phases.items()},
+            )
+
+
+def shape_of(type_loc):
+    """
+    :param type_loc: tuple[str] as returned by `location.validate`
+    :return: str label, Eg: "port_region"
+    """
+    return "_".join(type_loc)
+
+
+@contextmanager
+def request_timer(shape="unknown", **details):
+    """
+    Times the request running in this context; `phase` blocks below it add to it.
+    :param shape: str, may also be set later on the yielded timer
+    :param details: logged along a slow request, Eg: its query parameters
+    :return: ContextManager[RequestTimer]
+    """
+    timer = RequestTimer(shape)
+    timer.details.update(details)
+    token = _current.set(timer)
+    try:
+        yield timer
+    finally:
+        _current.reset(token)
+        timer.finish()
+
+
+def record(name, seconds):
+    """Adds `seconds` to phase `name` of the request running in this context, if any."""
+    timer = _current.get()
+    if timer is not None:
+        timer.add(name, seconds)
+
+
+@contextmanager
+def phase(name):
+    """Times the block as `name` for the request running in this context, if any."""
+    timer = _current.get()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - started)
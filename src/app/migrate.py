@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""Versioned schema migrations, applied at startup or via `python -m app.migrate`."""
+import asyncio
+import os
+import re
+import sys
+from pathlib import Path
+
+import asyncpg
+
+
+MIGRATIONS_DIR = Path(__file__).parent / "migrations"
+
+# arbitrary key, so that several workers starting together apply migrations once
+ADVISORY_LOCK_KEY = 7261001
+
+CREATE_VERSION_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version integer PRIMARY KEY,
+        name text NOT NULL,
+        applied_at timestamptz NOT NULL DEFAULT now()
+    )
+"""
+
+
+def discover(directory=MIGRATIONS_DIR):
+    """
+    Lists migration files named `<version>_<name>.sql`.
+    :param directory: pathlib.Path
+    :return: List[tuple[int, str, pathlib.Path]]
+        (version, name, path) sorted by version.
+    """
+    found = []
+    for path in directory.glob("*.sql"):
+        match = re.fullmatch(r"(\d+)_(\w+)\.sql", path.name)
+        if match is None:
+            raise ValueError(f"Migration file name not understood: {path.name}")
+        found.append((int(match.group(1)), match.group(2), path))
+
+    found.sort()
+    versions = [version for version, _, _ in found]
+    if len(set(versions)) != len(versions):
+        raise ValueError(f"Duplicate migration versions in {directory}")
+    return found
+
+
+async def applied_versions(conn):
+    """
+    :param conn: asyncpg.Connection object
+    :return: Set[int] versions already recorded in `schema_migrations`.
+    """
+    await conn.execute(CREATE_VERSION_TABLE)
+    return {row["version"] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+
+
+async def apply_migrations(conn, directory=MIGRATIONS_DIR, up_to=None):
+    """
+    Applies every pending migration in order, each inside its own transaction.
+    :param conn: asyncpg.Connection object
+    :param directory: pathlib.Path
+    :param up_to: None or int, the last version to apply (None applies them all)
+    :return: List[int] versions applied by this call.
+    """
+    await conn.execute("SELECT pg_advisory_lock($1)", ADVISORY_LOCK_KEY)
+    try:
+        done = await applied_versions(conn)
+        applied = []
+        for version, name, path in discover(directory):
+            if version in done or (up_to is not None and version > up_to):
+                continue
+            async with conn.transaction():
+                await conn.execute(path.read_text())
+                await conn.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+                    version,
+                    name,
+                )
+            applied.append(version)
+        return applied
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", ADVISORY_LOCK_KEY)
+
+
+async def _main(command):
+    conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+    try:
+        if command == "apply":
+            applied = await apply_migrations(conn)
+            print(f"applied: {applied}" if applied else "nothing to apply")
+        elif command == "status":
+            done = await applied_versions(conn)
+            for version, name, _ in discover():
+                print(f"{version:04d} {name}: {'applied' if version in done else 'pending'}")
+        else:
+            raise SystemExit(f"unknown command {command!r}, expected 'apply' or 'status'")
+    finally:
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main(sys.argv[1] if len(sys.argv) > 1 else "status"))
@@ -0,0 +1,4 @@
+-- Composite index matching the WHERE clause of every rate query:
+-- equality on the lane, range on the day.
+CREATE INDEX IF NOT EXISTS prices_lane_day_idx
+    ON prices (orig_code, dest_code, day);
@@ -0,0 +1,8 @@
+-- Covering variant of prices_lane_day_idx: `price` is stored in the index
+-- leaf so the daily COUNT/AVG can be answered by an index-only scan.
+-- It serves every lookup the plain index did, which is dropped to avoid
+-- maintaining both on every insert.
+CREATE INDEX IF NOT EXISTS prices_lane_day_covering_idx
+    ON prices (orig_code, dest_code, day) INCLUDE (price);
+
+DROP INDEX IF EXISTS prices_lane_day_idx;
@@ -0,0 +1,6 @@
+-- Region to ports expansion (recursive statement, region index reload).
+CREATE INDEX IF NOT EXISTS ports_parent_slug_idx
+    ON ports (parent_slug);
+
+ANALYZE prices;
+ANALYZE ports;
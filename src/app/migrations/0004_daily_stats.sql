@@ -0,0 +1,72 @@
+-- Pre-aggregated daily statistics read by the rate queries instead of raw prices.
+
+-- Version stamps: `prices_version` is bumped by every statement writing to
+-- prices, `stats_version` records which prices version the stats reflect.
+CREATE TABLE IF NOT EXISTS rates_meta (
+    id boolean PRIMARY KEY DEFAULT true CHECK (id),
+    prices_version bigint NOT NULL DEFAULT 1,
+    stats_version bigint NOT NULL DEFAULT 0
+);
+
+INSERT INTO rates_meta DEFAULT VALUES ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_prices_version() RETURNS trigger AS $$
+BEGIN
+    UPDATE rates_meta SET prices_version = prices_version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER prices_version_bump
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON prices
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_prices_version();
+
+-- Every region with the codes of all ports below it, at any depth.
+CREATE OR REPLACE VIEW region_ports AS
+    WITH RECURSIVE tree(root, slug) AS (
+        SELECT slug, slug
+            FROM regions
+        UNION
+        SELECT tree.root, regions.slug
+            FROM regions
+            JOIN tree ON regions.parent_slug = tree.slug
+    )
+    SELECT tree.root AS slug,
+           ports.code
+        FROM tree
+        JOIN ports ON ports.parent_slug = tree.slug;
+
+CREATE TABLE IF NOT EXISTS lane_daily_stats (
+    orig_code text NOT NULL,
+    dest_code text NOT NULL,
+    day date NOT NULL,
+    price_count integer NOT NULL,
+    price_sum bigint NOT NULL,
+    PRIMARY KEY (orig_code, dest_code, day)
+);
+
+CREATE TABLE IF NOT EXISTS region_daily_stats (
+    orig_slug text NOT NULL,
+    dest_slug text NOT NULL,
+    day date NOT NULL,
+    price_count bigint NOT NULL,
+    price_sum bigint NOT NULL,
+    PRIMARY KEY (orig_slug, dest_slug, day)
+);
+
+INSERT INTO lane_daily_stats (orig_code, dest_code, day, price_count, price_sum)
+    SELECT orig_code, dest_code, day, COUNT(*), SUM(price)
+        FROM prices
+        GROUP BY orig_code, dest_code, day;
+
+INSERT INTO region_daily_stats (orig_slug, dest_slug, day, price_count, price_sum)
+    SELECT orig.slug, dest.slug, stats.day, SUM(stats.price_count), SUM(stats.price_sum)
+        FROM lane_daily_stats AS stats
+        JOIN region_ports AS orig ON orig.code = stats.orig_code
+        JOIN region_ports AS dest ON dest.code = stats.dest_code
+        GROUP BY orig.slug, dest.slug, stats.day;
+
+UPDATE rates_meta SET stats_version = prices_version;
+
+ANALYZE lane_daily_stats;
+ANALYZE region_daily_stats;
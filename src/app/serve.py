@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Production entry point, `python -m app.serve`: one uvicorn worker process per CPU."""
+import os
+import tempfile
+
+import uvicorn
+
+from .api.pool import settings_from_env
+
+
+def worker_count():
+    """
+    :return: int
+        `WEB_CONCURRENCY` if set, else the number of CPUs this process may run on.
+    """
+    value = os.getenv("WEB_CONCURRENCY")
+    if value:
+        return int(value)
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS
+        return os.cpu_count() or 1
+
+
+def split_sizes(workers):
+    """
+    Makes the pool and admission sizes host-wide: each of `workers` processes gets its
+    share of `DB_POOL_MIN_SIZE`, `DB_POOL_MAX_SIZE` (per database, replicas included),
+    `ADMISSION_EXPENSIVE_LIMIT` and `ADMISSION_MAX_QUEUE`, at least one, so that the
+    connections opened by the host stay under the server's `max_connections` whatever its CPU count.
+    :param workers: int
+    """
+    settings = settings_from_env()
+    max_size = settings["max_size"]
+    totals = {
+        "DB_POOL_MIN_SIZE": settings["min_size"],
+        "DB_POOL_MAX_SIZE": max_size,
+        # the default of `app.admission`, taken from the host-wide pool size
+        "ADMISSION_EXPENSIVE_LIMIT": int(os.getenv("ADMISSION_EXPENSIVE_LIMIT", "0")) or max(1, max_size // 2),
+        "ADMISSION_MAX_QUEUE": int(os.getenv("ADMISSION_MAX_QUEUE", "32")),
+    }
+    for name, total in totals.items():
+        # read by every worker, which inherit the environment
+        os.environ[name] = str(max(min(total, 1), total // workers))
+
+
+def _shared_path(name):
+    """Helper private function to place a file shared by the workers on a tmpfs when there is one."""
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, f"{name}-{os.getuid()}")
+
+
+def shared_cache_path():
+    """
+    Where the workers share their cache tier.
+    :return: str
+    """
+    return _shared_path("rates-cache") + ".sqlite3"
+
+
+def snapshot_path():
+    """
+    Where the workers map the snapshot of the in-memory engine from.
+    :return: str
+    """
+    return _shared_path("rates-snapshot") + ".bin"
+
+
+def main():
+    workers = worker_count()
+    split_sizes(workers)
+    if workers > 1:
+        # read by `app.shared_cache` in every worker, which inherit the environment
+        path = os.environ.setdefault("SHARED_CACHE_PATH", shared_cache_path())
+        # entries of a former deployment may not decode the same way
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    if os.getenv("RATES_BACKEND") == "memory":
+        # kept across restarts: a snapshot of the current prices version is mapped as is
+        os.environ.setdefault("RATES_SNAPSHOT_PATH", snapshot_path())
+
+    # on SIGTERM/SIGINT each worker stops accepting connections, finishes the requests
+    # in flight, then runs the app's `shutdown` handler, closing the connection pool
+    uvicorn.run(
+        "app.main:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        workers=workers,
+        proxy_headers=True,
+        log_level=os.getenv("LOG_LEVEL", "info"),
+        access_log=os.getenv("ACCESS_LOG", "0") == "1",
+    )
+
+
+if __name__ == "__main__":
+    main()
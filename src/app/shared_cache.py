@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""Cache tier shared by the worker processes of one host, kept in SQLite on a tmpfs (`/dev/shm`)."""
+import logging
+import os
+import sqlite3
+import time
+
+
+CREATE_TABLE = """
+    CREATE TABLE IF NOT EXISTS entries (
+        key TEXT PRIMARY KEY,
+        value BLOB NOT NULL,
+        expires_at REAL NOT NULL
+    ) WITHOUT ROWID
+"""
+
+
+log = logging.getLogger("app.shared_cache")
+
+
+class SharedCache:
+    """
+    Bytes by string key with a TTL, visible to every process opening the same file.
+
+    Each worker keeps its own in-process caches in front of it: this tier only
+    saves the others from recomputing (or querying) what one of them already did.
+    The file lives on a tmpfs, so reads and writes are memory copies and a lookup
+    costs a few microseconds, cheap enough to run on the event loop.
+    Lookups and puts never wait for another worker's write lock: they are best-effort,
+    a busy or failing file is a miss (or a skipped put) and the value is recomputed.
+    Writes past `maxsize` entries first drop the expired ones, then the closest to expiry.
+    """
+
+    # puts between two evictions
+    PRUNE_EVERY = 256
+    # seconds deletions, which must not be skipped, wait for the write lock
+    LOCK_WAIT = 1.0
+
+    def __init__(self, path, maxsize=65536, ttl=60.0):
+        """
+        :param path: str, Eg: "/dev/shm/rates-cache.sqlite3"
+        :param maxsize: int, entries kept
+        :param ttl: float, default seconds an entry stays valid
+        """
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._conn = None
+        self._puts = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _get_conn(self):
+        """Helper private function to open the file once per process (after the workers forked)."""
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.LOCK_WAIT, isolation_level=None, check_same_thread=False)
+            try:
+                conn.execute("PRAGMA journal_mode=WAL")
+                # entries can be recomputed, durability is not needed
+                conn.execute("PRAGMA synchronous=OFF")
+                conn.execute(CREATE_TABLE)
+                # from now on a locked file fails right away instead of blocking the event loop
+                conn.execute("PRAGMA busy_timeout = 0")
+            except sqlite3.Error:
+                conn.close()
+                raise
+            self._conn = conn
+        return self._conn
+
+    def _failed(self, error):
+        """Helper private function to count and log an operation given up on."""
+        self.errors += 1
+        log.warning("shared cache %s: %s", self.path, error)
+
+    def get(self, key):
+        """
+        :param key: str
+        :return: bytes, or None on a miss/expired entry, or if the file could not be read.
+        """
+        try:
+            row = self._get_conn().execute(
+                "SELECT value FROM entries WHERE key = ? AND expires_at > ?", (key, time.time())
+            ).fetchone()
+        except sqlite3.Error as error:
+            self._failed(error)
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, value, ttl=None):
+        """
+        :param key: str
+        :param value: bytes
+        :param ttl: float or None for the default `ttl`
+        """
+        try:
+            conn = self._get_conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + (self.ttl if ttl is None else ttl)),
+            )
+            self._puts += 1
+            if self._puts % self.PRUNE_EVERY == 0:
+                self._prune(conn)
+        except sqlite3.Error as error:
+            # another worker holds the write lock, the entry is simply not shared
+            self._failed(error)
+
+    def _prune(self, conn):
+        """Helper private function to bound the entries to `maxsize`."""
+        conn.execute("DELETE FROM entries WHERE expires_at <= ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM entries WHERE key IN ("
+            "SELECT key FROM entries ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.maxsize,),
+        )
+
+    def _execute_waiting(self, query, *args):
+        """Helper private function to run a write that must not be skipped, waiting up to `LOCK_WAIT` for the lock."""
+        conn = self._get_conn()
+        conn.execute(f"PRAGMA busy_timeout = {int(self.LOCK_WAIT * 1000)}")
+        try:
+            conn.execute(query, args)
+        finally:
+            conn.execute("PRAGMA busy_timeout = 0")
+
+    def delete(self, key):
+        """Drops one entry, in every process."""
+        self._execute_waiting("DELETE FROM entries WHERE key = ?", key)
+
+    def invalidate(self):
+        """Drops every entry, in every process."""
+        self._execute_waiting("DELETE FROM entries")
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def stats(self):
+        """
+        :return: dict
+            Entries in the file and this process' hit/miss counters.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "path": self.path,
+            "size": self._get_conn().execute("SELECT COUNT(*) FROM entries").fetchone()[0],
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# disabled unless a path is given, Eg: by `python -m app.serve`
+shared_cache = SharedCache(
+    os.getenv("SHARED_CACHE_PATH"),
+    maxsize=int(os.getenv("SHARED_CACHE_SIZE", "65536")),
+    ttl=float(os.getenv("SHARED_CACHE_TTL", "300")),
+) if os.getenv("SHARED_CACHE_PATH") else None
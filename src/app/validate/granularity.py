@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""Validates the time buckets `/rates` aggregates prices over before sending them to DB."""
+import re
+
+
+# widest custom bucket, Eg: "366d"
+MAX_BUCKET_DAYS = 366
+
+
+def validate(granularity):
+    """
+    Validates whether `granularity` is one of:
+        1. "day", "week" (calendar weeks, starting on Monday) or "month" (calendar months)
+        2. "<N>d", buckets of N days starting at `date_from`, 1 <= N <= `MAX_BUCKET_DAYS`
+    :param granularity: str
+        Eg: "week", "14d"
+    :return: str
+        the canonical spelling ("1d" is "day", "07d" is "7d"), or "f_granularity_wrong"
+    """
+    granularity = str(granularity).strip().lower()
+    if granularity in ("day", "week", "month"):
+        return granularity
+
+    match = re.fullmatch(r"(\d{1,4})d", granularity)
+    if match is None or not 1 <= int(match.group(1)) <= MAX_BUCKET_DAYS:
+        return "f_granularity_wrong"
+    days = int(match.group(1))
+    return "day" if days == 1 else f"{days}d"
+
+
+def bucket_of(granularity):
+    """
+    :param granularity: str as returned by `validate`
+    :return: tuple[str, int]
+        The unit ("day", "week", "month" or "days") and the days per bucket of "days"
+        (1 for the others), the way the bucketed statements take them.
+    """
+    if granularity.endswith("d") and granularity[:-1].isdigit():
+        return "days", int(granularity[:-1])
+    return granularity, 1
@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
 """Validate result from DB and format it apt. before sending."""
+import json
 from datetime import timedelta, date
 
+import msgpack
+import numpy as np
+
+from .granularity import bucket_of
+
 
 # borrowed from https://stackoverflow.com/a/1060330/13170092
 def _daterange(start_date, end_date):
@@ -10,32 +16,297 @@ def _daterange(start_date, end_date):
         yield start_date + timedelta(n)
 
 
-def validate(data, date_from, date_to):
+def day_axis(date_from, date_to):
+    """
+    :param date_from: str in format "YYYY-MM-DD"
+    :param date_to: str in format "YYYY-MM-DD"
+    :return: numpy.ndarray of the `datetime64[D]` days of [`date_from`, `date_to`]
+    """
+    return np.arange(
+        np.datetime64(date_from, "D"), np.datetime64(date_to, "D") + 1, dtype="datetime64[D]"
+    )
+
+
+def bucket_starts(date_from, date_to, granularity="day"):
+    """
+    :param date_from: str in format "YYYY-MM-DD"
+    :param date_to: str in format "YYYY-MM-DD"
+    :param granularity: str as returned by `granularity.validate`
+    :return: numpy.ndarray
+        Offsets from `date_from` of the first day of each bucket, in order and starting at 0:
+        the first week or month is cut at `date_from`, N-day buckets start from it.
+    """
+    days = day_axis(date_from, date_to)
+    unit, step = bucket_of(granularity)
+    if unit == "day":
+        return np.arange(len(days))
+    if unit == "days":
+        return np.arange(0, len(days), step)
+    if unit == "week":
+        # 1970-01-01, day 0, was a Thursday
+        firsts = (days.astype(np.int64) + 3) % 7 == 0
+    else:
+        firsts = days == days.astype("datetime64[M]").astype("datetime64[D]")
+    firsts[0] = True
+    return np.flatnonzero(firsts)
+
+
+def bucket_axis(date_from, date_to, granularity="day"):
+    """
+    :return: numpy.ndarray of the `datetime64[D]` first day of each bucket of `bucket_starts`
+    """
+    return day_axis(date_from, date_to)[bucket_starts(date_from, date_to, granularity)]
+
+
+def to_arrays(data, date_from, date_to, granularity="day"):
+    """
+    Vectorized core of `validate`: lays the rows out on the full day (or bucket) axis.
+    :param data: List[asyncpg.Record]
+        Rows with keys "days", "average_price" and "day", in any order, days may be missing.
+        With a `granularity` other than "day", one row per bucket, "day" being its first
+        day and "days" the prices of the whole bucket.
+    :param date_from: str in format "YYYY-MM-DD"
+    :param date_to: str in format "YYYY-MM-DD"
+    :param granularity: str as returned by `granularity.validate`
+    :return: tuple[numpy.ndarray, numpy.ndarray]
+        `datetime64[D]` days of [`date_from`, `date_to`] (first days of its buckets) and the
+        float64 rounded average price of each, NaN where there are not enough prices (or none).
+    """
+    iso_date_from = date.fromisoformat(date_from)
+    starts = bucket_starts(date_from, date_to, granularity)
+    days = day_axis(date_from, date_to)[starts]
+    n_days = (date.fromisoformat(date_to) - iso_date_from).days + 1
+    prices = np.full(len(days), np.nan)
+
+    if len(data):
+        # ordinals and plain floats convert far faster than dates/Decimals would
+        offsets = np.fromiter(
+            (single_data["day"].toordinal() for single_data in data), dtype=np.int64, count=len(data)
+        ) - iso_date_from.toordinal()
+        counts = np.fromiter(
+            (single_data["days"] for single_data in data), dtype=np.int64, count=len(data)
+        )
+        # days without prices have no average, they are masked out by `counts` below
+        averages = np.fromiter(
+            (float(single_data["average_price"] or 0) for single_data in data), dtype=np.float64, count=len(data)
+        )
+
+        # statistical condition: more than 2 prices (in the bucket), on a day of the requested range
+        keep = (counts > 2) & (offsets >= 0) & (offsets < n_days)
+        slots = offsets if granularity == "day" else np.searchsorted(starts, offsets, side="right") - 1
+        # rint rounds half to even, like `round` did on the Decimal averages
+        prices[slots[keep]] = np.rint(averages[keep])
+
+    return days, prices
+
+
+def validate(data, date_from, date_to, granularity="day"):
     """
     Validates result to conform to the expected format.
     :param data: List[asyncpg.Record]
         Result that is received from successful execution of the query.
+        Days missing from it are filled in (see `to_arrays`).
     :param date_to: str in format "YYYY-MM-DD"
     :param date_from: str in format "YYYY-MM-DD"
+    :param granularity: str as returned by `granularity.validate`
     :return: List[dict]
         Each element has two keys:
-            "day": (str) representing day between `date_from` and `date_to` for which average was calculated.
+            "day": (str) representing day between `date_from` and `date_to` for which average was calculated,
+                   or the first day of the bucket with a `granularity` other than "day".
             "average_price": (None|int) averaged price, rounded to the nearest integer.
                              If statistical condition (less than 2 datapoint) or no transaction in database
-                             then returns None for that date.
+                             then returns None for that date (bucket).
     """
-    iso_date_from = date.fromisoformat(date_from)
-    iso_date_to = date.fromisoformat(date_to)
+    days, prices = to_arrays(data, date_from, date_to, granularity)
 
-    data_price_dict = {}
-    for single_data in data:
-        if single_data["days"] > 2:
-            data_price_dict[single_data["day"]] = round(single_data["average_price"])
+    missing = np.isnan(prices)
+    average_prices = np.where(missing, 0, prices).astype(np.int64).astype(object)
+    average_prices[missing] = None
 
     return [
-        {
-            "day": curr_date.strftime("%Y-%m-%d"),
-            "average_price": data_price_dict.get(curr_date)
-        }
-        for curr_date in _daterange(iso_date_from, iso_date_to)
+        {"day": day, "average_price": average_price}
+        for day, average_price in zip(np.datetime_as_string(days).tolist(), average_prices.tolist())
     ]
+
+
+def encode_json(days, prices):
+    """
+    Encodes the output of `to_arrays` straight to the JSON bytes of `validate`'s
+    result, without building the intermediate list of dicts.
+    :param days: numpy.ndarray of datetime64[D]
+    :param prices: numpy.ndarray of float64, NaN for None
+    :return: bytes
+        Eg: b'[{"day":"2016-01-01","average_price":1112},{"day":"2016-01-02","average_price":null}]'
+    """
+    missing = np.isnan(prices)
+    average_prices = np.where(missing, 0, prices).astype(np.int64).astype(str).astype(object)
+    average_prices[missing] = "null"
+
+    return ("[" + ",".join([
+        '{"day":"%s","average_price":%s}' % pair
+        for pair in zip(np.datetime_as_string(days).tolist(), average_prices.tolist())
+    ]) + "]").encode()
+
+
+COLUMNAR_MEDIA_TYPES = ("application/vnd.rates.columnar+json", "application/msgpack")
+
+
+def encode_columnar(days, prices, media_type):
+    """
+    Encodes the output of `to_arrays` as one dense column instead of one object per day:
+    the day of the i-th price is `date_from` + i days.
+    :param days: numpy.ndarray of datetime64[D]
+    :param prices: numpy.ndarray of float64, NaN for None
+    :param media_type: str, one of `COLUMNAR_MEDIA_TYPES`
+    :return: bytes
+        Eg: b'{"date_from":"2016-01-01","date_to":"2016-01-03","average_price":[1112,null,1098]}'
+        as JSON, or the same map as MessagePack.
+    """
+    date_from, date_to = np.datetime_as_string(days[[0, -1]]).tolist()
+    missing = np.isnan(prices)
+
+    if media_type == "application/msgpack":
+        average_prices = np.where(missing, 0, prices).astype(np.int64).astype(object)
+        average_prices[missing] = None
+        return msgpack.packb({
+            "date_from": date_from,
+            "date_to": date_to,
+            "average_price": average_prices.tolist(),
+        })
+
+    average_prices = np.where(missing, 0, prices).astype(np.int64).astype(str).astype(object)
+    average_prices[missing] = "null"
+    return ('{"date_from":"%s","date_to":"%s","average_price":[%s]}' % (
+        date_from, date_to, ",".join(average_prices.tolist())
+    )).encode()
+
+
+def to_matrix(data, origins, destinations, date_from, date_to, collapse=False):
+    """
+    Lays the rows of `sql.execute_matrix` out densely, lanes and days without prices being 0.
+    :param data: List[asyncpg.Record]
+        Rows with keys "orig_code", "dest_code", ("day" unless `collapse`), "price_count", "price_sum".
+    :param origins: List[str] port codes, the first axis in this order
+    :param destinations: List[str] port codes, the second axis in this order
+    :param date_from: str in format "YYYY-MM-DD"
+    :param date_to: str in format "YYYY-MM-DD"
+    :param collapse: bool, whether the rows are per lane over the whole range
+    :return: tuple[numpy.ndarray, numpy.ndarray]
+        counts and sums shaped (origins, destinations[, days]).
+    """
+    n_days = (date.fromisoformat(date_to) - date.fromisoformat(date_from)).days + 1
+    shape = (len(origins), len(destinations)) + (() if collapse else (n_days,))
+    counts = np.zeros(shape, dtype=np.int64)
+    sums = np.zeros(shape, dtype=np.int64)
+    if not len(data):
+        return counts, sums
+
+    orig_index = {code: index for index, code in enumerate(origins)}
+    dest_index = {code: index for index, code in enumerate(destinations)}
+    cells = (
+        np.fromiter((orig_index[row["orig_code"]] for row in data), dtype=np.int64, count=len(data)),
+        np.fromiter((dest_index[row["dest_code"]] for row in data), dtype=np.int64, count=len(data)),
+    )
+    if not collapse:
+        first = date.fromisoformat(date_from).toordinal()
+        cells += (np.fromiter((row["day"].toordinal() - first for row in data), dtype=np.int64, count=len(data)),)
+    # one row per cell, as the statements group by it
+    counts[cells] = np.fromiter((row["price_count"] for row in data), dtype=np.int64, count=len(data))
+    sums[cells] = np.fromiter((row["price_sum"] for row in data), dtype=np.int64, count=len(data))
+    return counts, sums
+
+
+def matrix_prices(counts, sums):
+    """
+    :param counts: numpy.ndarray as returned by `to_matrix`
+    :param sums: numpy.ndarray as returned by `to_matrix`
+    :return: numpy.ndarray of float64 rounded averages, NaN where there are not
+        enough prices (or none), like `to_arrays`.
+    """
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 2, np.rint(sums / counts), np.nan)
+
+
+def encode_matrix(origins, destinations, date_from, date_to, prices, media_type):
+    """
+    Encodes the output of `matrix_prices` with its axes.
+    :param origins: List[str]
+    :param destinations: List[str]
+    :param date_from: str in format "YYYY-MM-DD"
+    :param date_to: str in format "YYYY-MM-DD"
+    :param prices: numpy.ndarray shaped (origins, destinations[, days])
+    :param media_type: str, "application/msgpack" or else JSON
+    :return: bytes
+        JSON {"date_from", "date_to", "origins", "destinations", "average_price"}, the prices
+        nested as [origin][destination]([day]) with null for None. As MessagePack, the same
+        map with "shape", "dtype" ("<f4") and the prices as the raw little-endian float32
+        values in row-major order, NaN for None, Eg: for `numpy.frombuffer(...).reshape(shape)`.
+    """
+    axes = {"date_from": date_from, "date_to": date_to, "origins": list(origins), "destinations": list(destinations)}
+
+    if media_type == "application/msgpack":
+        # prices are integers well below 2**24, exact in float32
+        return msgpack.packb({
+            **axes,
+            "shape": list(prices.shape),
+            "dtype": "<f4",
+            "average_price": prices.astype("<f4").tobytes(),
+        })
+
+    missing = np.isnan(prices)
+    average_prices = np.where(missing, 0, prices).astype(np.int64).astype(object)
+    average_prices[missing] = None
+    return json.dumps({**axes, "average_price": average_prices.tolist()}, separators=(",", ":")).encode()
+
+
+STREAM_MEDIA_TYPES = ("application/x-ndjson", "text/csv")
+
+
+def _encode_line(day, average_price, media_type):
+    """Helper private function to encode one day as a NDJSON or CSV line."""
+    if media_type == "text/csv":
+        return f"{day},{'' if average_price is None else average_price}\n"
+    return f'{{"day": "{day}", "average_price": {"null" if average_price is None else average_price}}}\n'
+
+
+async def stream(rows, date_from, date_to, media_type, chunk_rows=512, granularity="day"):
+    """
+    Streaming counterpart of `validate`: encodes rows as they arrive and fills
+    missing days on the way, so memory does not grow with the date range.
+    Bucketed rows (a `granularity` other than "day") come one per bucket, none missing.
+    :param rows: AsyncIterable of rows ordered by day, Eg: an asyncpg cursor
+    :param date_from: str in format "YYYY-MM-DD"
+    :param date_to: str in format "YYYY-MM-DD"
+    :param media_type: str, one of `STREAM_MEDIA_TYPES`
+    :param chunk_rows: int, number of days encoded per yielded chunk
+    :param granularity: str as returned by `granularity.validate`
+    :return: AsyncIterator[bytes]
+        NDJSON lines like `{"day": ..., "average_price": ...}`, or CSV with a
+        `day,average_price` header and an empty price where `validate` gives None.
+    """
+    expected = date.fromisoformat(date_from)
+    iso_date_to = date.fromisoformat(date_to)
+
+    lines = ["day,average_price\n"] if media_type == "text/csv" else []
+    async for single_data in rows:
+        day = single_data["day"]
+        if day < expected or day > iso_date_to:
+            continue
+        if granularity == "day":
+            for missing in _daterange(expected, day - timedelta(1)):
+                lines.append(_encode_line(missing.strftime("%Y-%m-%d"), None, media_type))
+        average_price = round(single_data["average_price"]) if single_data["days"] > 2 else None
+        lines.append(_encode_line(day.strftime("%Y-%m-%d"), average_price, media_type))
+        expected = day + timedelta(1)
+
+        if len(lines) >= chunk_rows:
+            yield "".join(lines).encode()
+            lines = []
+
+    for missing in _daterange(expected, iso_date_to) if granularity == "day" else ():
+        lines.append(_encode_line(missing.strftime("%Y-%m-%d"), None, media_type))
+        if len(lines) >= chunk_rows:
+            yield "".join(lines).encode()
+            lines = []
+    if lines:
+        yield "".join(lines).encode()
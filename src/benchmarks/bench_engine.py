@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Latency of the in-memory rates engine (`RATES_BACKEND=memory`) per query shape and
+for a region-by-region matrix, on synthetic aggregates shaped like `lane_daily_stats`,
+and the time to write and map back its snapshot, which is what a worker's startup costs.
+
+Needs no database. Run from `src/` with
+`python -m benchmarks.bench_engine [lanes_per_port] [days] [repeat]`.
+"""
+import json
+import os
+import sys
+import tempfile
+import timeit
+from datetime import date
+
+import numpy as np
+
+from app.api import snapshot
+from app.api.engine import PriceEngine
+
+
+def main(lanes_per_port, days, repeat):
+    rng = np.random.default_rng(0)
+    codes = np.array([f"P{index:04d}" for index in range(1000)], dtype=object)
+    orig = np.repeat(np.arange(len(codes)), lanes_per_port)
+    dest = rng.integers(0, len(codes), size=orig.size)
+    # every lane priced on every day
+    orig, dest = np.repeat(orig, days), np.repeat(dest, days)
+    day = np.tile(np.arange(days) + date(2016, 1, 1).toordinal(), len(codes) * lanes_per_port)
+
+    engine = PriceEngine()
+    started = timeit.default_timer()
+    engine.build(codes[orig], codes[dest], day, np.full(day.size, 4), rng.integers(4000, 12000, size=day.size))
+    report = {"rows": len(engine), "build_s": round(timeit.default_timer() - started, 3)}
+
+    hot = (engine.ids_of([codes[orig[0]]]), engine.ids_of([codes[dest[0]]]))
+    region = engine.ids_of(codes[:50])
+    shapes = {
+        "port_port_31d": (*hot, "2016-01-01", "2016-01-31"),
+        "port_port_365d": (*hot, "2016-01-01", "2016-12-31"),
+        "region_port_31d": (region, hot[1], "2016-01-01", "2016-01-31"),
+        "region_region_31d": (region, engine.ids_of(codes[500:550]), "2016-01-01", "2016-01-31"),
+    }
+    for name, args in shapes.items():
+        seconds = min(timeit.repeat(lambda: engine.arrays(*args), number=100, repeat=repeat)) / 100
+        report[f"{name}_ms"] = round(seconds * 1000, 4)
+
+    # `/rates/matrix` of two 50-port regions
+    matrix = (list(codes[:50]), list(codes[500:550]), "2016-01-01", "2016-01-31")
+    for name, collapse in (("matrix_50x50_31d", False), ("matrix_50x50_collapsed", True)):
+        seconds = min(timeit.repeat(lambda: engine.matrix(*matrix, collapse), number=20, repeat=repeat)) / 20
+        report[f"{name}_ms"] = round(seconds * 1000, 4)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "snapshot.bin")
+        started = timeit.default_timer()
+        snapshot.write(path, engine, [], [])
+        report["snapshot_write_s"] = round(timeit.default_timer() - started, 3)
+        report["snapshot_mb"] = round(os.path.getsize(path) / 2 ** 20, 1)
+        started = timeit.default_timer()
+        snapshot.Snapshot(path).attach(PriceEngine())
+        report["snapshot_map_ms"] = round((timeit.default_timer() - started) * 1000, 3)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    arguments = [int(value) for value in sys.argv[1:]]
+    main(*(arguments + [20, 365, 5][len(arguments):]))
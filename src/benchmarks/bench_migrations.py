@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Per-query-shape latency before and after applying the index migrations in
+`app/migrations` (indexes on `prices` and `ports`, up to `INDEX_MIGRATIONS`).
+
+Run from `src/` against a freshly seeded database (migrations not applied yet)
+with `python -m benchmarks.bench_migrations [n]`. It measures every shape,
+applies the pending index migrations, and measures again on the same workload.
+The daily statistics (0004) are left out: the queries would read them instead
+of `prices`, and "after" would no longer measure the indexes alone.
+"""
+import asyncio
+import json
+import sys
+import time
+
+import asyncpg
+
+from app.api import sql
+from app.api.regions import region_index
+from app.api.stats import stats_state
+from app.migrate import applied_versions, apply_migrations
+from .common import database_url, sample_workload, summarize
+
+
+SHAPES = {
+    "port_port": lambda conn, f, t, o, d: sql.execute_when_both_ports(conn, o, d, f, t),
+    "port_region": lambda conn, f, t, o, d: sql.execute_when_one_region(conn, o, d, f, t, False),
+    "region_region": lambda conn, f, t, o, d: sql.execute_when_both_region(conn, o, d, f, t),
+}
+
+# last migration adding an index, the ones after it change what the queries read
+INDEX_MIGRATIONS = 3
+
+
+async def _measure(conn, workload):
+    report = {}
+    for shape, calls in workload.items():
+        samples = []
+        for args in calls:
+            started = time.perf_counter()
+            await SHAPES[shape](conn, *args)
+            samples.append(time.perf_counter() - started)
+        report[shape] = summarize(samples)
+    return report
+
+
+async def main(n):
+    conn = await asyncpg.connect(database_url())
+    try:
+        if await applied_versions(conn):
+            # with 0004 applied, both runs may read the statistics instead of `prices`
+            print("warning: some migrations are already applied, 'before' is not a clean baseline",
+                  file=sys.stderr)
+        workload = await sample_workload(conn, n)
+        await region_index.refresh(conn)
+
+        # the queries decide between raw prices and the statistics on what they last read
+        stats_state.invalidate()
+        before = await _measure(conn, workload)
+        # creating an index invalidates the plans Postgres cached for the table
+        applied = await apply_migrations(conn, up_to=INDEX_MIGRATIONS)
+        stats_state.invalidate()
+        after = await _measure(conn, workload)
+    finally:
+        await conn.close()
+
+    print(json.dumps({"applied": applied, "before": before, "after": after}, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 300))
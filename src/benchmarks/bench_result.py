@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of `result.validate` (NumPy day axis) against the former
+per-day Python loop, for ranges from 10 days up to 10 years.
+
+Needs no database: rows are synthesized like asyncpg returns them (one row
+per day with a Decimal average, some days too thin to be reported).
+Run from `src/` with `python -m benchmarks.bench_result [repeat]`.
+"""
+import json
+import random
+import sys
+import timeit
+from datetime import date, timedelta
+from decimal import Decimal
+
+from app.validate import result
+
+
+def _legacy_validate(data, date_from, date_to):
+    """`result.validate` as it was before the vectorized path."""
+    iso_date_from = date.fromisoformat(date_from)
+    iso_date_to = date.fromisoformat(date_to)
+
+    data_price_dict = {}
+    for single_data in data:
+        if single_data["days"] > 2:
+            data_price_dict[single_data["day"]] = round(single_data["average_price"])
+
+    return [
+        {
+            "day": curr_date.strftime("%Y-%m-%d"),
+            "average_price": data_price_dict.get(curr_date)
+        }
+        for curr_date in result._daterange(iso_date_from, iso_date_to)
+    ]
+
+
+def _rows(start, days, rng):
+    return [
+        {
+            "days": rng.randint(0, 6),
+            "average_price": Decimal(rng.randint(100000, 300000)) / 100,
+            "day": start + timedelta(offset),
+        }
+        for offset in range(days)
+    ]
+
+
+def main(repeat):
+    rng = random.Random(0)
+    start = date(2016, 1, 1)
+    report = {}
+    for days in (10, 100, 365, 3650):
+        rows = _rows(start, days, rng)
+        date_from = start.isoformat()
+        date_to = (start + timedelta(days - 1)).isoformat()
+        assert result.validate(rows, date_from, date_to) == _legacy_validate(rows, date_from, date_to)
+
+        legacy = min(timeit.repeat(lambda: _legacy_validate(rows, date_from, date_to), number=20, repeat=repeat)) / 20
+        vectorized = min(timeit.repeat(lambda: result.validate(rows, date_from, date_to), number=20, repeat=repeat)) / 20
+        report[f"{days}_days"] = {
+            "legacy_ms": round(legacy * 1000, 3),
+            "vectorized_ms": round(vectorized * 1000, 3),
+            "speedup": round(legacy / vectorized, 2),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
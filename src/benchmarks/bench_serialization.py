@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Serialization micro-benchmark of a `/rates` body: the former path (dicts from
+`result.validate`, `jsonable_encoder`, then `json.dumps` as FastAPI's
+JSONResponse does) against `result.encode_json` writing bytes from the arrays.
+
+Needs no database. Run from `src/` with `python -m benchmarks.bench_serialization [repeat]`.
+"""
+import json
+import random
+import sys
+import timeit
+from datetime import date, timedelta
+
+from fastapi.encoders import jsonable_encoder
+
+from app.validate import result
+from .bench_result import _rows
+
+
+def _former(rows, date_from, date_to):
+    return json.dumps(
+        jsonable_encoder(result.validate(rows, date_from, date_to)),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def _current(rows, date_from, date_to):
+    return result.encode_json(*result.to_arrays(rows, date_from, date_to))
+
+
+def main(repeat):
+    rng = random.Random(0)
+    start = date(2016, 1, 1)
+    report = {}
+    for days in (10, 100, 365, 3650):
+        rows = _rows(start, days, rng)
+        date_from = start.isoformat()
+        date_to = (start + timedelta(days - 1)).isoformat()
+        assert _former(rows, date_from, date_to) == _current(rows, date_from, date_to)
+
+        former = min(timeit.repeat(lambda: _former(rows, date_from, date_to), number=20, repeat=repeat)) / 20
+        current = min(timeit.repeat(lambda: _current(rows, date_from, date_to), number=20, repeat=repeat)) / 20
+        report[f"{days}_days"] = {
+            "former_ms": round(former * 1000, 3),
+            "encode_json_ms": round(current * 1000, 3),
+            "speedup": round(former / current, 2),
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
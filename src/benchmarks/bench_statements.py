@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the parameterized statements in `app/api/sql.py` against
+the former per-request f-string queries, on the seeded `sql/rates.sql` data.
+
+Run from `src/` with `python -m benchmarks.bench_statements [n]`.
+It prints, per query shape, the statement-cache hit rate (1 - distinct
+statements prepared by the session / executions, read from
+`pg_prepared_statements`) and p50/p99 latency of both variants.
+"""
+import asyncio
+import json
+import sys
+import time
+
+import asyncpg
+
+from app.api import sql
+from app.api.regions import region_index
+from .common import database_url, sample_workload, summarize
+
+
+async def _legacy_slugs(conn, parent_slug):
+    data = await conn.fetch(
+        f"SELECT slug FROM Regions WHERE parent_slug='{parent_slug}'"
+    )
+    data = [i['slug'] for i in data]
+    data.append(parent_slug)
+    return '\', \''.join(data)
+
+
+async def _legacy_port_port(conn, date_from, date_to, origin, destination):
+    return await conn.fetch(
+        f"""
+        SELECT COUNT(*) AS days, AVG(price) AS average_price, day
+            FROM Prices
+            WHERE orig_code='{origin}' AND dest_code='{destination}' AND
+                  (day BETWEEN '{date_from}' AND '{date_to}')
+            GROUP BY day;
+        """
+    )
+
+
+async def _legacy_port_region(conn, date_from, date_to, origin, destination):
+    data = await _legacy_slugs(conn, destination)
+    return await conn.fetch(
+        f"""
+        SELECT COUNT(*) AS days, AVG(price) AS average_price, day
+            FROM Prices
+            WHERE orig_code='{origin}' AND
+                  dest_code IN (SELECT code FROM Ports WHERE parent_slug IN ('{data}')) AND
+                  (day BETWEEN '{date_from}' AND '{date_to}')
+            GROUP BY day ORDER BY day
+        """
+    )
+
+
+async def _legacy_region_region(conn, date_from, date_to, origin, destination):
+    data_origin = await _legacy_slugs(conn, origin)
+    data_dest = await _legacy_slugs(conn, destination)
+    return await conn.fetch(
+        f"""
+        SELECT COUNT(*) AS days, AVG(price) AS average_price, day
+            FROM Prices
+            WHERE orig_code IN (SELECT code FROM Ports WHERE parent_slug IN ('{data_origin}')) AND
+                  dest_code IN (SELECT code FROM Ports WHERE parent_slug IN ('{data_dest}')) AND
+                  (day BETWEEN '{date_from}' AND '{date_to}')
+            GROUP BY day ORDER BY day
+        """
+    )
+
+
+async def _current_port_port(conn, date_from, date_to, origin, destination):
+    return await sql.execute_when_both_ports(conn, origin, destination, date_from, date_to)
+
+
+async def _current_port_region(conn, date_from, date_to, origin, destination):
+    return await sql.execute_when_one_region(conn, origin, destination, date_from, date_to, False)
+
+
+async def _current_region_region(conn, date_from, date_to, origin, destination):
+    return await sql.execute_when_both_region(conn, origin, destination, date_from, date_to)
+
+
+VARIANTS = {
+    "legacy": {
+        "port_port": _legacy_port_port,
+        "port_region": _legacy_port_region,
+        "region_region": _legacy_region_region,
+    },
+    "parameterized": {
+        "port_port": _current_port_port,
+        "port_region": _current_port_region,
+        "region_region": _current_region_region,
+    },
+}
+
+# statements issued per call, to turn executions into a hit rate
+# (the parameterized variant resolves regions from the in-process index)
+STATEMENTS_PER_CALL = {
+    "legacy": {"port_port": 1, "port_region": 2, "region_region": 3},
+    "parameterized": {"port_port": 1, "port_region": 1, "region_region": 1},
+}
+
+
+async def _run_variant(dsn, variant, shape, workload):
+    """Runs one variant on its own fresh connection so the caches start cold."""
+    conn = await asyncpg.connect(dsn)
+    try:
+        samples = []
+        for args in workload:
+            started = time.perf_counter()
+            await VARIANTS[variant][shape](conn, *args)
+            samples.append(time.perf_counter() - started)
+        # minus one for this very statement, which asyncpg prepares as well
+        prepared = await conn.fetchval("SELECT COUNT(*) FROM pg_prepared_statements") - 1
+    finally:
+        await conn.close()
+
+    executions = len(workload) * STATEMENTS_PER_CALL[variant][shape]
+    return {
+        **summarize(samples),
+        "statements_prepared": prepared,
+        "cache_hit_rate": round(1 - prepared / executions, 4),
+    }
+
+
+async def main(n):
+    dsn = database_url()
+    conn = await asyncpg.connect(dsn)
+    try:
+        workload = await sample_workload(conn, n)
+        # loaded up front, like the app does at startup
+        await region_index.refresh(conn)
+    finally:
+        await conn.close()
+
+    report = {}
+    for shape, calls in workload.items():
+        report[shape] = {
+            variant: await _run_variant(dsn, variant, shape, calls)
+            for variant in VARIANTS
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 500))
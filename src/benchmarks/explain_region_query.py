@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+EXPLAIN ANALYZE comparison of the region-to-region lookup on the seeded
+`sql/rates.sql` data:
+    legacy:    two slug lookups, then prices filtered by `IN (SELECT code FROM Ports ...)`
+    recursive: `RATES_BOTH_REGION_RECURSIVE`, hierarchy + day series in one statement
+    indexed:   `RATES_BOTH_REGION` with port codes from the in-process region index
+
+Run from `src/` with `python -m benchmarks.explain_region_query [origin destination date_from date_to]`.
+Prints the round-trips, planning and execution time of each variant, followed
+by the plan of the single-statement variants.
+"""
+import asyncio
+import json
+import sys
+from datetime import date
+
+import asyncpg
+
+from app.api import sql
+from app.api.regions import RegionIndex
+from .common import database_url
+
+
+LEGACY_SLUGS = "SELECT slug FROM Regions WHERE parent_slug = $1"
+
+LEGACY_RATES = """
+    SELECT COUNT(*) AS days, AVG(price) AS average_price, day
+        FROM Prices
+        WHERE orig_code IN (SELECT code FROM Ports WHERE parent_slug = ANY($1::text[])) AND
+              dest_code IN (SELECT code FROM Ports WHERE parent_slug = ANY($2::text[])) AND
+              (day BETWEEN $3::date AND $4::date)
+        GROUP BY day ORDER BY day
+"""
+
+
+async def _explain(conn, query, *args):
+    """Runs EXPLAIN (ANALYZE, BUFFERS) and returns the top-level JSON plan."""
+    plan = await conn.fetchval(
+        "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query, *args
+    )
+    return json.loads(plan)[0]
+
+
+def _timings(plans):
+    return {
+        "round_trips": len(plans),
+        "planning_ms": round(sum(p["Planning Time"] for p in plans), 3),
+        "execution_ms": round(sum(p["Execution Time"] for p in plans), 3),
+    }
+
+
+async def main(origin, destination, date_from, date_to):
+    conn = await asyncpg.connect(database_url())
+    try:
+        args = (date.fromisoformat(date_from), date.fromisoformat(date_to))
+
+        legacy_plans = [
+            await _explain(conn, LEGACY_SLUGS, origin),
+            await _explain(conn, LEGACY_SLUGS, destination),
+        ]
+        data_origin = [r["slug"] for r in await conn.fetch(LEGACY_SLUGS, origin)] + [origin]
+        data_dest = [r["slug"] for r in await conn.fetch(LEGACY_SLUGS, destination)] + [destination]
+        legacy_plans.append(await _explain(conn, LEGACY_RATES, data_origin, data_dest, *args))
+
+        recursive_plan = await _explain(conn, sql.RATES_BOTH_REGION_RECURSIVE, origin, destination, *args)
+
+        index = RegionIndex()
+        await index.refresh(conn)
+        indexed_plan = await _explain(
+            conn, sql.RATES_BOTH_REGION, index.ports_of(origin), index.ports_of(destination), *args
+        )
+    finally:
+        await conn.close()
+
+    print(json.dumps({
+        "query": [origin, destination, date_from, date_to],
+        "legacy": _timings(legacy_plans),
+        "recursive": _timings([recursive_plan]),
+        "indexed": _timings([indexed_plan]),
+    }, indent=2))
+    print(json.dumps({
+        "recursive_plan": recursive_plan["Plan"],
+        "indexed_plan": indexed_plan["Plan"],
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    cli_args = sys.argv[1:] or ["china_main", "northern_europe", "2016-01-01", "2016-01-31"]
+    asyncio.run(main(*cli_args))
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic prices at a multiple of the current volume, to see how query plans
+and caches behave at 10x, 100x, 1000x the `sql/rates.sql` dump.
+
+Lanes are drawn between the ports already in `ports`, with a Zipf-like
+popularity (a few busy lanes, a long tail of thin ones whose days often stay
+under the 3 prices needed for an average), weekdays busier than weekends and
+a per-lane base price drifting over the covered days. Rows are streamed to
+`COPY ... FROM STDIN` as CSV, then the daily statistics are rebuilt.
+
+Run from `src/` with `python -m benchmarks.generate --scale 10 [--truncate]`
+(`--scale` counts the rows already there; `--rows` asks for an exact number).
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from datetime import date
+
+import asyncpg
+import numpy as np
+
+from app.api.stats import refresh_stats
+from .common import database_url
+
+
+# relative volume of Monday..Sunday
+WEEKDAY_WEIGHTS = (1.0, 1.0, 1.0, 1.0, 0.9, 0.4, 0.3)
+
+
+def _lane_model(codes, rng, skew):
+    """
+    Helper private function to draw every lane's popularity and base price.
+    :param codes: List[str] port codes
+    :param rng: numpy.random.Generator
+    :param skew: float, Zipf exponent of lane popularity (0 is uniform)
+    :return: tuple[numpy.ndarray, ...] origin and destination indexes, probabilities, base prices
+    """
+    origins, destinations = np.meshgrid(np.arange(len(codes)), np.arange(len(codes)), indexing="ij")
+    keep = origins != destinations
+    origins, destinations = origins[keep], destinations[keep]
+
+    # popularity by rank, ranks shuffled over the lanes
+    weights = 1.0 / np.arange(1, origins.size + 1) ** skew
+    weights = rng.permutation(weights)
+    base_prices = rng.lognormal(mean=7.2, sigma=0.5, size=origins.size)
+    return origins, destinations, weights / weights.sum(), base_prices
+
+
+def _day_model(date_from, date_to):
+    """
+    Helper private function to get the covered days as CSV text with their probabilities.
+    :return: tuple[numpy.ndarray, numpy.ndarray]
+    """
+    ordinals = np.arange(date_from.toordinal(), date_to.toordinal() + 1)
+    labels = np.array([date.fromordinal(int(ordinal)).isoformat() for ordinal in ordinals], dtype=object)
+    weights = np.array([WEEKDAY_WEIGHTS[date.fromordinal(int(ordinal)).weekday()] for ordinal in ordinals])
+    return labels, weights / weights.sum()
+
+
+async def _csv_chunks(rows, chunk_rows, codes, lanes, days, rng):
+    """
+    Helper private function to produce the CSV body copied to `prices`, `chunk_rows` rows at a time.
+    :return: AsyncIterator[bytes]
+    """
+    origins, destinations, lane_probabilities, base_prices = lanes
+    day_labels, day_probabilities = days
+    codes = np.array(codes, dtype=object)
+
+    produced = 0
+    while produced < rows:
+        size = min(chunk_rows, rows - produced)
+        lane = rng.choice(origins.size, size=size, p=lane_probabilities)
+        day = rng.choice(day_labels.size, size=size, p=day_probabilities)
+        # +/-15% drift across the covered days, 8% noise around it
+        drift = 1 + 0.15 * np.sin(day / max(day_labels.size, 1) * np.pi * 2 + lane)
+        price = np.rint(base_prices[lane] * drift * rng.normal(1.0, 0.08, size=size)).astype(np.int64)
+        np.maximum(price, 1, out=price)
+
+        lines = map(",".join, zip(codes[origins[lane]], codes[destinations[lane]],
+                                  day_labels[day], price.astype(str)))
+        yield ("\n".join(lines) + "\n").encode()
+        produced += size
+        # the generation is CPU bound, let the COPY write what it has
+        await asyncio.sleep(0)
+
+
+async def generate(conn, rows, date_from, date_to, skew=1.1, seed=0, chunk_rows=500_000):
+    """
+    Appends `rows` synthetic prices between `date_from` and `date_to`.
+    :param conn: asyncpg.Connection object
+    :param rows: int
+    :param date_from: datetime.date
+    :param date_to: datetime.date
+    :param skew: float, Zipf exponent of lane popularity
+    :param seed: int, the same seed generates the same prices
+    :param chunk_rows: int, rows generated at once
+    :return: dict
+        Rows written, lanes drawn from, seconds and rows/sec.
+    """
+    rng = np.random.default_rng(seed)
+    codes = [record["code"] for record in await conn.fetch("SELECT code FROM ports ORDER BY code")]
+    lanes = _lane_model(codes, rng, skew)
+    days = _day_model(date_from, date_to)
+
+    started = time.perf_counter()
+    await conn.copy_to_table(
+        "prices",
+        source=_csv_chunks(rows, chunk_rows, codes, lanes, days, rng),
+        columns=("orig_code", "dest_code", "day", "price"),
+        format="csv",
+    )
+    seconds = time.perf_counter() - started
+    return {
+        "rows": rows,
+        "lanes": int(lanes[0].size),
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(rows / seconds) if seconds else 0,
+    }
+
+
+async def scale_to(conn, scale, truncate=False, **options):
+    """
+    Brings `prices` to `scale` times its current row count with synthetic rows over
+    the days it already covers, then rebuilds statistics and planner stats.
+    :param conn: asyncpg.Connection object
+    :param scale: float
+    :param truncate: bool, whether the existing rows are replaced instead of kept
+    :param options: passed to `generate`
+    :return: dict as returned by `generate`
+    :raise: SystemExit if `prices` is empty
+    """
+    bounds = await conn.fetchrow("SELECT COUNT(*) AS rows, MIN(day) AS lo, MAX(day) AS hi FROM prices")
+    if not bounds["rows"]:
+        # no volume to multiply nor days to cover
+        raise SystemExit("prices is empty: seed it first (sql/rates.sql), or give --rows with --date-from/--date-to")
+    rows = int(bounds["rows"] * scale) - (0 if truncate else bounds["rows"])
+    if truncate:
+        await conn.execute("TRUNCATE prices")
+    report = await generate(conn, max(rows, 0), bounds["lo"], bounds["hi"], **options)
+    await _refresh(conn)
+    return report
+
+
+async def _refresh(conn):
+    try:
+        await refresh_stats(conn)
+    except asyncpg.UndefinedTableError:
+        # migration 0004 not applied yet, the app builds them at startup
+        pass
+    await conn.execute("ANALYZE prices")
+
+
+async def _main(args):
+    conn = await asyncpg.connect(database_url())
+    try:
+        options = {"skew": args.skew, "seed": args.seed, "chunk_rows": args.chunk_rows}
+        if args.rows is None:
+            report = await scale_to(conn, args.scale, args.truncate, **options)
+        else:
+            if args.truncate:
+                await conn.execute("TRUNCATE prices")
+            report = await generate(conn, args.rows, date.fromisoformat(args.date_from),
+                                    date.fromisoformat(args.date_to), **options)
+            await _refresh(conn)
+    finally:
+        await conn.close()
+    print(json.dumps(report, indent=2))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.generate")
+    parser.add_argument("--scale", type=float, default=10.0, help="target multiple of the current row count")
+    parser.add_argument("--rows", type=int, help="exact number of rows to append instead of --scale")
+    parser.add_argument("--date-from", default="2016-01-01", help="first day, with --rows")
+    parser.add_argument("--date-to", default="2016-12-31", help="last day, with --rows")
+    parser.add_argument("--truncate", action="store_true", help="replace the existing prices")
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of lane popularity")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-rows", type=int, default=500_000)
+    asyncio.run(_main(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of `/rates` over HTTP: port->port, port->region and region->region
+mixes at several concurrency levels, reporting RPS and p50/p95/p99 latency.
+
+By default the app is started with uvicorn against `DATABASE_URL` (`--url`
+targets one already running instead); `--seed` first loads `sql/rates.sql`
+into an empty database with `psql`, and `--multiplier N` grows the prices N
+times with synthetic ones (see `benchmarks.generate`) before the run.
+`--cold` starts the app with its caches disabled; an app given by `--url` is
+sent `DELETE /rates/cache/` before each run instead, which empties the shared
+tier but the in-process caches of the one worker answering it only.
+Results are written as JSON, tagged with the git commit, so that two runs
+can be diffed with `python -m benchmarks.load compare a.json b.json`.
+
+Run from `src/` with `python -m benchmarks.load [--concurrency 1 8 32] [--duration 10] ...`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import asyncpg
+import httpx
+
+from .common import database_url, sample_workload, summarize
+from .generate import scale_to
+
+
+ROOT = Path(__file__).resolve().parents[2]
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+SHAPES = ("port_port", "port_region", "region_region")
+
+
+def git_revision():
+    """
+    :return: dict
+        Commit the benchmarked tree is at, and whether it had local changes.
+    """
+    def _git(*args):
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+
+    return {"commit": _git("rev-parse", "HEAD"), "dirty": bool(_git("status", "--porcelain", "--untracked-files=no"))}
+
+
+def seed(url):
+    """Loads `sql/rates.sql` into the (empty) database at `url`."""
+    subprocess.run(["psql", url, "-q", "-v", "ON_ERROR_STOP=1", "-f", str(ROOT / "sql" / "rates.sql")], check=True)
+
+
+def start_app(url, port, workers, cold=False):
+    """
+    Starts uvicorn serving the app and waits until `/health` answers.
+    :param cold: bool, start it without response, day and shared caches, in every worker
+    :return: subprocess.Popen
+    """
+    env = dict(os.environ, DATABASE_URL=url, APPLY_MIGRATIONS="1")
+    if cold:
+        # `DELETE /rates/cache/` would only reach the in-process caches of the worker answering it
+        env.update(RATES_CACHE_SIZE="0", DAY_CACHE_LANES="0")
+        env.pop("SHARED_CACHE_PATH", None)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=ROOT / "src",
+        env=env,
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"app exited with code {server.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health").status_code == 200:
+                return server
+        except httpx.TransportError:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise SystemExit("app did not become healthy within 60s")
+
+
+async def drive(client, queries, concurrency, duration, seed_=0):
+    """
+    Sends `/rates` requests drawn from `queries` from `concurrency` workers for `duration` seconds.
+    :param client: httpx.AsyncClient
+    :param queries: List[tuple] (date_from, date_to, origin, destination)
+    :return: dict
+        RPS, latency summary and count of non-200 answers.
+    """
+    latencies = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def _worker(index):
+        nonlocal errors
+        rng = random.Random(seed_ * 1000 + index)
+        while time.perf_counter() < deadline:
+            date_from, date_to, origin, destination = rng.choice(queries)
+            started = time.perf_counter()
+            response = await client.get("/rates", params={
+                "date_from": date_from,
+                "date_to": date_to,
+                "origin": origin,
+                "destination": destination,
+            })
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[_worker(index) for index in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return {
+        "rps": round(len(latencies) / elapsed, 1),
+        "errors": errors,
+        **summarize(latencies),
+    }
+
+
+async def run(args):
+    url = database_url()
+    conn = await asyncpg.connect(url)
+    try:
+        if args.multiplier > 1:
+            print(json.dumps(await scale_to(conn, args.multiplier)), file=sys.stderr)
+        workload = await sample_workload(conn, args.queries, seed=args.seed_rng)
+    finally:
+        await conn.close()
+
+    results = {}
+    limits = httpx.Limits(max_connections=max(args.concurrency))
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=60) as client:
+        for shape in args.shapes:
+            results[shape] = {}
+            for concurrency in args.concurrency:
+                # a short unrecorded run so connections and statements are warm
+                await drive(client, workload[shape], concurrency, min(1.0, args.duration))
+                if args.cold:
+                    # reaches the shared tier and the caches of one worker only, see `--cold`
+                    await client.delete("/rates/cache/")
+                results[shape][str(concurrency)] = await drive(
+                    client, workload[shape], concurrency, args.duration, args.seed_rng
+                )
+                print(shape, concurrency, json.dumps(results[shape][str(concurrency)]), file=sys.stderr)
+        pool_stats = (await client.get("/rates/pool_stats/")).json()
+    return results, pool_stats
+
+
+def compare(before_path, after_path):
+    """Prints, per shape and concurrency, the relative change of RPS and latency percentiles."""
+    before = json.loads(Path(before_path).read_text())
+    after = json.loads(Path(after_path).read_text())
+    report = {}
+    for shape, levels in after["results"].items():
+        for concurrency, current in levels.items():
+            former = before["results"].get(shape, {}).get(concurrency)
+            if former is None:
+                continue
+            report[f"{shape}@{concurrency}"] = {
+                key: f"{(current[key] - former[key]) / former[key] * 100:+.1f}%" if former[key] else None
+                for key in ("rps", "p50_ms", "p95_ms", "p99_ms")
+            }
+    print(json.dumps({
+        "before": before["git"]["commit"][:12],
+        "after": after["git"]["commit"][:12],
+        "changes": report,
+    }, indent=2))
+
+
+def main(argv):
+    if argv[:1] == ["compare"]:
+        if len(argv) != 3:
+            raise SystemExit("usage: python -m benchmarks.load compare <before.json> <after.json>")
+        return compare(argv[1], argv[2])
+
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.load")
+    parser.add_argument("--url", help="base URL of a running app (default: start one)")
+    parser.add_argument("--port", type=int, default=8765, help="port of the started app")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers of the started app")
+    parser.add_argument("--seed", action="store_true", help="load sql/rates.sql into an empty database first")
+    parser.add_argument("--multiplier", type=float, default=1, help="grow prices this many times first")
+    parser.add_argument("--shapes", nargs="+", choices=SHAPES, default=list(SHAPES))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per shape and concurrency")
+    parser.add_argument("--queries", type=int, default=200, help="distinct queries per shape")
+    parser.add_argument("--cold", action="store_true",
+                        help="start the app without caches; with --url, empty them before each run "
+                             "(only cold for an app with one worker)")
+    parser.add_argument("--seed-rng", type=int, default=0, dest="seed_rng")
+    parser.add_argument("--output", help="JSON file (default: benchmarks/results/<commit>-<time>.json)")
+    args = parser.parse_args(argv)
+
+    if args.seed:
+        seed(database_url())
+
+    server = None
+    if args.url is None:
+        server = start_app(database_url(), args.port, args.workers, cold=args.cold)
+        args.url = f"http://127.0.0.1:{args.port}"
+    try:
+        results, pool_stats = asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    revision = git_revision()
+    now = datetime.now(timezone.utc)
+    report = {
+        "git": revision,
+        "started_at": now.isoformat(),
+        "settings": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": results,
+        "pool": pool_stats,
+    }
+    output = Path(args.output) if args.output else (
+        RESULTS_DIR / f"{revision['commit'][:12]}-{now.strftime('%Y%m%dT%H%M%S')}.json"
+    )
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
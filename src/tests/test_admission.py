@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""Tests for the admission control of expensive queries."""
+import asyncio
+
+import pytest
+
+from app import admission
+
+
+def test_expensive_queries():
+    """Regions or wide ranges are expensive, short port lookups are not."""
+    assert not admission.is_expensive("port_port", "2016-01-01", "2016-01-31")
+    assert admission.is_expensive("port_port", "2016-01-01", "2017-01-01")
+    assert admission.is_expensive("port_region", "2016-01-01", "2016-01-01")
+    assert admission.statement_timeout("port_port") < admission.statement_timeout("region_region")
+
+
+def test_limiter_sheds_beyond_queue():
+    """Past `limit` running, one waits (then times out with 503) and the next is refused with 429."""
+    limiter = admission.AdmissionLimiter(limit=1, max_queue=1, queue_timeout=0.05, retry_after=2)
+
+    async def _run():
+        admitted = asyncio.Event()
+        release = asyncio.Event()
+
+        async def _hold():
+            async with limiter.admit(expensive=True):
+                admitted.set()
+                await release.wait()
+
+        async def _try():
+            async with limiter.admit(expensive=True):
+                pass
+
+        holder = asyncio.ensure_future(_hold())
+        await admitted.wait()
+        waiter = asyncio.ensure_future(_try())
+        while not limiter.queued:
+            await asyncio.sleep(0)
+
+        with pytest.raises(admission.Overloaded) as refused:
+            await _try()
+        assert (refused.value.status_code, refused.value.retry_after) == (429, 2)
+
+        # cheap lookups are never queued
+        async with limiter.admit(expensive=False):
+            pass
+
+        with pytest.raises(admission.Overloaded) as timed_out:
+            await waiter
+        assert timed_out.value.status_code == 503
+
+        release.set()
+        await holder
+        await _try()
+
+    asyncio.run(_run())
+    assert limiter.stats() == {
+        "limit": 1, "active": 0, "queued": 0,
+        "admitted_total": 2, "rejected_total": 1, "timeouts_total": 1,
+    }
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""Tests for eviction, expiry and coalescing of the response cache."""
+import asyncio
+from datetime import date, timedelta
+
+import pytest
+
+from app.cache import DayCache, ResponseCache
+
+
+def test_lru_eviction():
+    """Should evict the least recently used entry once full."""
+    cache = ResponseCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_ttl_expiry():
+    """Should not serve an entry past its ttl."""
+    cache = ResponseCache(ttl=0)
+    cache.put("a", 1)
+    assert cache.get("a") is None
+
+
+def test_concurrent_misses_are_coalesced():
+    """Should compute once for N identical concurrent misses."""
+    calls = []
+
+    async def _compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return ["result"]
+
+    async def _run():
+        cache = ResponseCache()
+        results = await asyncio.gather(*[cache.get_or_compute("key", _compute) for _ in range(5)])
+        assert results == [["result"]] * 5
+        assert await cache.get_or_compute("key", _compute) == ["result"]
+        return cache.stats()
+
+    stats = asyncio.run(_run())
+    assert len(calls) == 1
+    assert (stats["misses"], stats["coalesced"], stats["hits"]) == (1, 4, 1)
+
+
+def test_errors_reach_every_caller_and_are_not_cached():
+    """Should raise the failure to coalesced callers and retry on the next call."""
+    async def _fail():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("db down")
+
+    async def _run():
+        cache = ResponseCache()
+        outcomes = await asyncio.gather(
+            *[cache.get_or_compute("key", _fail) for _ in range(3)],
+            return_exceptions=True,
+        )
+        assert all(isinstance(outcome, RuntimeError) for outcome in outcomes)
+        assert len(cache) == 0
+        with pytest.raises(RuntimeError):
+            await cache.get_or_compute("key", _fail)
+
+    asyncio.run(_run())
+
+
+def test_cancelled_leader_hands_over_to_a_waiter():
+    """Should let a coalesced caller compute when the first one is cancelled, not cancel them all."""
+    calls = []
+
+    async def _compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return ["result"]
+
+    async def _run():
+        cache = ResponseCache()
+        leader = asyncio.ensure_future(cache.get_or_compute("key", _compute))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(cache.get_or_compute("key", _compute)) for _ in range(2)]
+        await asyncio.sleep(0)
+        leader.cancel()
+        assert await asyncio.gather(*followers) == [["result"]] * 2
+        assert leader.cancelled()
+        assert cache.get("key") == ["result"]
+
+    asyncio.run(_run())
+    assert len(calls) == 2
+
+
+def _dense_fetch(requested):
+    """Stand-in for the db returning one row per day of the requested range."""
+    async def _fetch(range_from, range_to):
+        requested.append((range_from, range_to))
+        day = date.fromisoformat(range_from)
+        rows = []
+        while day <= date.fromisoformat(range_to):
+            rows.append({"days": 3, "average_price": day.day * 100, "day": day})
+            day += timedelta(1)
+        return rows
+    return _fetch
+
+
+def test_day_cache_fetches_only_missing_days():
+    """Should fetch only the part of an overlapping window not seen before."""
+    async def _run():
+        cache = DayCache()
+        requested = []
+        fetch = _dense_fetch(requested)
+
+        first = await cache.get_or_fetch(("CNSGH", "EETLL"), "2016-01-01", "2016-01-10", fetch)
+        second = await cache.get_or_fetch(("CNSGH", "EETLL"), "2016-01-05", "2016-01-20", fetch)
+        third = await cache.get_or_fetch(("CNSGH", "EETLL"), "2016-01-03", "2016-01-08", fetch)
+        return requested, first, second, third
+
+    requested, first, second, third = asyncio.run(_run())
+    assert requested == [("2016-01-01", "2016-01-10"), ("2016-01-11", "2016-01-20")]
+    assert [row["day"].day for row in second] == list(range(5, 21))
+    assert [row["average_price"] for row in third] == [day * 100 for day in range(3, 9)]
+    assert len(first) == 10
+
+
+def test_day_cache_collapses_many_gaps():
+    """Should fall back to one spanning range past `MAX_RUNS` gaps."""
+    cache = DayCache()
+    lane = ("CNSGH", "EETLL")
+    cache.store(lane, [
+        {"days": 0, "average_price": None, "day": date(2016, 1, day)}
+        for day in (2, 4, 6, 8)
+    ])
+    assert cache.missing_runs(lane, date(2016, 1, 1), date(2016, 1, 9)) == [
+        (date(2016, 1, 1), date(2016, 1, 9))
+    ]
+
+
+def test_day_cache_bounds_days_over_lanes():
+    """Should evict the least recently used lanes once `max_days` days are held, whatever the lane count."""
+    async def _run():
+        cache = DayCache(max_lanes=100, max_days=30)
+        fetch = _dense_fetch([])
+        await cache.get_or_fetch(("a", "b"), "2016-01-01", "2016-01-20", fetch)
+        await cache.get_or_fetch(("c", "d"), "2016-01-01", "2016-01-10", fetch)
+        assert cache.stats()["days"] == 30
+        await cache.get_or_fetch(("e", "f"), "2016-01-01", "2016-01-05", fetch)
+        assert cache.stats()["lanes"] == 2 and cache.stats()["days"] == 15
+        # alone past the bound: answered, not kept, the other lanes stay
+        assert len(await cache.get_or_fetch(("g", "h"), "2016-01-01", "2016-02-29", fetch)) == 60
+        assert cache.stats()["lanes"] == 2 and cache.stats()["days"] == 15
+
+    asyncio.run(_run())
+
+
+def test_day_cache_disabled_still_answers():
+    """Should return the fetched rows even when nothing can be kept."""
+    async def _run():
+        cache = DayCache(max_lanes=0)
+        return await cache.get_or_fetch(("a", "b"), "2016-01-01", "2016-01-02", _dense_fetch([]))
+
+    assert len(asyncio.run(_run())) == 2
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Parity of the in-memory rates engine with the SQL path.
+
+The first tests compare it with a plain-Python reading of the same prices; the last
+one runs the actual `execute_when_*` queries and needs `DATABASE_URL` (skipped otherwise).
+"""
+import asyncio
+import os
+import random
+from datetime import date, timedelta
+
+import numpy as np
+import pytest
+
+from app.api import engine as memory
+from app.api import sql
+from app.api.regions import region_index
+from app.validate import location, result
+from app.validate.result import to_arrays
+
+PORTS = ["CNSGH", "CNYTN", "EETLL", "FIKTK", "NOOSL", "RULED", "SESTO", "DEHAM"]
+REGIONS = {
+    "china_main": ["CNSGH", "CNYTN"],
+    "baltic": ["EETLL", "FIKTK", "RULED"],
+    "scandinavia": ["NOOSL", "SESTO"],
+    "north_europe_main": ["DEHAM", "EETLL", "FIKTK", "NOOSL", "RULED", "SESTO"],
+    "nowhere": [],
+}
+START = date(2016, 1, 1)
+
+
+def _prices(rng, rows=4000):
+    return [
+        (rng.choice(PORTS), rng.choice(PORTS), START + timedelta(rng.randrange(60)), rng.randint(800, 3000))
+        for _ in range(rows)
+    ]
+
+
+def _reference_rows(prices, origins, destinations, date_from, date_to):
+    """What the SQL path returns: one row per day, count and AVG of the matching prices."""
+    start, end = date.fromisoformat(date_from), date.fromisoformat(date_to)
+    by_day = {}
+    for orig, dest, day, price in prices:
+        if orig in origins and dest in destinations and start <= day <= end:
+            by_day.setdefault(day, []).append(price)
+    return [
+        {"days": len(by_day.get(day, [])),
+         "average_price": sum(by_day[day]) / len(by_day[day]) if day in by_day else None,
+         "day": day}
+        for day in (start + timedelta(offset) for offset in range((end - start).days + 1))
+    ]
+
+
+@pytest.fixture
+def loaded(monkeypatch):
+    prices = _prices(random.Random(0))
+    engine = memory.PriceEngine()
+    engine.build(*zip(*[(o, d, day.toordinal(), 1, p) for o, d, day, p in prices]), codes=PORTS)
+    monkeypatch.setattr(memory, "engine", engine)
+    monkeypatch.setattr(region_index, "_ports", REGIONS)
+    monkeypatch.setattr(region_index, "loaded_at", float("inf"))
+    monkeypatch.setattr(region_index, "loads", 1)
+    return prices, engine
+
+
+def _assert_same(left, right):
+    np.testing.assert_array_equal(left[0], right[0])
+    np.testing.assert_array_equal(left[1], right[1])
+
+
+def test_parity_with_reference(loaded):
+    """Every shape, over ranges inside, across and outside the loaded days."""
+    prices, engine = loaded
+    rng = random.Random(1)
+    locations = PORTS + list(REGIONS) + ["XXXXX"]
+    for _ in range(300):
+        origin, destination = rng.choice(locations), rng.choice(locations)
+        first = START + timedelta(rng.randrange(-10, 70))
+        date_from, date_to = first.isoformat(), (first + timedelta(rng.randrange(40))).isoformat()
+        type_loc = location.validate(origin, destination)
+
+        origins = REGIONS[origin] if type_loc[0] == "region" else [origin]
+        destinations = REGIONS[destination] if type_loc[1] == "region" else [destination]
+        expected = to_arrays(_reference_rows(prices, origins, destinations, date_from, date_to), date_from, date_to)
+
+        _assert_same(asyncio.run(memory.rates_arrays(None, type_loc, origin, destination, date_from, date_to)),
+                     expected)
+
+
+def test_execute_functions_mirror_sql(loaded):
+    """The `execute_when_*` stand-ins return the rows the queries would."""
+    prices, engine = loaded
+    args = ("2016-01-05", "2016-01-25")
+
+    rows = asyncio.run(memory.execute_when_both_ports(None, "CNSGH", "EETLL", *args))
+    assert rows == _reference_rows(prices, ["CNSGH"], ["EETLL"], *args)
+
+    rows = asyncio.run(memory.execute_when_one_region(None, "china_main", "EETLL", *args, True))
+    assert rows == _reference_rows(prices, REGIONS["china_main"], ["EETLL"], *args)
+
+    rows = asyncio.run(memory.execute_when_both_region(None, "china_main", "north_europe_main", *args))
+    reference = _reference_rows(prices, REGIONS["china_main"], REGIONS["north_europe_main"], *args)
+    assert [row["days"] for row in rows] == [row["days"] for row in reference]
+    assert np.allclose([row["average_price"] or 0 for row in rows], [row["average_price"] or 0 for row in reference])
+
+
+@pytest.mark.parametrize("granularity", ["week", "month", "10d"])
+def test_buckets_weighted_by_count(loaded, granularity):
+    """Buckets average every price they hold, not the daily averages."""
+    prices, engine = loaded
+    args = ("2015-12-30", "2016-02-20")
+    daily = _reference_rows(prices, REGIONS["china_main"], REGIONS["baltic"], *args)
+    starts = result.bucket_starts(*args, granularity)
+    bucket_rows = []
+    for first, end in zip(starts, list(starts[1:]) + [len(daily)]):
+        count = sum(row["days"] for row in daily[first:end])
+        total = sum(row["days"] * (row["average_price"] or 0) for row in daily[first:end])
+        bucket_rows.append({"days": count, "average_price": total / count if count else None,
+                            "day": daily[first]["day"]})
+
+    type_loc = ("region", "region")
+    _assert_same(asyncio.run(memory.rates_arrays(None, type_loc, "china_main", "baltic", *args, granularity)),
+                 to_arrays(bucket_rows, *args, granularity))
+    rows = asyncio.run(memory.execute_when_both_region(None, "china_main", "baltic", *args, granularity))
+    assert [row["days"] for row in rows] == [row["days"] for row in bucket_rows]
+    assert [row["day"] for row in rows] == [row["day"] for row in bucket_rows]
+
+
+def test_matrix_matches_each_lane(loaded):
+    """Each cell of the matrix holds what the lane alone aggregates, unknown ports holding nothing."""
+    prices, engine = loaded
+    origins, destinations = REGIONS["china_main"] + ["XXXXX"], REGIONS["north_europe_main"]
+    args = ("2015-12-25", "2016-02-10")
+
+    counts, sums = engine.matrix(origins, destinations, *args)
+    assert counts.shape == (3, 6, 48)
+    for i, orig in enumerate(origins):
+        for j, dest in enumerate(destinations):
+            lane = engine.aggregate(engine.ids_of([orig]), engine.ids_of([dest]),
+                                    *(date.fromisoformat(day) for day in args))
+            np.testing.assert_array_equal(counts[i, j], lane[0])
+            np.testing.assert_array_equal(sums[i, j], lane[1])
+    assert not counts[2].any()
+
+    collapsed = engine.matrix(origins, destinations, *args, collapse=True)
+    np.testing.assert_array_equal(collapsed[0], counts.sum(axis=2))
+    np.testing.assert_array_equal(collapsed[1], sums.sum(axis=2))
+
+
+def test_duplicate_rows_are_summed():
+    """Rows loaded twice for a lane and day add up, like prices of the same day."""
+    engine = memory.PriceEngine()
+    day = START.toordinal()
+    engine.build(["CNSGH"] * 3, ["EETLL"] * 3, [day, day, day + 1], [2, 1, 5], [200, 130, 500])
+    counts, sums = engine.aggregate(engine.ids_of(["CNSGH"]), engine.ids_of(["EETLL"]), START, START + timedelta(1))
+    assert counts.tolist() == [3, 5]
+    assert sums.tolist() == [330, 500]
+
+
+def test_refresh_builds_off_the_event_loop(monkeypatch):
+    """The arrays are built in a thread from records fetched in batches, then swapped in."""
+    import threading
+    from contextlib import asynccontextmanager
+    from app.api.stats import stats_state
+
+    rng = random.Random(11)
+    records = [
+        {"orig_code": orig, "dest_code": dest, "day": day, "price_count": 1, "price_sum": price}
+        for orig, dest, day, price in _prices(rng, rows=250)
+    ]
+
+    class _Cursor:
+        def __init__(self):
+            self.position = 0
+
+        async def fetch(self, n):
+            self.position += n
+            return records[self.position - n:self.position]
+
+    class _Connection:
+        @asynccontextmanager
+        async def transaction(self):
+            yield
+
+        async def cursor(self, query):
+            return _Cursor()
+
+        async def fetch(self, query):
+            return [{"code": code} for code in PORTS + ["USNYC"]]
+
+    async def _not_fresh(conn):
+        return False
+
+    threads = []
+    arrays_of = memory.arrays_of
+
+    def _arrays_of(*args, **kwargs):
+        threads.append(threading.get_ident())
+        return arrays_of(*args, **kwargs)
+
+    monkeypatch.setattr(stats_state, "is_fresh", _not_fresh)
+    monkeypatch.setattr(stats_state, "prices_version", 5)
+    monkeypatch.setattr(memory, "arrays_of", _arrays_of)
+    engine = memory.PriceEngine()
+    asyncio.run(engine.refresh(_Connection(), chunk_rows=100))
+
+    assert threads and threads[0] != threading.get_ident()
+    expected = memory.PriceEngine()
+    expected.build(*zip(*[(row["orig_code"], row["dest_code"], row["day"].toordinal(), 1, row["price_sum"])
+                          for row in records]), codes=PORTS + ["USNYC"])
+    assert engine.version == 5
+    assert engine.codes.tolist() == expected.codes.tolist()
+    for name in memory.PriceEngine.COLUMNS:
+        assert getattr(engine, name).tolist() == getattr(expected, name).tolist()
+
+
+@pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="needs a seeded Postgres in DATABASE_URL")
+def test_parity_with_database():
+    """The engine loaded from the db answers what the queries return, for a sample of each shape."""
+    import asyncpg
+    from app.api.stats import stats_state
+    from benchmarks.common import sample_workload
+
+    async def _run():
+        conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+        try:
+            stats_state.invalidate()
+            region_index.invalidate()
+            await region_index.refresh(conn)
+            engine = memory.PriceEngine()
+            await engine.refresh(conn)
+            workload = await sample_workload(conn, 50, seed=3)
+            for queries in workload.values():
+                for date_from, date_to, origin, destination in queries:
+                    type_loc = location.validate(origin, destination)
+                    if type_loc[0] == type_loc[1] == "port":
+                        rows = await sql.execute_when_both_ports(conn, origin, destination, date_from, date_to)
+                    elif type_loc[0] == type_loc[1] == "region":
+                        rows = await sql.execute_when_both_region(conn, origin, destination, date_from, date_to)
+                    else:
+                        rows = await sql.execute_when_one_region(
+                            conn, origin, destination, date_from, date_to, type_loc[0] == "region"
+                        )
+                    orig_ids = engine.ids_of(await region_index.resolve(conn, origin)
+                                             if type_loc[0] == "region" else [origin])
+                    dest_ids = engine.ids_of(await region_index.resolve(conn, destination)
+                                             if type_loc[1] == "region" else [destination])
+                    _assert_same(engine.arrays(orig_ids, dest_ids, date_from, date_to),
+                                 to_arrays(rows, date_from, date_to))
+        finally:
+            await conn.close()
+
+    asyncio.run(_run())
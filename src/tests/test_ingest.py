@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""Tests for parsing and staging of bulk-loaded prices."""
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date
+
+import pytest
+
+from app.api import ingest
+
+
+async def _chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def _collect(records):
+    return [record async for record in records]
+
+
+class _IngestConnection:
+    """Stand-in for `asyncpg.Connection` recording what a load sends."""
+
+    def __init__(self, rejected=0, codes=None):
+        self.copies = []
+        self.statements = []
+        self.rejected = {"rows": rejected, "codes": codes}
+
+    async def execute(self, query, *args):
+        self.statements.append(query)
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.copies.append((table, list(records), columns))
+
+    async def fetchrow(self, query):
+        self.statements.append(query)
+        if query == ingest.READ_META:
+            return {"prices_version": 8, "stats_version": 7}
+        return self.rejected
+
+    async def fetch(self, query):
+        return sorted({record[:3] for _, batch, _ in self.copies for record in batch})
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+
+def test_read_csv_split_across_chunks():
+    """Lines cut between chunks are put back together, columns follow the header."""
+    lines = ingest.iter_lines(_chunks(b"day,price,orig_code,dest_code\n2016-01-0", b"1,1200,CNSGH,EETLL\n\n",
+                                      b"2016-01-02,1300,CNSGH,EETLL"))
+    records = asyncio.run(_collect(ingest.read_records(lines, "text/csv")))
+    assert records == [
+        ("CNSGH", "EETLL", date(2016, 1, 1), 1200),
+        ("CNSGH", "EETLL", date(2016, 1, 2), 1300),
+    ]
+
+
+def test_read_ndjson_reports_bad_line():
+    """The first invalid line stops the load with its number."""
+    lines = ingest.iter_lines(_chunks(
+        b'{"orig_code": "CNSGH", "dest_code": "EETLL", "day": "2016-01-01", "price": 1200}\n',
+        b'{"orig_code": "CNSGH", "dest_code": "EETLL", "day": "01/02/2016", "price": 1300}\n',
+    ))
+    with pytest.raises(ingest.IngestError, match="Line 2"):
+        asyncio.run(_collect(ingest.read_records(lines, "application/x-ndjson")))
+
+
+def test_ingest_batches_and_refreshes(monkeypatch):
+    """Rows are copied in batches to the staging table, then the touched stats refreshed."""
+    refreshed = []
+
+    async def _refresh_stats(conn, keys, version):
+        refreshed.extend(keys)
+        assert version == 8
+
+    monkeypatch.setattr(ingest, "refresh_stats", _refresh_stats)
+
+    async def _records():
+        for day in range(1, 6):
+            yield "CNSGH", "XXXXX" if day == 5 else "EETLL", date(2016, 1, day), 1000 + day
+
+    conn = _IngestConnection(rejected=1, codes=["XXXXX"])
+    report = asyncio.run(ingest.ingest(conn, _records(), batch_rows=2))
+
+    assert [len(batch) for _, batch, _ in conn.copies] == [2, 2, 1]
+    assert {table for table, _, _ in conn.copies} == {"prices_staging"}
+    assert conn.statements[-2:] == [ingest.INSERT_STAGED, ingest.READ_META]
+    assert len(refreshed) == 5
+    assert report["rows"] == 5
+    assert report["inserted"] == 4
+    assert report["unknown_ports"] == ["XXXXX"]
+    assert report["rows_per_sec"] > 0
+
+
+def test_ingest_all_rejected_writes_nothing(monkeypatch):
+    """A load with no row left does not touch `prices`, so its version is not bumped"""
+    refreshed = []
+
+    async def _refresh_stats(conn, keys, version):
+        refreshed.append(version)
+
+    monkeypatch.setattr(ingest, "refresh_stats", _refresh_stats)
+
+    async def _records():
+        yield "CNSGH", "XXXXX", date(2016, 1, 1), 1000
+
+    class _RejectingConnection(_IngestConnection):
+        async def fetch(self, query):
+            # the staging table is empty once the unknown ports were dropped
+            return []
+
+    conn = _RejectingConnection(rejected=1, codes=["XXXXX"])
+    report = asyncio.run(ingest.ingest(conn, _records()))
+
+    assert ingest.INSERT_STAGED not in conn.statements
+    assert ingest.READ_META not in conn.statements
+    assert refreshed == []
+    assert report["inserted"] == 0
+
+    empty = _RejectingConnection()
+    assert asyncio.run(ingest.ingest(empty, _chunks()))["rows"] == 0
+    assert ingest.INSERT_STAGED not in empty.statements
+
+
+class _StatsConnection(_IngestConnection):
+    """Stand-in for `asyncpg.Connection` with the given version stamps in `rates_meta`."""
+
+    def __init__(self, prices_version, stats_version):
+        super().__init__()
+        self.meta = {"prices_version": prices_version, "stats_version": stats_version}
+
+    async def fetchrow(self, query):
+        return self.meta
+
+
+@pytest.mark.parametrize("prices_version, stats_version, incremental", [
+    (8, 7, True),
+    # another write landed between the stats and this load, or after it
+    (8, 6, False),
+    (9, 7, False),
+])
+def test_refresh_trusts_keys_of_the_only_write(prices_version, stats_version, incremental):
+    """Only the lanes of the load are recomputed when it is the one write the stats miss."""
+    from app.api import stats
+
+    conn = _StatsConnection(prices_version, stats_version)
+    keys = [("CNSGH", "EETLL", date(2016, 1, 1))]
+    assert asyncio.run(stats.refresh_stats(conn, keys, version=8)) == prices_version
+
+    expected = stats.INSERT_REGION_DAYS if incremental else stats.REBUILD_REGION_STATS
+    assert conn.statements[-2:] == [expected, stats.MARK_FRESH]
@@ -1,12 +1,25 @@
 # -*- coding: utf-8 -*-
 """Tests related to main functionality of the app."""
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date
+
+import pytest
 from starlette.testclient import TestClient
 
 from app import main
+from app.validate.result import to_arrays
 
 client = TestClient(main.app)
 
 
+@pytest.fixture(autouse=True)
+def _known_data_version(monkeypatch):
+    """The prices version is read from `rates_meta`, pin it instead of reaching the db."""
+    monkeypatch.setattr(main.stats_state, "prices_version", 7)
+    monkeypatch.setattr(main.stats_state, "checked_at", float("inf"))
+
+
 def test_single_port(monkeypatch):
     """Monkeypatch db-fetching(give mock data) to see if app works for Ports"""
     result = {
@@ -60,3 +73,572 @@ def test_single_price(monkeypatch):
     response = client.get("/rates/get_single_price")
     assert response.status_code == 200
     assert response.json() == result
+
+
+def test_rates_bad_dates():
+    """Should refuse dates in the wrong order before touching the db"""
+    response = client.get("/rates", params={
+        "date_from": "2016-01-10",
+        "date_to": "2016-01-01",
+        "origin": "CNSGH",
+        "destination": "EETLL",
+    })
+    assert response.status_code == 418
+
+
+def test_rates_are_cached(monkeypatch):
+    """Monkeypatch db-fetching(give mock data) to see that repeated queries are served from cache"""
+    result = [{"day": "2016-01-01", "average_price": 1112}]
+    calls = []
+
+    async def _mock_fetch_rates(type_loc, origin, destination, date_from, date_to, granularity="day"):
+        calls.append(type_loc)
+        return to_arrays([{"days": 3, "average_price": 1112, "day": date(2016, 1, 1)}], date_from, date_to)
+
+    monkeypatch.setattr(main, "_fetch_rates", _mock_fetch_rates)
+    main.rates_cache.invalidate()
+
+    params = {
+        "date_from": "2016-01-01",
+        "date_to": "2016-01-01",
+        "origin": "CNSGH",
+        "destination": "north_europe_main",
+    }
+    for _ in range(3):
+        response = client.get("/rates", params=params)
+        assert response.status_code == 200
+        assert response.json() == result
+        assert response.headers["etag"]
+
+    assert calls == [("port", "region")]
+    main.rates_cache.invalidate()
+
+
+def test_rates_batch(monkeypatch):
+    """Monkeypatch db-fetching(give mock data) to see that lanes are answered in request order"""
+    async def _mock_fetch_rates(type_loc, origin, destination, date_from, date_to, granularity="day"):
+        return to_arrays(
+            [{"days": 3, "average_price": len(origin), "day": date.fromisoformat(date_from)}],
+            date_from,
+            date_from,
+        )
+
+    class _MockPool:
+        max_size = 2
+
+    monkeypatch.setattr(main, "_fetch_rates", _mock_fetch_rates)
+    monkeypatch.setitem(main.connect_dict, "pool", _MockPool())
+    main.rates_cache.invalidate()
+
+    response = client.post("/rates/batch", json={
+        "date_from": "2016-01-01",
+        "date_to": "2016-01-02",
+        "lanes": [
+            {"origin": "CNSGH", "destination": "EETLL"},
+            {"origin": "china_main", "destination": "EETLL", "date_from": "2016-01-02"},
+            {"origin": "baltic", "destination": "north_europe_main"},
+        ],
+    })
+    assert response.status_code == 200
+    body = response.json()
+    assert [lane["origin"] for lane in body] == ["CNSGH", "china_main", "baltic"]
+    assert body[1]["date_from"] == "2016-01-02"
+    assert body[1]["rates"] == [{"day": "2016-01-02", "average_price": 10}]
+    main.rates_cache.invalidate()
+
+
+def test_rates_batch_reports_bad_lane():
+    """Should name the lane that failed validation"""
+    response = client.post("/rates/batch", json={
+        "lanes": [
+            {"origin": "CNSGH", "destination": "EETLL",
+             "date_from": "2016-01-01", "date_to": "2016-01-02"},
+            {"origin": "CNSGH", "destination": "EETLL"},
+        ],
+    })
+    assert response.status_code == 418
+    assert response.json()["detail"].startswith("Lane 1:")
+
+
+def test_rates_streamed_as_csv(monkeypatch):
+    """Monkeypatch db-fetching(give mock cursor) to see that days are streamed and filled"""
+    released = []
+
+    class _MockConnection:
+        @asynccontextmanager
+        async def transaction(self):
+            yield
+
+        async def cursor(self, query, *args, prefetch=None):
+            yield {"days": 3, "average_price": 1100.4, "day": date(2016, 1, 2)}
+
+    class _MockPool:
+        @asynccontextmanager
+        async def acquire(self):
+            yield _MockConnection()
+            released.append(True)
+
+    async def _mock_plan_rates(conn, type_loc, origin, destination, date_from, date_to, granularity="day",
+                               from_stats=None):
+        return ("SELECT", origin, destination)
+
+    monkeypatch.setattr(main, "plan_rates", _mock_plan_rates)
+    monkeypatch.setitem(main.connect_dict, "pool", _MockPool())
+
+    response = client.get("/rates", headers={"Accept": "text/csv"}, params={
+        "date_from": "2016-01-01",
+        "date_to": "2016-01-03",
+        "origin": "CNSGH",
+        "destination": "EETLL",
+    })
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert response.text == "day,average_price\n2016-01-01,\n2016-01-02,1100\n2016-01-03,\n"
+    assert released == [True]
+
+
+def test_rates_stream_failure_releases_connection(monkeypatch):
+    """A cursor failing mid-stream still gives the connection and the admission slot back"""
+    released = []
+
+    class _MockConnection:
+        @asynccontextmanager
+        async def transaction(self):
+            yield
+
+        async def cursor(self, query, *args, prefetch=None):
+            yield {"days": 3, "average_price": 1100.4, "day": date(2016, 1, 2)}
+            raise ConnectionResetError("connection lost mid-stream")
+
+    class _MockAcquire:
+        # not a generator: only an explicit exit releases it, not the loop's shutdown
+        async def __aenter__(self):
+            return _MockConnection()
+
+        async def __aexit__(self, *exc_info):
+            released.append(True)
+
+    class _MockPool:
+        def acquire(self):
+            return _MockAcquire()
+
+    async def _mock_plan_rates(conn, type_loc, origin, destination, date_from, date_to, granularity="day",
+                               from_stats=None):
+        return ("SELECT", origin, destination)
+
+    monkeypatch.setattr(main, "plan_rates", _mock_plan_rates)
+    monkeypatch.setitem(main.connect_dict, "pool", _MockPool())
+    active = main.admission.active
+
+    # raised through anyio's task group, wrapped in an ExceptionGroup by recent versions
+    with pytest.raises(Exception):
+        client.get("/rates", headers={"Accept": "text/csv"}, params={
+            "date_from": "2016-01-01",
+            "date_to": "2016-01-03",
+            "origin": "china_main",
+            "destination": "EETLL",
+        })
+    assert released == [True]
+    assert main.admission.active == active
+
+
+def test_rates_stream_cut_after_timeout(monkeypatch):
+    """A stream still going after `STREAM_TIMEOUT` gives its connection and admission slot back"""
+    import asyncio
+
+    released = []
+
+    class _MockConnection:
+        @asynccontextmanager
+        async def transaction(self):
+            yield
+
+        async def cursor(self, query, *args, prefetch=None):
+            # a lane without end, read slowly
+            while True:
+                await asyncio.sleep(0.01)
+                yield {"days": 3, "average_price": 1100.4, "day": date(2016, 1, 2)}
+
+    class _MockAcquire:
+        async def __aenter__(self):
+            return _MockConnection()
+
+        async def __aexit__(self, *exc_info):
+            released.append(True)
+
+    class _MockPool:
+        def acquire(self):
+            return _MockAcquire()
+
+    async def _mock_plan_rates(conn, type_loc, origin, destination, date_from, date_to, granularity="day",
+                               from_stats=None):
+        return ("SELECT", origin, destination)
+
+    monkeypatch.setattr(main, "plan_rates", _mock_plan_rates)
+    monkeypatch.setattr(main, "STREAM_TIMEOUT", 0.05)
+    monkeypatch.setitem(main.connect_dict, "pool", _MockPool())
+    active = main.admission.active
+
+    try:
+        client.get("/rates", headers={"Accept": "text/csv"}, params={
+            "date_from": "2016-01-01",
+            "date_to": "2016-12-31",
+            "origin": "china_main",
+            "destination": "EETLL",
+        })
+    except BaseException:
+        # the response is cut short, how that reaches the client depends on the server
+        pass
+    assert released == [True]
+    assert main.admission.active == active
+
+
+def test_rates_stream_acquire_failure_gives_slot_back(monkeypatch):
+    """A connection that cannot be acquired for a stream does not keep the admission slot"""
+    class _MockPool:
+        def acquire(self):
+            raise ConnectionRefusedError("primary is down")
+
+    monkeypatch.setitem(main.connect_dict, "pool", _MockPool())
+    active = main.admission.active
+
+    with pytest.raises(ConnectionRefusedError):
+        client.get("/rates", headers={"Accept": "text/csv"}, params={
+            "date_from": "2016-01-01",
+            "date_to": "2016-01-03",
+            "origin": "china_main",
+            "destination": "EETLL",
+        })
+    assert main.admission.active == active
+
+
+def test_rates_columnar(monkeypatch):
+    """Monkeypatch db-fetching(give mock data) to see the columnar representations"""
+    import msgpack
+
+    async def _mock_fetch_rates(type_loc, origin, destination, date_from, date_to, granularity="day"):
+        return to_arrays([{"days": 3, "average_price": 1112, "day": date(2016, 1, 2)}], date_from, date_to)
+
+    monkeypatch.setattr(main, "_fetch_rates", _mock_fetch_rates)
+    main.rates_cache.invalidate()
+
+    params = {
+        "date_from": "2016-01-01",
+        "date_to": "2016-01-03",
+        "origin": "CNSGH",
+        "destination": "EETLL",
+    }
+    expected = {"date_from": "2016-01-01", "date_to": "2016-01-03", "average_price": [None, 1112, None]}
+
+    response = client.get("/rates", params=params, headers={"Accept": "application/vnd.rates.columnar+json"})
+    assert response.headers["content-type"] == "application/vnd.rates.columnar+json"
+    assert response.json() == expected
+
+    response = client.get("/rates", params=params, headers={"Accept": "application/msgpack"})
+    assert response.headers["content-type"] == "application/msgpack"
+    assert msgpack.unpackb(response.content) == expected
+    main.rates_cache.invalidate()
+
+
+def test_rates_by_bucket(monkeypatch):
+    """Monkeypatch db-fetching(give mock data) to see one answer per week, and bad granularities refused"""
+    calls = []
+
+    async def _mock_fetch_rates(type_loc, origin, destination, date_from, date_to, granularity="day"):
+        calls.append(granularity)
+        return to_arrays([{"days": 12, "average_price": 1112.4, "day": date(2016, 1, 4)}],
+                         date_from, date_to, granularity)
+
+    monkeypatch.setattr(main, "_fetch_rates", _mock_fetch_rates)
+    main.rates_cache.invalidate()
+
+    params = {
+        "date_from": "2016-01-01",
+        "date_to": "2016-01-17",
+        "origin": "CNSGH",
+        "destination": "EETLL",
+    }
+    response = client.get("/rates", params={**params, "granularity": "Week"})
+    assert response.json() == [
+        {"day": "2016-01-01", "average_price": None},
+        {"day": "2016-01-04", "average_price": 1112},
+        {"day": "2016-01-11", "average_price": None},
+    ]
+    assert calls == ["week"]
+
+    # a daily answer is another entry, with another ETag
+    daily = client.get("/rates", params=params)
+    assert len(daily.json()) == 17
+    assert daily.headers["etag"] != response.headers["etag"]
+    assert calls == ["week", "day"]
+
+    for granularity in ("year", "0d", "1000d"):
+        assert client.get("/rates", params={**params, "granularity": granularity}).status_code == 418
+    main.rates_cache.invalidate()
+
+
+def test_rates_matrix_from_memory(monkeypatch):
+    """The matrix of two regions answered by the in-memory engine, as JSON and dense MessagePack"""
+    import msgpack
+    import numpy as np
+    from app.api.engine import PriceEngine
+
+    engine = PriceEngine()
+    day = date(2016, 1, 1).toordinal()
+    engine.build(["CNSGH", "CNSGH", "CNYTN"], ["EETLL", "EETLL", "FIKTK"], [day, day + 1, day],
+                 [3, 1, 2], [3000, 1200, 1800], version=7)
+    monkeypatch.setattr(main, "RATES_BACKEND", "memory")
+    monkeypatch.setattr(main, "engine", engine)
+    monkeypatch.setattr(main.region_index, "_ports", {"china_main": ["CNSGH", "CNYTN"], "baltic": ["EETLL", "FIKTK"]})
+    monkeypatch.setattr(main.region_index, "loaded_at", float("inf"))
+    main.rates_cache.invalidate()
+
+    params = {"date_from": "2016-01-01", "date_to": "2016-01-02", "origin": "china_main", "destination": "baltic"}
+    response = client.get("/rates/matrix", params=params)
+    assert response.status_code == 200
+    assert response.json() == {
+        "date_from": "2016-01-01", "date_to": "2016-01-02",
+        "origins": ["CNSGH", "CNYTN"], "destinations": ["EETLL", "FIKTK"],
+        "average_price": [[[1000, None], [None, None]], [[None, None], [None, None]]],
+    }
+    assert client.get("/rates/matrix", params=params,
+                      headers={"If-None-Match": response.headers["etag"]}).status_code == 304
+
+    response = client.get("/rates/matrix", params={**params, "collapse": "true"},
+                          headers={"Accept": "application/msgpack"})
+    decoded = msgpack.unpackb(response.content)
+    assert decoded["shape"] == [2, 2]
+    dense = np.frombuffer(decoded["average_price"], dtype=decoded["dtype"]).reshape(decoded["shape"])
+    assert dense[0, 0] == 1050 and np.isnan(dense[1, 1])
+
+    monkeypatch.setattr(main, "MATRIX_MAX_CELLS", 4)
+    main.rates_cache.invalidate()
+    assert client.get("/rates/matrix", params=params).status_code == 413
+    assert client.get("/rates/matrix", params={**params, "collapse": "true"}).status_code == 200
+    main.rates_cache.invalidate()
+
+
+def test_rates_not_modified(monkeypatch):
+    """A revalidation with the current ETag is answered 304 without fetching"""
+    calls = []
+
+    async def _mock_fetch_rates(type_loc, origin, destination, date_from, date_to, granularity="day"):
+        calls.append(type_loc)
+        return to_arrays([], date_from, date_to)
+
+    monkeypatch.setattr(main, "_fetch_rates", _mock_fetch_rates)
+    main.rates_cache.invalidate()
+
+    params = {
+        "date_from": "2016-01-01",
+        "date_to": "2016-01-03",
+        "origin": "CNSGH",
+        "destination": "EETLL",
+    }
+    response = client.get("/rates", params=params)
+    etag = response.headers["etag"]
+    assert etag.startswith('"v7-')
+    assert response.headers["cache-control"].startswith("public, max-age=")
+    main.rates_cache.invalidate()
+
+    response = client.get("/rates", params=params, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert calls == [("port", "port")]
+
+    # new prices, new ETag
+    monkeypatch.setattr(main.stats_state, "prices_version", 8)
+    response = client.get("/rates", params=params, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    main.rates_cache.invalidate()
+
+
+def test_rates_compressed(monkeypatch):
+    """Large bodies are gzipped when the client accepts it, small ones are not"""
+    async def _mock_fetch_rates(type_loc, origin, destination, date_from, date_to, granularity="day"):
+        return to_arrays([], date_from, date_to)
+
+    monkeypatch.setattr(main, "_fetch_rates", _mock_fetch_rates)
+    main.rates_cache.invalidate()
+
+    params = {
+        "date_from": "2016-01-01",
+        "date_to": "2016-12-31",
+        "origin": "CNSGH",
+        "destination": "EETLL",
+    }
+    response = client.get("/rates", params=params, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["etag"].endswith('-gzip"')
+    # the client already inflated it
+    assert response.content.startswith(b'[{"day":"2016-01-01","average_price":null}')
+
+    params["date_to"] = "2016-01-01"
+    response = client.get("/rates", params=params, headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in response.headers
+    main.rates_cache.invalidate()
+
+
+@pytest.mark.parametrize("accept, expected", [
+    (None, "application/json"),
+    ("text/csv", "text/csv"),
+    ("application/json, text/csv;q=0.1", "application/json"),
+    ("text/csv;q=0.5, application/x-ndjson", "application/x-ndjson"),
+    ("application/msgpack;q=0", "application/json"),
+    ("*/*;q=0.1, application/msgpack;q=0", "application/json"),
+    ("text/*", "text/csv"),
+    ("image/png", "application/json"),
+])
+def test_media_type_negotiation(accept, expected):
+    """The representation follows the q-values of `Accept`, never one at q=0"""
+    offered = ("application/json", *main.result.STREAM_MEDIA_TYPES, *main.result.COLUMNAR_MEDIA_TYPES)
+    assert main.encoding.negotiate_media_type(accept, offered) == expected
+
+
+def test_rates_prefers_json_to_low_quality_csv(monkeypatch):
+    """A media type listed with a lower q-value is not streamed"""
+    async def _mock_fetch_rates(type_loc, origin, destination, date_from, date_to, granularity="day"):
+        return to_arrays([], date_from, date_to)
+
+    monkeypatch.setattr(main, "_fetch_rates", _mock_fetch_rates)
+    main.rates_cache.invalidate()
+    response = client.get("/rates", headers={"Accept": "application/json, text/csv;q=0.1"}, params={
+        "date_from": "2016-01-01",
+        "date_to": "2016-01-01",
+        "origin": "CNSGH",
+        "destination": "EETLL",
+    })
+    assert response.headers["content-type"] == "application/json"
+    assert response.json() == [{"day": "2016-01-01", "average_price": None}]
+    main.rates_cache.invalidate()
+
+
+def test_metrics_exposition(monkeypatch):
+    """A served request shows up in the histograms of `/metrics`"""
+    async def _mock_fetch_rates(type_loc, origin, destination, date_from, date_to, granularity="day"):
+        return to_arrays([], date_from, date_to)
+
+    monkeypatch.setattr(main, "_fetch_rates", _mock_fetch_rates)
+    main.rates_cache.invalidate()
+
+    client.get("/rates", params={
+        "date_from": "2016-01-01",
+        "date_to": "2016-01-01",
+        "origin": "CNSGH",
+        "destination": "north_europe_main",
+    })
+    response = client.get("/metrics")
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'rates_phase_seconds_count{phase="serialize",shape="port_region"}' in response.text
+    assert 'rates_request_seconds_bucket{shape="port_region",le="+Inf"}' in response.text
+    assert "rates_cache_hit_ratio" in response.text
+    main.rates_cache.invalidate()
+
+
+def test_rates_shed_with_retry_after(monkeypatch):
+    """A query refused by admission control is answered with its status and `Retry-After`"""
+    @asynccontextmanager
+    async def _saturated(expensive):
+        raise main.Overloaded(429, "[BUSY]Too many expensive queries waiting, retry later.", 3)
+        yield
+
+    monkeypatch.setattr(main.admission, "admit", _saturated)
+    main.rates_cache.invalidate()
+    main.day_cache.invalidate()
+
+    response = client.get("/rates", params={
+        "date_from": "2016-01-01",
+        "date_to": "2016-01-10",
+        "origin": "china_main",
+        "destination": "north_europe_main",
+    })
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "3"
+
+
+def test_rates_from_shared_tier(monkeypatch, tmp_path):
+    """A query answered by another worker is served from the shared tier without fetching"""
+    from app.shared_cache import SharedCache
+
+    calls = []
+
+    async def _mock_fetch_rates(type_loc, origin, destination, date_from, date_to, granularity="day"):
+        calls.append(type_loc)
+        return to_arrays([{"days": 3, "average_price": 1112, "day": date(2016, 1, 2)}], date_from, date_to)
+
+    monkeypatch.setattr(main, "_fetch_rates", _mock_fetch_rates)
+    monkeypatch.setattr(main, "shared_cache", SharedCache(str(tmp_path / "cache.sqlite3")))
+    params = {
+        "date_from": "2016-01-01",
+        "date_to": "2016-01-03",
+        "origin": "CNSGH",
+        "destination": "EETLL",
+    }
+    expected = [
+        {"day": "2016-01-01", "average_price": None},
+        {"day": "2016-01-02", "average_price": 1112},
+        {"day": "2016-01-03", "average_price": None},
+    ]
+    for _ in range(2):
+        # as if the second request reached another worker, with its own empty cache
+        main.rates_cache.invalidate()
+        assert client.get("/rates", params=params).json() == expected
+
+    assert calls == [("port", "port")]
+    main.rates_cache.invalidate()
+
+
+def test_ingest_empties_shared_tier(monkeypatch, tmp_path):
+    """Loading prices drops the answers every worker put in the shared tier"""
+    from app.shared_cache import SharedCache
+
+    class _MockPool:
+        @asynccontextmanager
+        async def acquire(self):
+            yield None
+
+    async def _mock_ingest(conn, records):
+        return {"rows": sum(1 for _ in [record async for record in records])}
+
+    cache = SharedCache(str(tmp_path / "cache.sqlite3"))
+    cache.put("rates", b"stale")
+    monkeypatch.setattr(main, "shared_cache", cache)
+    monkeypatch.setattr(main, "ingest", _mock_ingest)
+    monkeypatch.setattr(main, "RATES_BACKEND", "postgres")
+    monkeypatch.setitem(main.connect_dict, "pool", _MockPool())
+
+    response = client.post("/rates/prices", headers={"Content-Type": "text/csv"},
+                           content="orig_code,dest_code,day,price\nCNSGH,EETLL,2016-01-02,1100\n")
+    assert response.status_code == 200
+    assert cache.get("rates") is None
+
+
+def test_failed_engine_reload_is_delayed(monkeypatch, caplog):
+    """A reload of the in-memory engine that failed is logged and not retried on the next request"""
+    loads = []
+
+    class _MockPool:
+        @asynccontextmanager
+        async def acquire(self):
+            yield None
+
+    async def _failing_load(conn, engine, path=None):
+        loads.append(True)
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(main.snapshot, "load", _failing_load)
+    monkeypatch.setitem(main.connect_dict, "pool", _MockPool())
+    monkeypatch.setitem(main.connect_dict, "engine_reload", None)
+    monkeypatch.setitem(main.connect_dict, "engine_reload_after", 0.0)
+
+    async def _run():
+        main._reload_engine()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        main._reload_engine()
+
+    asyncio.run(_run())
+    assert loads == [True]
+    assert main.connect_dict["engine_reload_after"] > 0
+    assert "in-memory engine reload failed" in caplog.text
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""Tests for the request timings and their Prometheus exposition."""
+import logging
+
+from app import metrics
+
+
+def test_histogram_is_cumulative():
+    """Bucket counts include every smaller bucket, +Inf equals the count."""
+    histogram = metrics.Histogram("test_seconds", "Test.", labels=("shape",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, "port_port")
+
+    lines = histogram.render()
+    assert 'test_seconds_bucket{shape="port_port",le="0.1"} 2' in lines
+    assert 'test_seconds_bucket{shape="port_port",le="1.0"} 3' in lines
+    assert 'test_seconds_bucket{shape="port_port",le="+Inf"} 4' in lines
+    assert 'test_seconds_count{shape="port_port"} 4' in lines
+    assert 'test_seconds_sum{shape="port_port"} 3.65' in lines
+
+
+def test_phases_recorded_under_shape(monkeypatch, caplog):
+    """Phases timed before the shape is known are still labeled with it, slow requests are logged."""
+    monkeypatch.setattr(metrics, "SLOW_QUERY_SECONDS", 1e-9)
+    phases = metrics.Histogram("test_phase_seconds", "Test.", labels=("phase", "shape"))
+    monkeypatch.setattr(metrics, "PHASE_SECONDS", phases)
+
+    with caplog.at_level(logging.WARNING, logger="app.slow_query"):
+        with metrics.request_timer(origin="CNSGH") as timer:
+            with metrics.phase("date_validate"):
+                pass
+            timer.shape = "port_region"
+            metrics.record("region_lookup", 0.01)
+            metrics.record("region_lookup", 0.02)
+
+    assert sorted(phases._series) == [("date_validate", "port_region"), ("region_lookup", "port_region")]
+    assert phases._series[("region_lookup", "port_region")][1] == 0.03
+    assert "shape=port_region origin=CNSGH" in caplog.text
+
+    # outside a request, nothing is recorded
+    with metrics.phase("serialize"):
+        pass
+    assert len(phases._series) == 2
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Tests for discovery and bookkeeping of schema migrations."""
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+from app import migrate
+
+
+class _MigrationConnection:
+    """Stand-in for `asyncpg.Connection` keeping `schema_migrations` in memory."""
+
+    def __init__(self, done=()):
+        self.done = set(done)
+        self.scripts = []
+
+    async def execute(self, query, *args):
+        if query.startswith("INSERT INTO schema_migrations"):
+            self.done.add(args[0])
+        elif not query.lstrip().startswith(("SELECT pg_advisory", "CREATE TABLE IF NOT EXISTS schema_migrations")):
+            self.scripts.append(query)
+
+    async def fetch(self, query):
+        return [{"version": version} for version in self.done]
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+
+def test_discover_is_ordered():
+    """Should list the shipped migrations by version."""
+    versions = [version for version, _, _ in migrate.discover()]
+    assert versions == sorted(versions)
+    assert versions[:3] == [1, 2, 3]
+
+
+def test_discover_rejects_bad_names(tmp_path):
+    """Should refuse files that do not follow `<version>_<name>.sql`."""
+    (tmp_path / "add_index.sql").write_text("SELECT 1;")
+    with pytest.raises(ValueError):
+        migrate.discover(tmp_path)
+
+
+def test_apply_only_pending(tmp_path):
+    """Should run pending migrations in order and record them."""
+    (tmp_path / "0001_first.sql").write_text("SELECT 1;")
+    (tmp_path / "0002_second.sql").write_text("SELECT 2;")
+    (tmp_path / "0003_third.sql").write_text("SELECT 3;")
+    conn = _MigrationConnection(done={1})
+
+    applied = asyncio.run(migrate.apply_migrations(conn, tmp_path))
+
+    assert applied == [2, 3]
+    assert conn.scripts == ["SELECT 2;", "SELECT 3;"]
+    assert asyncio.run(migrate.apply_migrations(conn, tmp_path)) == []
+
+
+def test_apply_up_to_version(tmp_path):
+    """Should leave migrations past `up_to` pending."""
+    (tmp_path / "0001_first.sql").write_text("SELECT 1;")
+    (tmp_path / "0002_second.sql").write_text("SELECT 2;")
+    conn = _MigrationConnection()
+
+    assert asyncio.run(migrate.apply_migrations(conn, tmp_path, up_to=1)) == [1]
+    assert asyncio.run(migrate.apply_migrations(conn, tmp_path)) == [2]
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Tests for the pool wrapper, using a stand-in for `asyncpg.Pool`."""
+import asyncio
+
+import pytest
+
+from app.api.pool import ConnectionPool, PoolTimeout
+
+
+class _FakeConnection:
+    async def fetchval(self, query):
+        return 1
+
+
+class _FakePool:
+    """Mimics the subset of `asyncpg.Pool` used by `ConnectionPool`."""
+
+    def __init__(self, size):
+        self._free = asyncio.Queue()
+        for _ in range(size):
+            self._free.put_nowait(_FakeConnection())
+        self.size = size
+
+    async def acquire(self, timeout=None):
+        return await asyncio.wait_for(self._free.get(), timeout)
+
+    async def release(self, conn):
+        self._free.put_nowait(conn)
+
+    def get_size(self):
+        return self.size
+
+    def get_idle_size(self):
+        return self._free.qsize()
+
+
+def _make_pool(size=1, acquire_timeout=0.05):
+    pool = ConnectionPool("postgresql://unused", max_size=size,
+                          acquire_timeout=acquire_timeout)
+    pool._pool = _FakePool(size)
+    return pool
+
+
+def test_metrics_track_in_use():
+    """Should count connections handed out and give them back on exit."""
+    async def _run():
+        pool = _make_pool(size=2)
+        async with pool.acquire():
+            metrics = pool.metrics()
+            assert metrics["in_use"] == 1
+            assert metrics["idle"] == 1
+            assert metrics["saturation"] == 0.5
+        assert pool.metrics()["in_use"] == 0
+        assert pool.metrics()["acquired_total"] == 1
+
+    asyncio.run(_run())
+
+
+def test_acquire_timeout():
+    """Should raise `PoolTimeout` and count it when the pool is saturated."""
+    async def _run():
+        pool = _make_pool(size=1)
+        async with pool.acquire():
+            with pytest.raises(PoolTimeout):
+                async with pool.acquire():
+                    pass
+        assert pool.metrics()["timeouts_total"] == 1
+        assert pool.metrics()["waiting"] == 0
+
+    asyncio.run(_run())
+
+
+def test_health_check():
+    """Should report healthy when the connection answers `SELECT 1`."""
+    assert asyncio.run(_make_pool().health_check()) is True
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Tests for the in-process region hierarchy index."""
+import asyncio
+
+from app.api.regions import RegionIndex
+
+REGIONS = [
+    {"slug": "northern_europe", "parent_slug": None},
+    {"slug": "scandinavia", "parent_slug": "northern_europe"},
+    {"slug": "stockholm_area", "parent_slug": "scandinavia"},
+    {"slug": "china_main", "parent_slug": None},
+]
+
+PORTS = [
+    {"code": "NOOSL", "parent_slug": "scandinavia"},
+    {"code": "SESTO", "parent_slug": "stockholm_area"},
+    {"code": "RULED", "parent_slug": "northern_europe"},
+    {"code": "CNSGH", "parent_slug": "china_main"},
+]
+
+
+class _TreeConnection:
+    """Stand-in for `asyncpg.Connection` serving the tree above and counting queries."""
+
+    def __init__(self):
+        self.queries = 0
+
+    async def fetch(self, query):
+        self.queries += 1
+        return REGIONS if "Regions" in query else PORTS
+
+
+def _loaded_index():
+    index = RegionIndex()
+    index.load(REGIONS, PORTS)
+    return index
+
+
+def test_transitive_closure():
+    """Should reach grandchild regions and ports directly under a main region."""
+    index = _loaded_index()
+    assert index.ports_of("northern_europe") == ["NOOSL", "RULED", "SESTO"]
+    assert index.ports_of("scandinavia") == ["NOOSL", "SESTO"]
+    assert index.ports_of("stockholm_area") == ["SESTO"]
+
+
+def test_unknown_slug():
+    """Should resolve an unknown slug to no ports."""
+    assert _loaded_index().ports_of("atlantis") == []
+
+
+def test_resolve_only_loads_when_stale():
+    """Should hit the db once for the load and then answer from memory."""
+    async def _run():
+        index = RegionIndex(ttl=0)
+        conn = _TreeConnection()
+        assert await index.resolve(conn, "china_main") == ["CNSGH"]
+        assert await index.resolve(conn, "scandinavia") == ["NOOSL", "SESTO"]
+        assert conn.queries == 2
+
+        index.invalidate()
+        await index.resolve(conn, "china_main")
+        assert conn.queries == 4
+
+    asyncio.run(_run())
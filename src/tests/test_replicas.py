@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""Tests for the routing of reads to replicas, using stand-ins for the primary and replica pools."""
+import asyncio
+
+import asyncpg
+import pytest
+
+from app.api.pool import ConnectionPool
+from app.api.replicas import ReplicaRouter
+from app.api.stats import stats_state
+
+
+class _Server:
+    """What a stand-in database answers: its name, replication lag and prices version."""
+
+    def __init__(self, name, lag=0.0, prices_version=7, stats_version=None):
+        self.name = name
+        self.lag = lag
+        self.prices_version = prices_version
+        self.stats_version = prices_version if stats_version is None else stats_version
+        self.down = False
+
+
+class _FakeConnection:
+    def __init__(self, server):
+        self.server = server
+
+    async def fetchval(self, query):
+        if self.server.down:
+            raise ConnectionResetError(f"{self.server.name} is down")
+        return self.server.lag
+
+    async def fetchrow(self, query):
+        return {"prices_version": self.server.prices_version, "stats_version": self.server.stats_version}
+
+
+class _FakePool:
+    """Mimics the subset of `asyncpg.Pool` used by `ConnectionPool`."""
+
+    def __init__(self, server, size):
+        self._free = asyncio.Queue()
+        for _ in range(size):
+            self._free.put_nowait(_FakeConnection(server))
+
+    async def acquire(self, timeout=None):
+        return await asyncio.wait_for(self._free.get(), timeout)
+
+    async def release(self, conn):
+        self._free.put_nowait(conn)
+
+    async def close(self):
+        pass
+
+    def get_size(self):
+        return 0
+
+    def get_idle_size(self):
+        return self._free.qsize()
+
+
+def _make_pool(server, size=2):
+    pool = ConnectionPool("postgresql://unused", max_size=size, acquire_timeout=0.05)
+    pool._pool = _FakePool(server, size)
+    return pool
+
+
+async def _router(*replicas, max_lag=5.0):
+    """A router over opened stand-in pools, checked once."""
+    router = ReplicaRouter(_make_pool(_Server("primary")), [_make_pool(server) for server in replicas],
+                           max_lag=max_lag, check_interval=3600)
+    for replica in router.replicas:
+        replica.is_open = True
+    return await router.open()
+
+
+async def _server_of(router):
+    async with router.acquire() as conn:
+        return conn.server.name
+
+
+@pytest.fixture(autouse=True)
+def _prices_version(monkeypatch):
+    monkeypatch.setattr(stats_state, "prices_version", 7)
+
+
+def test_least_outstanding_replica_is_picked():
+    """Reads go to the replica with the fewest queries running, ties taking turns."""
+    async def _run():
+        router = await _router(_Server("first"), _Server("second"))
+        assert [await _server_of(router) for _ in range(4)] == ["first", "second", "first", "second"]
+
+        async with router.replicas[0].pool.acquire():
+            assert [await _server_of(router) for _ in range(2)] == ["second", "second"]
+        assert router.metrics()["replica_reads_total"] == 6
+        assert router.metrics()["primary_reads_total"] == 0
+
+    asyncio.run(_run())
+
+
+def test_replicas_out_of_sync_are_skipped():
+    """A replica trailing by more than `max_lag`, or still holding older prices, leaves reads to the others."""
+    async def _run():
+        lagging, behind = _Server("lagging", lag=30.0), _Server("behind", prices_version=6)
+        router = await _router(lagging, behind)
+        assert await _server_of(router) == "primary"
+        assert [replica["in_sync"] for replica in router.metrics()["replicas"]] == [False, False]
+
+        lagging.lag, behind.prices_version = 0.5, 7
+        await router.check()
+        assert {await _server_of(router) for _ in range(2)} == {"lagging", "behind"}
+
+    asyncio.run(_run())
+
+
+def test_replica_with_stale_stats_is_skipped(monkeypatch):
+    """While the primary's stats are fresh, a replica that has not replayed their refresh takes no reads."""
+    async def _run():
+        server = _Server("replica", stats_version=6)
+        router = await _router(server)
+        monkeypatch.setattr(stats_state, "fresh", True)
+        assert await _server_of(router) == "primary"
+
+        monkeypatch.setattr(stats_state, "fresh", False)
+        assert await _server_of(router) == "replica"
+
+        server.stats_version = 7
+        monkeypatch.setattr(stats_state, "fresh", True)
+        await router.check()
+        assert await _server_of(router) == "replica"
+
+    asyncio.run(_run())
+
+
+def test_failed_replica_fails_over_to_primary():
+    """A query the replica could not run is run again on the primary, and the replica left aside."""
+    async def _run():
+        server = _Server("replica")
+        router = await _router(server)
+        calls = []
+
+        async def _query(conn):
+            calls.append(conn.server.name)
+            if conn.server.down:
+                raise asyncpg.ConnectionDoesNotExistError("connection was closed in the middle of operation")
+            return conn.server.name
+
+        server.down = True
+        assert await router.run(_query) == "primary"
+        assert calls == ["replica", "primary"]
+        assert router.metrics()["failovers_total"] == 1
+
+        # left aside for `retry_after` seconds, then checked again
+        assert await router.run(_query) == "primary"
+        assert calls == ["replica", "primary", "primary"]
+        server.down = False
+        router.replicas[0].down_until = 0.0
+        await router.check()
+        assert await router.run(_query) == "replica"
+
+    asyncio.run(_run())
+
+
+def test_timeout_on_replica_is_not_a_failover():
+    """A statement timeout reaches the caller, the replica stays in rotation and the primary is spared."""
+    async def _run():
+        router = await _router(_Server("replica"))
+        calls = []
+
+        async def _slow_query(conn):
+            calls.append(conn.server.name)
+            await asyncio.sleep(1)
+
+        with pytest.raises(asyncio.TimeoutError):
+            await router.run(lambda conn: asyncio.wait_for(_slow_query(conn), 0.01))
+        with pytest.raises(asyncio.TimeoutError):
+            async with router.acquire() as conn:
+                await asyncio.wait_for(_slow_query(conn), 0.01)
+
+        assert calls == ["replica", "replica"]
+        assert not router.replicas[0].is_down()
+        assert router.metrics()["failovers_total"] == 0
+
+    asyncio.run(_run())
+
+
+def test_unreachable_replica_is_left_aside():
+    """A replica whose check fails takes no reads until it answers again."""
+    async def _run():
+        server = _Server("replica")
+        server.down = True
+        router = await _router(server)
+        assert router.replicas[0].is_down()
+        assert router.metrics()["replicas"][0]["failures_total"] == 1
+        assert await _server_of(router) == "primary"
+
+    asyncio.run(_run())
+
+
+def test_without_replicas_reads_go_to_primary():
+    async def _run():
+        router = await _router()
+        assert await _server_of(router) == "primary"
+        assert router.max_size == router.primary.max_size
+
+    asyncio.run(_run())
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Tests for the cache tier shared by worker processes."""
+import asyncio
+import time
+
+from app.api.regions import RegionIndex
+from app.shared_cache import SharedCache
+from .test_regions import _TreeConnection
+
+
+def test_entries_seen_by_other_handles(tmp_path):
+    """What one worker puts, another one opening the same file gets, until it expires."""
+    path = str(tmp_path / "cache.sqlite3")
+    first, second = SharedCache(path, ttl=60), SharedCache(path, ttl=60)
+
+    first.put("rates:a", b"\x00\x01")
+    first.put("rates:b", b"\x02", ttl=-1)
+    assert second.get("rates:a") == b"\x00\x01"
+    assert second.get("rates:b") is None
+    assert second.stats()["hits"] == 1
+
+    second.invalidate()
+    assert first.get("rates:a") is None
+
+
+def test_locked_file_is_a_miss(tmp_path):
+    """While another worker holds the write lock, puts are skipped and lookups still answer, without waiting."""
+    path = str(tmp_path / "cache.sqlite3")
+    cache, other = SharedCache(path, ttl=60), SharedCache(path, ttl=60)
+    cache.put("rates:a", b"\x00")
+    other._get_conn().execute("BEGIN IMMEDIATE")
+    try:
+        started = time.monotonic()
+        cache.put("rates:b", b"\x01")
+        assert cache.get("rates:a") == b"\x00"
+        assert time.monotonic() - started < 0.5
+    finally:
+        other._get_conn().execute("ROLLBACK")
+    assert cache.get("rates:b") is None
+    assert cache.stats()["errors"] == 1
+
+
+def test_prune_keeps_maxsize(tmp_path, monkeypatch):
+    """Past `maxsize`, the entries closest to expiry go first."""
+    monkeypatch.setattr(SharedCache, "PRUNE_EVERY", 1)
+    cache = SharedCache(str(tmp_path / "cache.sqlite3"), maxsize=2, ttl=60)
+    for index in range(4):
+        cache.put(f"key{index}", b"x", ttl=60 + index)
+        time.sleep(0.001)
+
+    assert cache.stats()["size"] == 2
+    assert cache.get("key0") is None
+    assert cache.get("key3") == b"x"
+
+
+def test_region_rows_loaded_once_per_host(tmp_path):
+    """A second worker builds its index from the rows the first one shared."""
+    path = str(tmp_path / "cache.sqlite3")
+    first = RegionIndex(ttl=60, shared=SharedCache(path))
+    second = RegionIndex(ttl=60, shared=SharedCache(path))
+    conn = _TreeConnection()
+
+    asyncio.run(first.refresh(conn))
+    asyncio.run(second.refresh(conn))
+
+    assert conn.queries == 2
+    assert second.ports_of("northern_europe") == first.ports_of("northern_europe")
+
+    # invalidating drops the shared rows too
+    second.invalidate()
+    asyncio.run(first.refresh(conn))
+    assert conn.queries == 4
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""Tests for the memory-mapped snapshot of the in-memory engine."""
+import asyncio
+import os
+import random
+
+import numpy as np
+import pytest
+
+from app.api import snapshot
+from app.api.engine import PriceEngine
+from app.api.stats import stats_state
+from .test_engine import PORTS, _prices
+from .test_regions import PORTS as TREE_PORTS, REGIONS as TREE_REGIONS, _TreeConnection
+
+QUERIES = [
+    (["CNSGH"], ["EETLL"], "2016-01-01", "2016-01-31"),
+    (["CNSGH", "CNYTN"], ["EETLL", "FIKTK", "RULED"], "2015-12-20", "2016-03-10"),
+]
+
+
+def _engine(seed, version):
+    engine = PriceEngine()
+    prices = _prices(random.Random(seed))
+    engine.build(*zip(*[(o, d, day.toordinal(), 1, p) for o, d, day, p in prices]), codes=PORTS, version=version)
+    return engine
+
+
+def _answers(engine):
+    return [engine.arrays(engine.ids_of(orig), engine.ids_of(dest), *days)[1] for orig, dest, *days in QUERIES]
+
+
+def test_mapped_engine_answers_the_same(tmp_path):
+    """An engine attached to the file answers like the one saved, from read-only views of the mapping."""
+    path = str(tmp_path / "snapshot.bin")
+    built = _engine(0, version=3)
+    snapshot.write(path, built, TREE_REGIONS, TREE_PORTS)
+
+    mapped = snapshot.Snapshot(path)
+    engine = PriceEngine()
+    mapped.attach(engine)
+
+    assert engine.version == 3
+    assert list(engine.codes) == list(built.codes)
+    for expected, answer in zip(_answers(built), _answers(engine)):
+        np.testing.assert_array_equal(expected, answer)
+    for name in PriceEngine.COLUMNS:
+        column = getattr(engine, name)
+        assert not column.flags.owndata and not column.flags.writeable
+        assert column.ctypes.data % snapshot.ALIGN == 0
+    assert mapped.tree() == (TREE_REGIONS, TREE_PORTS)
+
+
+def test_swap_keeps_former_mapping_readable(tmp_path):
+    """Writing a new version replaces the file for the next readers only."""
+    path = str(tmp_path / "snapshot.bin")
+    first, second = _engine(0, version=3), _engine(1, version=4)
+    snapshot.write(path, first, TREE_REGIONS, TREE_PORTS)
+    engine = PriceEngine()
+    snapshot.Snapshot(path).attach(engine)
+
+    snapshot.write(path, second, TREE_REGIONS, TREE_PORTS)
+
+    for expected, answer in zip(_answers(first), _answers(engine)):
+        np.testing.assert_array_equal(expected, answer)
+    assert snapshot.Snapshot(path).prices_version == 4
+    assert os.listdir(tmp_path) == ["snapshot.bin"]
+
+
+@pytest.mark.parametrize("content", [b"", b"RATES", b"NOTASNAP" + bytes(64)])
+def test_foreign_file_is_not_mapped(tmp_path, content):
+    path = tmp_path / "snapshot.bin"
+    path.write_bytes(content)
+    assert snapshot.open_snapshot(str(path)) is None
+    assert snapshot.open_snapshot(str(tmp_path / "missing.bin")) is None
+
+
+def test_load_builds_once_per_version(tmp_path, monkeypatch):
+    """The first worker builds and writes the snapshot, the next ones only map it."""
+    builds = []
+
+    async def _refresh(self, conn):
+        builds.append(stats_state.prices_version)
+        built = _engine(stats_state.prices_version, stats_state.prices_version)
+        self.assign(built.codes, built.epoch, built.version,
+                    **{name: getattr(built, name) for name in PriceEngine.COLUMNS})
+
+    monkeypatch.setattr(PriceEngine, "refresh", _refresh)
+    monkeypatch.setattr(stats_state, "prices_version", 3)
+    monkeypatch.setattr(stats_state, "checked_at", float("inf"))
+    path = str(tmp_path / "snapshot.bin")
+    conn = _TreeConnection()
+
+    async def _run():
+        first, second = PriceEngine(), PriceEngine()
+        assert (await snapshot.load(conn, first, path)).prices_version == 3
+        await snapshot.load(conn, second, path)
+        assert builds == [3] and second.version == 3
+        assert conn.queries == 2
+
+        stats_state.prices_version = 4
+        await snapshot.load(conn, second, path)
+        assert builds == [3, 4] and second.version == 4
+        assert not second.keys.flags.owndata
+
+    asyncio.run(_run())
+
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""Tests that the query layer only sends constant statements with bound parameters."""
+import asyncio
+from datetime import date
+
+import pytest
+
+from app.api import sql
+from app.api.regions import region_index
+from app.api.stats import stats_state
+
+
+class _RecordingConnection:
+    """Stand-in for `asyncpg.Connection` remembering what was sent to the db."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def fetch(self, query, *args):
+        self.calls.append((query, args))
+        return []
+
+
+@pytest.fixture(autouse=True)
+def stats_freshness(monkeypatch):
+    """Pins the stats freshness check (no `rates_meta` behind the stand-in) to stale."""
+    monkeypatch.setattr(stats_state, "checked_at", float("inf"))
+    monkeypatch.setattr(stats_state, "fresh", False)
+
+
+def test_both_ports_is_parameterized():
+    """Should bind locations and typed dates instead of formatting them in."""
+    conn = _RecordingConnection()
+    asyncio.run(sql.execute_when_both_ports(conn, "CNSGH", "EETLL", "2016-01-01", "2016-01-10"))
+
+    assert conn.calls == [(
+        sql.RATES_BOTH_PORTS,
+        ("CNSGH", "EETLL", date(2016, 1, 1), date(2016, 1, 10)),
+    )]
+
+
+def test_freshness_given_leaves_stats_state(monkeypatch):
+    """A freshness decided by the caller is used as is: the connection (a replica's) sets no stamps."""
+    monkeypatch.setattr(stats_state, "checked_at", None)
+    monkeypatch.setattr(stats_state, "prices_version", 7)
+    conn = _RecordingConnection()
+    asyncio.run(sql.execute_when_both_ports(conn, "CNSGH", "EETLL", "2016-01-01", "2016-01-10", from_stats=True))
+
+    assert [query for query, _ in conn.calls] == [sql.STATS_BOTH_PORTS]
+    assert stats_state.checked_at is None and stats_state.prices_version == 7
+
+
+def test_same_text_for_different_arguments(monkeypatch):
+    """Should reuse one statement text across requests so it is prepared once."""
+    monkeypatch.setattr(region_index, "_ports", {"baltic": ["EETLL", "FIKTK"]})
+    monkeypatch.setattr(region_index, "loaded_at", float("inf"))
+    monkeypatch.setattr(region_index, "loads", 1)
+
+    conn = _RecordingConnection()
+    asyncio.run(sql.execute_when_both_region(conn, "baltic", "china_main", "2016-01-01", "2016-01-02"))
+    asyncio.run(sql.execute_when_both_region(conn, "scandinavia", "baltic", "2016-02-01", "2016-02-02"))
+
+    # regions are resolved in-process, only the rates statement reaches the db
+    assert [query for query, _ in conn.calls] == [sql.RATES_BOTH_REGION] * 2
+    assert conn.calls[0][1][:2] == (["EETLL", "FIKTK"], [])
+
+
+def test_both_region_before_index_is_loaded(monkeypatch):
+    """Should resolve the hierarchy inside the one statement when the index is cold."""
+    monkeypatch.setattr(region_index, "loads", 0)
+
+    conn = _RecordingConnection()
+    asyncio.run(sql.execute_when_both_region(conn, "baltic", "china_main", "2016-01-01", "2016-01-02"))
+
+    assert conn.calls == [(
+        sql.RATES_BOTH_REGION_RECURSIVE,
+        ("baltic", "china_main", date(2016, 1, 1), date(2016, 1, 2)),
+    )]
+
+
+def test_reads_stats_when_fresh(monkeypatch):
+    """Should read the region rollup by slug, without expanding regions."""
+    monkeypatch.setattr(stats_state, "fresh", True)
+
+    conn = _RecordingConnection()
+    asyncio.run(sql.execute_when_both_region(conn, "baltic", "china_main", "2016-01-01", "2016-01-02"))
+    asyncio.run(sql.execute_when_both_ports(conn, "CNSGH", "EETLL", "2016-01-01", "2016-01-02"))
+
+    assert [query for query, _ in conn.calls] == [sql.STATS_BOTH_REGION, sql.STATS_BOTH_PORTS]
+    assert conn.calls[0][1][:2] == ("baltic", "china_main")
+
+
+def test_bucketed_statement_wraps_the_daily_one():
+    """Should send the bucketed text of the daily statement, with the bucket as parameters."""
+    conn = _RecordingConnection()
+    asyncio.run(sql.execute_when_both_ports(conn, "CNSGH", "EETLL", "2016-01-01", "2016-03-31", "14d"))
+    asyncio.run(sql.execute_when_both_ports(conn, "CNSGH", "EETLL", "2016-01-01", "2016-03-31", "month"))
+
+    assert conn.calls[0] == (
+        sql.BUCKETED[sql.RATES_BOTH_PORTS],
+        ("CNSGH", "EETLL", date(2016, 1, 1), date(2016, 3, 31), "days", 14),
+    )
+    assert conn.calls[1][1][4:] == ("month", 1)
+    assert sql.RATES_BOTH_PORTS in sql.BUCKETED[sql.RATES_BOTH_PORTS]
+
+
+def test_matrix_is_one_statement(monkeypatch):
+    """Should expand each region once and read every lane with one statement."""
+    monkeypatch.setattr(region_index, "_ports", {"baltic": ["EETLL", "FIKTK"], "china_main": ["CNSGH"]})
+    monkeypatch.setattr(region_index, "loaded_at", float("inf"))
+    monkeypatch.setattr(region_index, "loads", 1)
+
+    async def _run(conn):
+        origins = await sql.ports_of(conn, "china_main", True)
+        destinations = await sql.ports_of(conn, "baltic", True)
+        assert await sql.ports_of(conn, "RULED", False) == ["RULED"]
+        await sql.execute_matrix(conn, origins, destinations, "2016-01-01", "2016-01-31")
+        await sql.execute_matrix(conn, origins, destinations, "2016-01-01", "2016-01-31", collapse=True)
+
+    conn = _RecordingConnection()
+    asyncio.run(_run(conn))
+    assert conn.calls == [
+        (sql.MATRIX_RATES, (["CNSGH"], ["EETLL", "FIKTK"], date(2016, 1, 1), date(2016, 1, 31))),
+        (sql.MATRIX_RATES_COLLAPSED, (["CNSGH"], ["EETLL", "FIKTK"], date(2016, 1, 1), date(2016, 1, 31))),
+    ]
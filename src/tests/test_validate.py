@@ -2,7 +2,7 @@
 """Tests that all validation functions perform as expectation, covering 100% coverage."""
 import pytest
 
-from app.validate import date, location, result
+from app.validate import date, granularity, location, result
 
 
 class TestDate:
@@ -113,6 +113,24 @@ class TestLocation:
             assert result_ == ("neither", "neither")
 
 
+class TestGranularity:
+    @pytest.mark.parametrize("given, expected", [
+        ("day", "day"), ("Week", "week"), ("month", "month"), ("1d", "day"), ("07d", "7d"), ("366d", "366d"),
+    ])
+    def test_canonical(self, given, expected):
+        """Should accept the units and N-day buckets, spelled one way."""
+        assert granularity.validate(given) == expected
+
+    @pytest.mark.parametrize("given", ["", "year", "0d", "367d", "d", "7", "-7d", "7 days"])
+    def test_granularity_wrong(self, given):
+        """Should return 'f_granularity_wrong' for anything else"""
+        assert granularity.validate(given) == "f_granularity_wrong"
+
+    def test_bucket_of(self):
+        assert granularity.bucket_of("week") == ("week", 1)
+        assert granularity.bucket_of("14d") == ("days", 14)
+
+
 class TestResult:
     from datetime import date
 
@@ -159,3 +177,113 @@ class TestResult:
             counter += 1
 
         assert counter == 10
+
+    def test_validate_fills_sparse_rows(self):
+        """Should fill days missing from the rows with None."""
+        data = [
+            {"days": 3, "average_price": 1000.4, "day": self.date(2016, 1, 2)},
+            {"days": 2, "average_price": 1000.0, "day": self.date(2016, 1, 3)},
+        ]
+
+        assert result.validate(data, "2016-01-01", "2016-01-03") == [
+            {"day": "2016-01-01", "average_price": None},
+            {"day": "2016-01-02", "average_price": 1000},
+            {"day": "2016-01-03", "average_price": None},
+        ]
+
+    def test_validate_maps_dense_rows(self):
+        """Should give the same answer for one row per day, as the queries return."""
+        data = [
+            {"days": 0, "average_price": None, "day": self.date(2016, 1, 1)},
+            {"days": 3, "average_price": 1000.4, "day": self.date(2016, 1, 2)},
+            {"days": 2, "average_price": 1000.0, "day": self.date(2016, 1, 3)},
+        ]
+
+        assert result.validate(data, "2016-01-01", "2016-01-03") == [
+            {"day": "2016-01-01", "average_price": None},
+            {"day": "2016-01-02", "average_price": 1000},
+            {"day": "2016-01-03", "average_price": None},
+        ]
+
+    def test_to_arrays(self):
+        """Should lay prices on the full day axis, NaN where not reported."""
+        import numpy as np
+
+        data = [
+            {"days": 5, "average_price": 1000.5, "day": self.date(2016, 1, 3)},
+            {"days": 1, "average_price": 900.0, "day": self.date(2016, 1, 1)},
+            {"days": 9, "average_price": 800.0, "day": self.date(2016, 2, 1)},
+        ]
+        days, prices = result.to_arrays(data, "2016-01-01", "2016-01-03")
+
+        assert np.datetime_as_string(days).tolist() == ["2016-01-01", "2016-01-02", "2016-01-03"]
+        assert np.isnan(prices[:2]).all()
+        assert prices[2] == 1000
+
+    def test_encode_json_matches_validate(self):
+        """Should encode exactly what `validate` returns, without the dicts."""
+        import json
+
+        data = [
+            {"days": 0, "average_price": None, "day": self.date(2016, 1, 1)},
+            {"days": 3, "average_price": 1000.4, "day": self.date(2016, 1, 2)},
+        ]
+        encoded = result.encode_json(*result.to_arrays(data, "2016-01-01", "2016-01-03"))
+
+        assert json.loads(encoded) == result.validate(data, "2016-01-01", "2016-01-03")
+
+    def test_bucket_axis(self):
+        """Should cut calendar weeks/months at `date_from` and count N-day buckets from it."""
+        import numpy as np
+
+        def _axis(*args):
+            return np.datetime_as_string(result.bucket_axis(*args)).tolist()
+
+        # 2016-01-01 was a Friday
+        assert _axis("2016-01-01", "2016-01-18", "week") == ["2016-01-01", "2016-01-04", "2016-01-11", "2016-01-18"]
+        assert _axis("2016-01-15", "2016-03-01", "month") == ["2016-01-15", "2016-02-01", "2016-03-01"]
+        assert _axis("2016-01-01", "2016-01-20", "7d") == ["2016-01-01", "2016-01-08", "2016-01-15"]
+        assert _axis("2016-01-01", "2016-01-03", "day") == ["2016-01-01", "2016-01-02", "2016-01-03"]
+
+    def test_validate_buckets(self):
+        """Should lay bucket rows on the bucket axis, None below 3 prices per bucket."""
+        data = [
+            {"days": 2, "average_price": 1000.0, "day": self.date(2016, 1, 1)},
+            {"days": 9, "average_price": 1200.4, "day": self.date(2016, 1, 4)},
+        ]
+
+        assert result.validate(data, "2016-01-01", "2016-01-17", "week") == [
+            {"day": "2016-01-01", "average_price": None},
+            {"day": "2016-01-04", "average_price": 1200},
+            {"day": "2016-01-11", "average_price": None},
+        ]
+
+    def test_matrix(self):
+        """Should lay lane rows out densely and encode them with their axes."""
+        import json
+
+        import msgpack
+        import numpy as np
+
+        data = [
+            {"orig_code": "CNYTN", "dest_code": "EETLL", "day": self.date(2016, 1, 2),
+             "price_count": 4, "price_sum": 4002},
+            {"orig_code": "CNSGH", "dest_code": "EETLL", "day": self.date(2016, 1, 1),
+             "price_count": 2, "price_sum": 2000},
+        ]
+        origins, destinations = ["CNSGH", "CNYTN"], ["EETLL", "FIKTK"]
+        counts, sums = result.to_matrix(data, origins, destinations, "2016-01-01", "2016-01-02")
+        prices = result.matrix_prices(counts, sums)
+
+        assert counts.shape == (2, 2, 2)
+        assert prices[1, 0, 1] == 1000 and np.isnan(prices[0, 0, 0])
+
+        decoded = json.loads(result.encode_matrix(origins, destinations, "2016-01-01", "2016-01-02",
+                                                  prices, "application/json"))
+        assert decoded["average_price"] == [[[None, None], [None, None]], [[None, 1000], [None, None]]]
+
+        decoded = msgpack.unpackb(result.encode_matrix(origins, destinations, "2016-01-01", "2016-01-02",
+                                                       prices, "application/msgpack"))
+        dense = np.frombuffer(decoded["average_price"], dtype=decoded["dtype"]).reshape(decoded["shape"])
+        np.testing.assert_array_equal(dense, prices)
+        assert decoded["origins"] == origins